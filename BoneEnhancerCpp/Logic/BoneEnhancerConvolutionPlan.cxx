@@ -0,0 +1,160 @@
+/*==============================================================================
+
+Program: 3D Slicer
+
+Portions (c) Copyright Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+See COPYRIGHT.txt
+or http://www.slicer.org/copyright/copyright.txt for details.
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+==============================================================================*/
+
+#include "BoneEnhancerConvolutionPlan.h"
+
+// STD includes
+#include <cmath>
+
+//----------------------------------------------------------------------------
+BoneEnhancerConvolutionPlan::BoneEnhancerConvolutionPlan()
+  : Nx(0)
+  , Ny(0)
+  , Sigma(0.0)
+  , RowTask(NULL)
+  , ColumnTask(NULL)
+  , RowBuffer(NULL)
+  , SingleRowTask(NULL)
+  , SingleColumnTask(NULL)
+  , SingleRowBuffer(NULL)
+{
+}
+
+//----------------------------------------------------------------------------
+BoneEnhancerConvolutionPlan::~BoneEnhancerConvolutionPlan()
+{
+  this->Release();
+}
+
+//----------------------------------------------------------------------------
+void BoneEnhancerConvolutionPlan::Release()
+{
+  if (this->RowTask)
+  {
+    vslConvDeleteTask(&this->RowTask);
+    this->RowTask = NULL;
+  }
+  if (this->ColumnTask)
+  {
+    vslConvDeleteTask(&this->ColumnTask);
+    this->ColumnTask = NULL;
+  }
+  if (this->RowBuffer)
+  {
+    mkl_free(this->RowBuffer);
+    this->RowBuffer = NULL;
+  }
+  if (this->SingleRowTask)
+  {
+    vslConvDeleteTask(&this->SingleRowTask);
+    this->SingleRowTask = NULL;
+  }
+  if (this->SingleColumnTask)
+  {
+    vslConvDeleteTask(&this->SingleColumnTask);
+    this->SingleColumnTask = NULL;
+  }
+  if (this->SingleRowBuffer)
+  {
+    mkl_free(this->SingleRowBuffer);
+    this->SingleRowBuffer = NULL;
+  }
+  this->Kernel.clear();
+  this->SingleKernel.clear();
+  this->Nx = 0;
+  this->Ny = 0;
+  this->Sigma = 0.0;
+}
+
+//----------------------------------------------------------------------------
+void BoneEnhancerConvolutionPlan::Prepare(int nx, int ny, double sigma)
+{
+  if (!this->Kernel.empty() && nx == this->Nx && ny == this->Ny && sigma == this->Sigma)
+  {
+    return;
+  }
+  this->Release();
+
+  // Calculate the 1D Gaussian kernel, the 2D kernel exp(-(x*x + y*y)/(2*sigma*sigma)) is its outer product
+  int intervall = floor(sigma*3);
+  for (int x = -intervall; x <= intervall; ++x)
+  {
+    this->Kernel.push_back(exp( -(x*x)/(2*sigma*sigma) ));
+  }
+  this->SingleKernel.assign(this->Kernel.begin(), this->Kernel.end());
+  this->Nx = nx;
+  this->Ny = ny;
+  this->Sigma = sigma;
+}
+
+//----------------------------------------------------------------------------
+void BoneEnhancerConvolutionPlan::GetTaskShapes(MKL_INT imageShape[2], MKL_INT rowKernelShape[2], MKL_INT columnKernelShape[2], MKL_INT rowStart[2], MKL_INT columnStart[2])
+{
+  // Both passes compute the central nx*ny part of the full convolution, which starts at the kernel center.
+  // The kernel is the fixed operand x of the tasks, the image the operand y given on execution.
+  MKL_INT nG = static_cast<MKL_INT>(this->Kernel.size());
+  imageShape[0] = this->Nx;
+  imageShape[1] = this->Ny;
+  rowKernelShape[0] = nG;
+  rowKernelShape[1] = 1;
+  columnKernelShape[0] = 1;
+  columnKernelShape[1] = nG;
+  rowStart[0] = nG / 2;
+  rowStart[1] = 0;
+  columnStart[0] = 0;
+  columnStart[1] = nG / 2;
+}
+
+//----------------------------------------------------------------------------
+void BoneEnhancerConvolutionPlan::Execute(const double* inputBuffer, double* outputBuffer)
+{
+  // The double precision tasks are created on first use
+  if (!this->RowTask)
+  {
+    MKL_INT imageShape[2], rowKernelShape[2], columnKernelShape[2], rowStart[2], columnStart[2];
+    this->GetTaskShapes(imageShape, rowKernelShape, columnKernelShape, rowStart, columnStart);
+    vsldConvNewTaskX(&this->RowTask, VSL_CONV_MODE_AUTO, 2, rowKernelShape, imageShape, imageShape, &this->Kernel[0], NULL);
+    vslConvSetStart(this->RowTask, rowStart);
+    vsldConvNewTaskX(&this->ColumnTask, VSL_CONV_MODE_AUTO, 2, columnKernelShape, imageShape, imageShape, &this->Kernel[0], NULL);
+    vslConvSetStart(this->ColumnTask, columnStart);
+
+    // Allocating memory aligned on 64-byte boundary for better performance
+    this->RowBuffer = (double*)mkl_malloc( this->Nx * this->Ny * sizeof( double ), 64 );
+  }
+  vsldConvExecX(this->RowTask, inputBuffer, NULL, this->RowBuffer, NULL);
+  vsldConvExecX(this->ColumnTask, this->RowBuffer, NULL, outputBuffer, NULL);
+}
+
+//----------------------------------------------------------------------------
+void BoneEnhancerConvolutionPlan::Execute(const float* inputBuffer, float* outputBuffer)
+{
+  // The single precision tasks are created on first use
+  if (!this->SingleRowTask)
+  {
+    MKL_INT imageShape[2], rowKernelShape[2], columnKernelShape[2], rowStart[2], columnStart[2];
+    this->GetTaskShapes(imageShape, rowKernelShape, columnKernelShape, rowStart, columnStart);
+    vslsConvNewTaskX(&this->SingleRowTask, VSL_CONV_MODE_AUTO, 2, rowKernelShape, imageShape, imageShape, &this->SingleKernel[0], NULL);
+    vslConvSetStart(this->SingleRowTask, rowStart);
+    vslsConvNewTaskX(&this->SingleColumnTask, VSL_CONV_MODE_AUTO, 2, columnKernelShape, imageShape, imageShape, &this->SingleKernel[0], NULL);
+    vslConvSetStart(this->SingleColumnTask, columnStart);
+
+    // Allocating memory aligned on 64-byte boundary for better performance
+    this->SingleRowBuffer = (float*)mkl_malloc( this->Nx * this->Ny * sizeof( float ), 64 );
+  }
+  vslsConvExecX(this->SingleRowTask, inputBuffer, NULL, this->SingleRowBuffer, NULL);
+  vslsConvExecX(this->SingleColumnTask, this->SingleRowBuffer, NULL, outputBuffer, NULL);
+}
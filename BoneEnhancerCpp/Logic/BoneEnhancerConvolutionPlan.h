@@ -0,0 +1,73 @@
+/*==============================================================================
+
+Program: 3D Slicer
+
+Portions (c) Copyright Brigham and Women's Hospital (BWH) All Rights Reserved.
+
+See COPYRIGHT.txt
+or http://www.slicer.org/copyright/copyright.txt for details.
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+==============================================================================*/
+
+// .NAME BoneEnhancerConvolutionPlan - reusable separable Gaussian convolution
+// .SECTION Description
+// Convolves 2D images with a Gaussian kernel as two 1D passes (along x, then along y)
+// using Intel MKL convolution tasks. The tasks are created once per image size and
+// sigma and reused for every following image, and the "same" sized output is written
+// directly, without an intermediate full-size convolution result. Double and single
+// precision images are supported, the tasks of each precision are created on first use.
+
+#ifndef __BoneEnhancerConvolutionPlan_h
+#define __BoneEnhancerConvolutionPlan_h
+
+// STD includes
+#include <vector>
+
+// Other includes
+#include "mkl.h"
+
+class BoneEnhancerConvolutionPlan
+{
+public:
+  BoneEnhancerConvolutionPlan();
+  ~BoneEnhancerConvolutionPlan();
+
+  /*! Prepares the plan for nx*ny images and a Gaussian kernel of the given sigma. Does nothing if it is already prepared for them. */
+  void Prepare(int nx, int ny, double sigma);
+
+  /*! Releases the convolution tasks and the intermediate buffer. */
+  void Release();
+
+  /*! Convolves an nx*ny image with the Gaussian kernel, pixels outside the image are zero. Input and output must not overlap. */
+  void Execute(const double* inputBuffer, double* outputBuffer);
+  void Execute(const float* inputBuffer, float* outputBuffer);
+
+  /*! Returns the size of the Gaussian kernel, i.e. floor(3*sigma)*2+1. */
+  int GetKernelSize() const { return static_cast<int>(this->Kernel.size()); }
+
+private:
+  BoneEnhancerConvolutionPlan(const BoneEnhancerConvolutionPlan&); // Not implemented
+  void operator=(const BoneEnhancerConvolutionPlan&); // Not implemented
+
+  void GetTaskShapes(MKL_INT imageShape[2], MKL_INT rowKernelShape[2], MKL_INT columnKernelShape[2], MKL_INT rowStart[2], MKL_INT columnStart[2]);
+
+  int Nx;
+  int Ny;
+  double Sigma;
+  std::vector<double> Kernel;
+  VSLConvTaskPtr RowTask;
+  VSLConvTaskPtr ColumnTask;
+  double* RowBuffer;
+  std::vector<float> SingleKernel;
+  VSLConvTaskPtr SingleRowTask;
+  VSLConvTaskPtr SingleColumnTask;
+  float* SingleRowBuffer;
+};
+
+#endif
@@ -17,6 +17,7 @@ limitations under the License.
 
 // BoneEnhancerCpp Logic includes
 #include "vtkSlicerBoneEnhancerCppLogic.h"
+#include "BoneEnhancerConvolutionPlan.h"
 
 // MRML includes
 #include <vtkMRMLScene.h>
@@ -31,18 +32,21 @@ limitations under the License.
 #include <vtkNew.h>
 #include <vtkObjectFactory.h>
 #include <vtkTimerLog.h>
+#include <vtkTypeTraits.h>
 
 // STD includes
+#include <algorithm>
 #include <cassert>
+#include <cfloat>
+#include <limits>
+#include <vector>
 
 // Slicer includes
 #include <vtkSlicerVolumesLogic.h>
 
 // Other includes
 #include "mkl.h"
-#ifdef NDEBUG
 #include <omp.h>
-#endif
 
 //----------------------------------------------------------------------------
 vtkStandardNewMacro(vtkSlicerBoneEnhancerCppLogic);
@@ -50,17 +54,81 @@ vtkStandardNewMacro(vtkSlicerBoneEnhancerCppLogic);
 //----------------------------------------------------------------------------
 vtkSlicerBoneEnhancerCppLogic::vtkSlicerBoneEnhancerCppLogic()
 {
+  this->NumberOfThreads = 0;
+  this->ShadowModelNy = 0;
+  this->ShadowModelSigma = 0.0;
+  this->InstrumentationEnabled = false;
+  std::fill(this->StageTimes, this->StageTimes + NumberOfStages, 0.0);
+  this->SliceTimes = vtkDoubleArray::New();
+  this->SliceTimes->SetNumberOfComponents(5);
+  this->CallStartTime = 0.0;
+  this->NumberOfSkippedSlices = 0;
+  this->NumberOfAllocatedBytes = 0;
+  this->NumberOfThreadsUsed = 0;
 }
 
 //----------------------------------------------------------------------------
 vtkSlicerBoneEnhancerCppLogic::~vtkSlicerBoneEnhancerCppLogic()
 {
+  this->ReleaseBuffers();
+  this->SliceTimes->Delete();
+}
+
+//----------------------------------------------------------------------------
+void vtkSlicerBoneEnhancerCppLogic::ReleaseBuffers()
+{
+  for (size_t i = 0; i < this->GaussianPlans.size(); ++i)
+  {
+    delete this->GaussianPlans[i];
+  }
+  this->GaussianPlans.clear();
+  for (size_t i = 0; i < this->BufferPool.size(); ++i)
+  {
+    FreePooledBuffers(this->BufferPool[i]);
+  }
+  this->BufferPool.clear();
+  this->ShadowModelSum.clear();
+  this->ShadowKernel.clear();
+  this->ShadowModelNy = 0;
+  this->ShadowModelSigma = 0.0;
+
+  // Internal buffers of Intel MKL
+  mkl_free_buffers();
 }
 
 //----------------------------------------------------------------------------
 void vtkSlicerBoneEnhancerCppLogic::PrintSelf(ostream& os, vtkIndent indent)
 {
   this->Superclass::PrintSelf(os, indent);
+  os << indent << "NumberOfThreads: " << this->NumberOfThreads << "\n";
+  os << indent << "InstrumentationEnabled: " << this->InstrumentationEnabled << "\n";
+}
+
+//----------------------------------------------------------------------------
+const char* vtkSlicerBoneEnhancerCppLogic::GetStageName(int stage)
+{
+  static const char* stageNames[NumberOfStages] = { "conversion", "gaussian", "laplacianOfGaussian", "reflectionNumber", "shadowValue", "normalization", "boneSurfaceProbability" };
+  if (stage < 0 || stage >= NumberOfStages)
+  {
+    return NULL;
+  }
+  return stageNames[stage];
+}
+
+//----------------------------------------------------------------------------
+double vtkSlicerBoneEnhancerCppLogic::GetStageTime(int stage)
+{
+  if (stage < 0 || stage >= NumberOfStages)
+  {
+    return 0.0;
+  }
+  return this->StageTimes[stage];
+}
+
+//----------------------------------------------------------------------------
+vtkDoubleArray* vtkSlicerBoneEnhancerCppLogic::GetSliceTimes()
+{
+  return this->SliceTimes;
 }
 
 //---------------------------------------------------------------------------
@@ -70,6 +138,7 @@ void vtkSlicerBoneEnhancerCppLogic::SetMRMLSceneInternal(vtkMRMLScene * newScene
   events->InsertNextValue(vtkMRMLScene::NodeAddedEvent);
   events->InsertNextValue(vtkMRMLScene::NodeRemovedEvent);
   events->InsertNextValue(vtkMRMLScene::EndBatchProcessEvent);
+  events->InsertNextValue(vtkMRMLScene::EndCloseEvent);
   this->SetAndObserveMRMLSceneEventsInternal(newScene, events.GetPointer());
 }
 
@@ -97,9 +166,68 @@ void vtkSlicerBoneEnhancerCppLogic
 {
 }
 
+//---------------------------------------------------------------------------
+void vtkSlicerBoneEnhancerCppLogic
+::OnMRMLSceneEndClose()
+{
+  this->ReleaseBuffers();
+}
+
+//---------------------------------------------------------------------------
+// Internal precision of the algorithms: double for double input, float otherwise
+template <class TInput> struct BoneEnhancerRealType { typedef float Type; };
+template <> struct BoneEnhancerRealType<double> { typedef double Type; };
+
+//---------------------------------------------------------------------------
+// Intel MKL vector math overloads for both precisions
+static inline void BoneEnhancerPowx(int n, const double* a, double b, double* r) { vdPowx(n, a, b, r); }
+static inline void BoneEnhancerPowx(int n, const float* a, float b, float* r) { vsPowx(n, a, b, r); }
+static inline void BoneEnhancerMul(int n, const double* a, const double* b, double* r) { vdMul(n, a, b, r); }
+static inline void BoneEnhancerMul(int n, const float* a, const float* b, float* r) { vsMul(n, a, b, r); }
+
+//---------------------------------------------------------------------------
+// Converts a BSP value to the output scalar type, integer types are rounded and clamped to their range and NaN becomes
+// zero, as in the NumPy engine (Foroughi2007.castToType)
+template <class TOutput> static inline TOutput BoneEnhancerConvertOutput(double value)
+{
+  if (!std::numeric_limits<TOutput>::is_integer)
+  {
+    return static_cast<TOutput>(value);
+  }
+  if (value != value)
+  {
+    return 0;
+  }
+  if (value <= vtkTypeTraits<TOutput>::Min())
+  {
+    return vtkTypeTraits<TOutput>::Min();
+  }
+  if (value >= vtkTypeTraits<TOutput>::Max())
+  {
+    return vtkTypeTraits<TOutput>::Max();
+  }
+  return static_cast<TOutput>(value + 0.5);
+}
+
+//---------------------------------------------------------------------------
+// Adds the wall time since lastTime to a stage and restarts it, does nothing if instrumentation is off (stageTimes is NULL)
+static inline void BoneEnhancerStopStage(double* stageTimes, int stage, double& lastTime)
+{
+  if (stageTimes)
+  {
+    double now = vtkTimerLog::GetUniversalTime();
+    stageTimes[stage] += now - lastTime;
+    lastTime = now;
+  }
+}
+
 //---------------------------------------------------------------------------
 // An image processing connector method, which takes both an input, and a output volume node from 3D Slicer,
-// an array of parameters, and the name of the algorithm to execute.
+// an array of parameters (sorted alphabetically by name), and the registered name of the algorithm to execute
+// (Algorithms.py of BoneEnhancerPy, e.g. "Foroughi2007", or its former title "Foroughi2007 (with minor
+// modifications)"). The input and output volumes can be of any scalar type (e.g. unsigned char, unsigned
+// short, float or double) and the input is not modified. Returns the runtime in seconds, or -1 if the
+// algorithm is unknown.
 float vtkSlicerBoneEnhancerCppLogic
 ::ImageProcessingConnector(vtkMRMLScalarVolumeNode* inputVolumeNode, vtkMRMLScalarVolumeNode* outputVolumeNode, vtkDoubleArray* params, std::string algorithmName, int firstSliceIndex, int lastSliceIndex)
 {
@@ -108,9 +236,17 @@ float vtkSlicerBoneEnhancerCppLogic
   int ny = dims[1];
   int nz = dims[2];
 
+  // Reset the instrumentation of the previous call
+  std::fill(this->StageTimes, this->StageTimes + NumberOfStages, 0.0);
+  this->SliceTimes->SetNumberOfTuples(0);
+  this->NumberOfSkippedSlices = 0;
+  this->NumberOfAllocatedBytes = 0;
+  this->NumberOfThreadsUsed = 0;
+  this->CallStartTime = vtkTimerLog::GetUniversalTime();
+
   vtkSmartPointer<vtkTimerLog> timer = vtkSmartPointer<vtkTimerLog>::New();
   timer->StartTimer();
-  if (algorithmName == "Foroughi2007 (with minor modifications)")
+  if (algorithmName == "Foroughi2007" || algorithmName == "Foroughi2007 (with minor modifications)")
   {
     // Define necessary parameters
     double blurredVSBLoG = params->GetValue(0);
@@ -120,9 +256,17 @@ float vtkSlicerBoneEnhancerCppLogic
     double smoothingSigma = params->GetValue(4);
     int transducerMargin = params->GetValue(5);		
 
-
     // Extract BSP from input volume (through pointer) and put result into the output volume's buffer
-    this->Foroughi2007(static_cast<double*>(inputVolumeNode->GetImageData()->GetScalarPointer(0,0,0)), static_cast<double*>(outputVolumeNode->GetImageData()->GetScalarPointer(0,0,0)), smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, nx, ny, nz, firstSliceIndex, lastSliceIndex);
+    void* inputPointer = inputVolumeNode->GetImageData()->GetScalarPointer(0,0,0);
+    void* outputPointer = outputVolumeNode->GetImageData()->GetScalarPointer(0,0,0);
+    int outputScalarType = outputVolumeNode->GetImageData()->GetScalarType();
+    switch (inputVolumeNode->GetImageData()->GetScalarType())
+    {
+      vtkTemplateMacro(this->Foroughi2007Dispatch(static_cast<VTK_TT*>(inputPointer), outputPointer, outputScalarType, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, nx, ny, nz, firstSliceIndex, lastSliceIndex));
+      default:
+        std::cout << "Unsupported input scalar type!" << std::endl;
+        return 0;
+    }
 
     // Set the output volume's geometry to be the same as the input volume
     vtkSmartPointer<vtkMatrix4x4> ijkToRasMatrix = vtkSmartPointer<vtkMatrix4x4>::New();
@@ -134,8 +278,8 @@ float vtkSlicerBoneEnhancerCppLogic
   }
   else
   {
-    std::cout << "No algorithm defined!" << std::endl;
-    return 0;
+    vtkErrorMacro("ImageProcessingConnector: unknown algorithm " << algorithmName);
+    return -1;
   }
 
   timer->StopTimer();
@@ -144,62 +288,71 @@ float vtkSlicerBoneEnhancerCppLogic
 }
 
 //-----------------------------------------------------------------------------
-// Implementation of: Foroughi, P., et al. (2007) Ultrasound bone segmentation using dynamic programming. IEEE Ultrason Symp 13(4):25232526
-// (with some modifications), which extracts the bone surface probability (BSP) from an US volume.
-// By: Mikael Brudfors, March 2014
-void vtkSlicerBoneEnhancerCppLogic
-::Foroughi2007(double* inputBuffer, double* outputBuffer, double smoothingSigma, int transducerMargin, double shadowSigma, double boneThreshold, double blurredVSBLoG, double shadowVSIntensity, int nx, int ny, int nz, int firstSliceIndex, int lastSliceIndex)
+bool vtkSlicerBoneEnhancerCppLogic
+::GaussianConvolution(vtkImageData* inputImageData, vtkImageData* outputImageData, double smoothingSigma)
 {
-  int sliceSize = nx * ny;
-  int volumeSize = nx * ny * nz;
-  int nG = floor(smoothingSigma*3)*2+1;
-
-  // Allocating memory for matrices aligned on 64-byte boundary for better performance
-  double* gaussianBuffer = (double*)mkl_malloc( sliceSize * sizeof( double ), 64 );
-  double* laplacianOfGaussianBuffer = (double*)mkl_malloc( sliceSize * sizeof( double ), 64 );
-  double* gaussianBufferTemp = (double*)mkl_malloc( (nx + nG - 1) * (ny  + nG - 1) * sizeof( double ), 64 );
-  double* laplacianOfGaussianBufferTemp = (double*)mkl_malloc( (nx + 2) * (ny  + 2) * sizeof( double ), 64 );
-  double* reflectionNumberBuffer = (double*)mkl_malloc(sliceSize * sizeof( double ), 64 );
-  double* shadowValueBuffer = (double*)mkl_malloc( sliceSize * sizeof( double ), 64 );
-  double* shadowModel = (double*)mkl_malloc( ny * sizeof( double ), 64 );
-  double* gaussianKernel = (double*)mkl_malloc(nG * nG * sizeof( double ), 64 );
-  double* laplacianKernel = (double*)mkl_malloc(3 * 3 * sizeof( double ), 64 );
-
-  // Calculate shadow model
-  for(int i = 0; i < ny; ++i)
+  int* dims = inputImageData->GetDimensions();
+  int sliceSize = dims[0] * dims[1];
+  outputImageData->SetDimensions(dims);
+  outputImageData->AllocateScalars(inputImageData->GetScalarType(), 1);
+
+  BoneEnhancerConvolutionPlan plan;
+  plan.Prepare(dims[0], dims[1], smoothingSigma);
+  switch (inputImageData->GetScalarType())
   {
-    if (i < ny - 5) 
-    { 
-      shadowModel[i] = 1 - exp( - (i*i - 1)/(2*shadowSigma*shadowSigma)); 
+    case VTK_DOUBLE:
+    {
+      const double* inputBuffer = static_cast<double*>(inputImageData->GetScalarPointer());
+      double* outputBuffer = static_cast<double*>(outputImageData->GetScalarPointer());
+      for (int z = 0; z < dims[2]; ++z)
+      {
+        plan.Execute(&inputBuffer[z * sliceSize], &outputBuffer[z * sliceSize]);
+      }
+      break;
     }
-    else 
-    { 
-      shadowModel[i] = 0.0; 
+    case VTK_FLOAT:
+    {
+      const float* inputBuffer = static_cast<float*>(inputImageData->GetScalarPointer());
+      float* outputBuffer = static_cast<float*>(outputImageData->GetScalarPointer());
+      for (int z = 0; z < dims[2]; ++z)
+      {
+        plan.Execute(&inputBuffer[z * sliceSize], &outputBuffer[z * sliceSize]);
+      }
+      break;
     }
+    default:
+      std::cout << "Unsupported scalar type!" << std::endl;
+      return false;
   }
+  outputImageData->Modified();
+  return true;
+}
 
-  // Calculate Gaussian kernel
-  int idx = 0;
-  int intervall = (nG - 1) / 2;
-  for(double x = -intervall; x <= intervall; ++x)
+//-----------------------------------------------------------------------------
+// Calls Foroughi2007 with the output buffer cast to the output scalar type.
+template <class TInput>
+void vtkSlicerBoneEnhancerCppLogic
+::Foroughi2007Dispatch(TInput* inputBuffer, void* outputBuffer, int outputScalarType, double smoothingSigma, int transducerMargin, double shadowSigma, double boneThreshold, double blurredVSBLoG, double shadowVSIntensity, int nx, int ny, int nz, int firstSliceIndex, int lastSliceIndex)
+{
+  switch (outputScalarType)
   {
-    for(double y = -intervall; y <= intervall; ++y)
-    {
-      gaussianKernel [idx] = exp( -( (x*x)/(2*smoothingSigma*smoothingSigma) + (y*y)/(2*smoothingSigma*smoothingSigma) ) );
-      ++idx;
-    }
+    vtkTemplateMacro(this->Foroughi2007(inputBuffer, static_cast<VTK_TT*>(outputBuffer), smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, nx, ny, nz, firstSliceIndex, lastSliceIndex));
+    default:
+      std::cout << "Unsupported output scalar type!" << std::endl;
   }
+}
 
-  // Calculate Laplacian kernel
-  laplacianKernel[0] = 0;
-  laplacianKernel[1] = -1;
-  laplacianKernel[2] = 0;
-  laplacianKernel[3] = -1;
-  laplacianKernel[4] = 4;
-  laplacianKernel[5] = -1;
-  laplacianKernel[6] = 0;
-  laplacianKernel[7] = -1;
-  laplacianKernel[8] = 0;
+//-----------------------------------------------------------------------------
+// Implementation of: Foroughi, P., et al. (2007) Ultrasound bone segmentation using dynamic programming. IEEE Ultrason Symp 13(4):25232526
+// (with some modifications), which extracts the bone surface probability (BSP) from an US volume.
+// By: Mikael Brudfors, March 2014
+template <class TInput, class TOutput>
+void vtkSlicerBoneEnhancerCppLogic
+::Foroughi2007(const TInput* inputBuffer, TOutput* outputBuffer, double smoothingSigma, int transducerMargin, double shadowSigma, double boneThreshold, double blurredVSBLoG, double shadowVSIntensity, int nx, int ny, int nz, int firstSliceIndex, int lastSliceIndex)
+{
+  typedef typename BoneEnhancerRealType<TInput>::Type RealType;
+  int sliceSize = nx * ny;
+  this->UpdateShadowModel(ny, shadowSigma);
 
   if (firstSliceIndex<0 || lastSliceIndex<0 || firstSliceIndex>lastSliceIndex)
   {
@@ -207,141 +360,353 @@ void vtkSlicerBoneEnhancerCppLogic
     lastSliceIndex = nz-1;
   }
 
+  // Slices are independent, so they are distributed across the worker threads. A single slice is
+  // instead processed by one worker, which parallelizes the loops within the slice.
+  int numberOfWorkers = std::max(1, std::min(this->GetNumberOfWorkerThreads(), lastSliceIndex - firstSliceIndex + 1));
+  this->NumberOfThreadsUsed = numberOfWorkers;
+
+  // Each worker adds its stage times to its own part of WorkerStageTimes, and each slice writes its own tuple of SliceTimes
+  bool instrumentationEnabled = this->InstrumentationEnabled;
+  double* sliceTimes = NULL;
+  if (instrumentationEnabled)
+  {
+    this->WorkerStageTimes.assign(numberOfWorkers * NumberOfStages, 0.0);
+    this->SliceTimes->SetNumberOfTuples(lastSliceIndex - firstSliceIndex + 1);
+    sliceTimes = this->SliceTimes->GetPointer(0);
+  }
+
+  // Each worker owns its scratch buffers and its Gaussian convolution plan, which are kept between calls
+  // and reused as long as the slice size, the precision and sigma do not change
+  std::vector< SliceBuffers<RealType> > workerBuffers(numberOfWorkers);
+  for (int worker = 0; worker < numberOfWorkers; ++worker)
+  {
+    SliceBuffers<RealType>& buffers = workerBuffers[worker];
+    this->GetSliceBuffers(worker, nx, ny, buffers);
+    buffers.GaussianPlan->Prepare(nx, ny, smoothingSigma);
+    buffers.StageTimes = instrumentationEnabled ? &this->WorkerStageTimes[worker * NumberOfStages] : NULL;
+  }
+
   // Loop through each slice
+  int idx;
+  int numberOfSkippedSlices = 0;
+  #pragma omp parallel for schedule(dynamic) num_threads(numberOfWorkers) if(numberOfWorkers > 1) reduction(+:numberOfSkippedSlices)
   for(idx = firstSliceIndex; idx <= lastSliceIndex; ++idx)
   {
     // Index of slice in buffer
     int slice = sliceSize * idx;
+    int worker = omp_get_thread_num();
+    double sliceStartTime = instrumentationEnabled ? vtkTimerLog::GetUniversalTime() : 0.0;
+    bool processed = this->Foroughi2007Slice(&inputBuffer[slice], &outputBuffer[slice], workerBuffers[worker], transducerMargin, boneThreshold, blurredVSBLoG, shadowVSIntensity, nx, ny);
+    if (!processed)
+    {
+      ++numberOfSkippedSlices;
+    }
+    if (instrumentationEnabled)
+    {
+      double* sliceTime = &sliceTimes[5 * (idx - firstSliceIndex)];
+      sliceTime[0] = idx;
+      sliceTime[1] = sliceStartTime - this->CallStartTime;
+      sliceTime[2] = vtkTimerLog::GetUniversalTime() - sliceStartTime;
+      sliceTime[3] = worker;
+      sliceTime[4] = processed ? 0.0 : 1.0;
+    }
+  }
+  this->NumberOfSkippedSlices = numberOfSkippedSlices;
 
-    // If slice has not all zero pixels...
-    if (GetMaxPixelValue(&inputBuffer[slice], sliceSize) > 0)
+  if (instrumentationEnabled)
+  {
+    for (int worker = 0; worker < numberOfWorkers; ++worker)
     {
-      // Convolve with Gaussian kernel and normalize result between zero and one
-      this->Conv2(&inputBuffer[slice], gaussianKernel, gaussianBufferTemp, gaussianBuffer, nx, ny, nG, nG);
-      this->Normalize(gaussianBuffer, sliceSize, false);
-
-      // Convolve blurred image with Laplacian kernel
-      this->Conv2(gaussianBuffer, laplacianKernel, laplacianOfGaussianBufferTemp, laplacianOfGaussianBuffer, nx, ny, 3, 3);
-
-      // Main loop calculating reflection number and shadow value
-      double sumG=0;
-      double sumGI=0;
-      int i, pixelIdx, x, y;
-      #ifdef NDEBUG
-			#pragma omp parallel for reduction(+:sumG,sumGI), private(i, x, pixelIdx)
-      #endif		
-      for (y = 0; y < ny; ++y)
+      for (int stage = 0; stage < NumberOfStages; ++stage)
       {
-        for (x = 0; x < nx; ++x)
-        {
-          pixelIdx = x + y * nx;
-
-          // Only include pixels with intensity value larger than a specified threshold
-          if (gaussianBuffer[pixelIdx] >= boneThreshold && pixelIdx > transducerMargin * nx)
-          {
-            // Set outermost border pixels to zero and exclude negative pixels
-            if ((x==nx-1 || x==0 || y==ny-1 || y==0) || laplacianOfGaussianBuffer[pixelIdx] <= 0) 
-            { 
-              laplacianOfGaussianBuffer[pixelIdx] = 0.0;	
-            }
-            else
-            {
-              // Divide by small number to increase image intensity (What! :)
-              laplacianOfGaussianBuffer[pixelIdx] = laplacianOfGaussianBuffer[pixelIdx] / 0.005;
-            }
-
-            // Calculate reflection number
-            reflectionNumberBuffer[pixelIdx] = pow(gaussianBuffer[pixelIdx], blurredVSBLoG) + laplacianOfGaussianBuffer[pixelIdx];
-
-            // Calculate shadow value
-            sumG = 0;
-            sumGI = 0;
-            for (i = y; i < ny; ++i) 
-            {
-              sumG += shadowModel[i - y];
-              sumGI += shadowModel[i - y] * gaussianBuffer[x+i*nx];
-            }
-            shadowValueBuffer[pixelIdx] = sumGI / sumG;
-          }
-          else 
-          { 
-            reflectionNumberBuffer[pixelIdx] = 0.0;	
-            shadowValueBuffer[pixelIdx] = 0.0;	
-          }			
-        }
+        this->StageTimes[stage] += this->WorkerStageTimes[worker * NumberOfStages + stage];
       }
+    }
+  }
+}
 
-      // Normalize both reflection numbers and shadow values
-      this->Normalize(reflectionNumberBuffer, sliceSize, false);
-      this->Normalize(shadowValueBuffer, sliceSize, true);
-
-      // Calculate BSP
-      vdPowx(sliceSize, shadowValueBuffer, shadowVSIntensity, shadowValueBuffer);
-      vdMul(sliceSize, shadowValueBuffer, reflectionNumberBuffer, &outputBuffer[slice]);
+//-----------------------------------------------------------------------------
+template <class TReal>
+void vtkSlicerBoneEnhancerCppLogic
+::GetSliceBuffers(int worker, int nx, int ny, SliceBuffers<TReal>& buffers)
+{
+  while (static_cast<int>(this->GaussianPlans.size()) <= worker)
+  {
+    this->GaussianPlans.push_back(new BoneEnhancerConvolutionPlan());
+  }
+  while (static_cast<int>(this->BufferPool.size()) <= worker)
+  {
+    PooledBuffers emptyBuffers = { 0, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL };
+    this->BufferPool.push_back(emptyBuffers);
+  }
 
-      // Normalize BSP
-      this->Normalize(&outputBuffer[slice], sliceSize, false, 255);
-    }
+  PooledBuffers& pooledBuffers = this->BufferPool[worker];
+  if (pooledBuffers.Nx != nx || pooledBuffers.Ny != ny || pooledBuffers.ScalarSize != static_cast<int>(sizeof(TReal)))
+  {
+    FreePooledBuffers(pooledBuffers);
+    // Allocating memory for matrices aligned on 64-byte boundary for better performance
+    int sliceSize = nx * ny;
+    pooledBuffers.Input = mkl_malloc( sliceSize * sizeof( TReal ), 64 );
+    pooledBuffers.Gaussian = mkl_malloc( sliceSize * sizeof( TReal ), 64 );
+    pooledBuffers.LaplacianOfGaussian = mkl_malloc( sliceSize * sizeof( TReal ), 64 );
+    pooledBuffers.ReflectionNumber = mkl_malloc( sliceSize * sizeof( TReal ), 64 );
+    pooledBuffers.ShadowValue = mkl_malloc( sliceSize * sizeof( TReal ), 64 );
+    pooledBuffers.ShadowTailSum = (double*)mkl_malloc( (sliceSize + nx) * sizeof( double ), 64 );
+    pooledBuffers.Nx = nx;
+    pooledBuffers.Ny = ny;
+    pooledBuffers.ScalarSize = sizeof(TReal);
+    this->NumberOfAllocatedBytes += 5 * static_cast<vtkIdType>(sliceSize) * sizeof(TReal) + static_cast<vtkIdType>(sliceSize + nx) * sizeof(double);
   }
 
-  // Free memory
-  mkl_free(gaussianBuffer);
-  mkl_free(laplacianOfGaussianBuffer);
-  mkl_free(gaussianBufferTemp);
-  mkl_free(laplacianOfGaussianBufferTemp);
-  mkl_free(reflectionNumberBuffer);
-  mkl_free(shadowValueBuffer);
-  mkl_free(shadowModel);
-  mkl_free(gaussianKernel);
-  mkl_free(laplacianKernel);
+  buffers.Input = static_cast<TReal*>(pooledBuffers.Input);
+  buffers.Gaussian = static_cast<TReal*>(pooledBuffers.Gaussian);
+  buffers.LaplacianOfGaussian = static_cast<TReal*>(pooledBuffers.LaplacianOfGaussian);
+  buffers.ReflectionNumber = static_cast<TReal*>(pooledBuffers.ReflectionNumber);
+  buffers.ShadowValue = static_cast<TReal*>(pooledBuffers.ShadowValue);
+  buffers.ShadowTailSum = pooledBuffers.ShadowTailSum;
+  buffers.ShadowModelSum = &this->ShadowModelSum[0];
+  buffers.ShadowKernel = &this->ShadowKernel[0];
+  buffers.NumberOfShadowKernelWeights = static_cast<int>(this->ShadowKernel.size());
+  buffers.GaussianPlan = this->GaussianPlans[worker];
+}
 
-  mkl_free_buffers();
+//-----------------------------------------------------------------------------
+void vtkSlicerBoneEnhancerCppLogic
+::FreePooledBuffers(PooledBuffers& pooledBuffers)
+{
+  if (pooledBuffers.Input)
+  {
+    mkl_free(pooledBuffers.Input);
+    mkl_free(pooledBuffers.Gaussian);
+    mkl_free(pooledBuffers.LaplacianOfGaussian);
+    mkl_free(pooledBuffers.ReflectionNumber);
+    mkl_free(pooledBuffers.ShadowValue);
+    mkl_free(pooledBuffers.ShadowTailSum);
+  }
+  PooledBuffers emptyBuffers = { 0, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL };
+  pooledBuffers = emptyBuffers;
 }
 
 //-----------------------------------------------------------------------------
-// Performs a 2D convolution using Intel MKL defined by the kernel buffer.
 void vtkSlicerBoneEnhancerCppLogic
-::Conv2(const double* inputBuffer, const double* kernelBuffer, double* tempBuffer, double* outputBuffer, int nx, int ny, int kx, int ky)
+::UpdateShadowModel(int ny, double shadowSigma)
+{
+  if (ny == this->ShadowModelNy && shadowSigma == this->ShadowModelSigma)
+  {
+    return;
+  }
+
+  // Number of shadow kernel weights larger than the machine epsilon
+  int nS = std::min((int)ceil(sqrt(1 - 2*shadowSigma*shadowSigma*log(DBL_EPSILON))), ny);
+  this->ShadowModelSum.resize(ny);
+  this->ShadowKernel.resize(nS);
+
+  // Calculate shadow model, which is 1 - shadowKernel[i] for i < ny - 5 and zero otherwise, and its cumulative sum
+  for(int i = 0; i < ny; ++i)
+  {
+    double shadowModel = 0.0;
+    if (i < ny - 5) 
+    { 
+      shadowModel = 1 - exp( - (i*i - 1)/(2*shadowSigma*shadowSigma)); 
+    }
+    this->ShadowModelSum[i] = (i > 0 ? this->ShadowModelSum[i - 1] : 0.0) + shadowModel;
+  }
+  for(int i = 0; i < nS; ++i)
+  {
+    this->ShadowKernel[i] = exp( - (i*i - 1)/(2*shadowSigma*shadowSigma));
+  }
+  this->ShadowModelNy = ny;
+  this->ShadowModelSigma = shadowSigma;
+}
+
+//-----------------------------------------------------------------------------
+// Extracts the BSP from a single slice, using the scratch buffers of the calling worker thread.
+template <class TInput, class TOutput, class TReal>
+bool vtkSlicerBoneEnhancerCppLogic
+::Foroughi2007Slice(const TInput* inputBuffer, TOutput* outputBuffer, SliceBuffers<TReal>& buffers, int transducerMargin, double boneThreshold, double blurredVSBLoG, double shadowVSIntensity, int nx, int ny)
 {
-  int inputShape[] = {nx, ny};
-  int kernelShape[] = {kx, ky};
-  int resultShape[] = {nx + kx - 1, ny + ky - 1};
+  int sliceSize = nx * ny;
+  TReal* gaussianBuffer = buffers.Gaussian;
+  TReal* laplacianOfGaussianBuffer = buffers.LaplacianOfGaussian;
+  TReal* reflectionNumberBuffer = buffers.ReflectionNumber;
+  TReal* shadowValueBuffer = buffers.ShadowValue;
+  double* stageTimes = buffers.StageTimes;
+  double lastTime = stageTimes ? vtkTimerLog::GetUniversalTime() : 0.0;
+
+  // If slice has all zero pixels, there is nothing to do
+  if (GetMaxPixelValue(inputBuffer, sliceSize) <= 0)
+  {
+    BoneEnhancerStopStage(stageTimes, StageConversion, lastTime);
+    return false;
+  }
 
-  VSLConvTaskPtr task;
-  int status = vsldConvNewTask(&task,VSL_CONV_MODE_AUTO, 2,inputShape, kernelShape, resultShape);
+  // Convert the slice to the internal precision
+  for (int i = 0; i < sliceSize; ++i)
+  {
+    buffers.Input[i] = static_cast<TReal>(inputBuffer[i]);
+  }
+  BoneEnhancerStopStage(stageTimes, StageConversion, lastTime);
+
+  // Convolve with Gaussian kernel and normalize result between zero and one
+  buffers.GaussianPlan->Execute(buffers.Input, gaussianBuffer);
+  BoneEnhancerStopStage(stageTimes, StageGaussian, lastTime);
+  this->Normalize(gaussianBuffer, sliceSize, false);
+  BoneEnhancerStopStage(stageTimes, StageNormalization, lastTime);
+
+  // Convolve blurred image with Laplacian kernel
+  this->Laplacian(gaussianBuffer, laplacianOfGaussianBuffer, nx, ny);
+  BoneEnhancerStopStage(stageTimes, StageLaplacianOfGaussian, lastTime);
+
+  // Calculate shadow value of all pixels
+  this->ShadowValue(gaussianBuffer, buffers.ShadowModelSum, buffers.ShadowKernel, buffers.NumberOfShadowKernelWeights, buffers.ShadowTailSum, shadowValueBuffer, nx, ny);
+  BoneEnhancerStopStage(stageTimes, StageShadowValue, lastTime);
+
+  // Main loop calculating reflection number and masking shadow value
+  int pixelIdx, x, y;
+  #pragma omp parallel for private(x, pixelIdx) num_threads(this->GetNumberOfWorkerThreads())
+  for (y = 0; y < ny; ++y)
+  {
+    for (x = 0; x < nx; ++x)
+    {
+      pixelIdx = x + y * nx;
 
-  status = vsldConvExec(task, inputBuffer, NULL, kernelBuffer, NULL, tempBuffer, NULL);
-  vslConvDeleteTask(&task);
+      // Only include pixels with intensity value larger than a specified threshold
+      if (gaussianBuffer[pixelIdx] >= boneThreshold && pixelIdx > transducerMargin * nx)
+      {
+        // Set outermost border pixels to zero and exclude negative pixels
+        if ((x==nx-1 || x==0 || y==ny-1 || y==0) || laplacianOfGaussianBuffer[pixelIdx] <= 0) 
+        { 
+          laplacianOfGaussianBuffer[pixelIdx] = 0.0;	
+        }
+        else
+        {
+          // Divide by small number to increase image intensity (What! :)
+          laplacianOfGaussianBuffer[pixelIdx] = laplacianOfGaussianBuffer[pixelIdx] / 0.005;
+        }
 
-  this->ResizeMatrix(tempBuffer, outputBuffer, kx, ky, nx + kx - 1, ny + ky - 1);
+        // Calculate reflection number
+        reflectionNumberBuffer[pixelIdx] = pow(gaussianBuffer[pixelIdx], static_cast<TReal>(blurredVSBLoG)) + laplacianOfGaussianBuffer[pixelIdx];
+      }
+      else 
+      { 
+        reflectionNumberBuffer[pixelIdx] = 0.0;	
+        shadowValueBuffer[pixelIdx] = 0.0;	
+      }			
+    }
+  }
+  BoneEnhancerStopStage(stageTimes, StageReflectionNumber, lastTime);
+
+  // Normalize both reflection numbers and shadow values
+  this->Normalize(reflectionNumberBuffer, sliceSize, false);
+  this->Normalize(shadowValueBuffer, sliceSize, true);
+  BoneEnhancerStopStage(stageTimes, StageNormalization, lastTime);
+
+  // Calculate BSP, reusing the Gaussian buffer
+  BoneEnhancerPowx(sliceSize, shadowValueBuffer, static_cast<TReal>(shadowVSIntensity), shadowValueBuffer);
+  BoneEnhancerMul(sliceSize, shadowValueBuffer, reflectionNumberBuffer, gaussianBuffer);
+  BoneEnhancerStopStage(stageTimes, StageBoneSurfaceProbability, lastTime);
+
+  // Normalize BSP and convert it to the output scalar type
+  this->Normalize(gaussianBuffer, sliceSize, false, 255);
+  BoneEnhancerStopStage(stageTimes, StageNormalization, lastTime);
+  for (int i = 0; i < sliceSize; ++i)
+  {
+    outputBuffer[i] = BoneEnhancerConvertOutput<TOutput>(gaussianBuffer[i]);
+  }
+  BoneEnhancerStopStage(stageTimes, StageConversion, lastTime);
+  return true;
 }
 
 //-----------------------------------------------------------------------------
+// Returns the number of threads to use, which is the OpenMP default unless set by SetNumberOfThreads.
+int vtkSlicerBoneEnhancerCppLogic
+::GetNumberOfWorkerThreads()
+{
+  if (this->NumberOfThreads > 0)
+  {
+    return this->NumberOfThreads;
+  }
+  return omp_get_max_threads();
+}
+
+//-----------------------------------------------------------------------------
+// Calculates the shadow value, sum(shadowModel[i-y] * gaussian[x,i]) / sum(shadowModel[i-y]) for i = y..ny-1,
+// of all pixels in O(ny * nS) per column instead of O(ny^2). As shadowModel[i] = 1 - shadowKernel[i] for
+// i < ny - 5 (and zero otherwise), the weighted tail sum is a plain tail sum, computed recursively from the
+// bottom of the image, minus a correlation with the shadow kernel, which vanishes after nS rows.
+// The tail sums are accumulated in double precision.
+template <class T>
 void vtkSlicerBoneEnhancerCppLogic
-::ResizeMatrix(const double* inputBuffer, double* outputBuffer, int xClipping, int yClipping, int xInputSize, int yInputSize)
+::ShadowValue(const T* gaussianBuffer, const double* shadowModelSum, const double* shadowKernel, int nS, double* tailSumBuffer, T* shadowValueBuffer, int nx, int ny)
 {
-  int xStart = (xClipping + 2 - 1) / 2 - 1;
-  int yStart = (yClipping + 2 - 1) / 2 - 1;
-  int xStop = xInputSize - xStart;
-  int yStop = yInputSize - yStart;		
+  // Tail sums of each column, the row below the image is zero
+  int x, y, k;
+  for (x = 0; x < nx; ++x)
+  {
+    tailSumBuffer[x + ny * nx] = 0.0;
+  }
+  for (y = ny - 1; y >= 0; --y)
+  {
+    for (x = 0; x < nx; ++x)
+    {
+      tailSumBuffer[x + y * nx] = tailSumBuffer[x + (y + 1) * nx] + gaussianBuffer[x + y * nx];
+    }
+  }
 
-  int idx = 0;
-  for (int y = 0; y < yInputSize; ++y)
+  #pragma omp parallel for private(x, k) num_threads(this->GetNumberOfWorkerThreads())
+  for (y = 0; y < ny; ++y)
   {
-    for (int x = 0; x < xInputSize; ++x)
+    // Index of the last row below y with a non-zero shadow model weight
+    int lastRow = std::max(y + std::min(ny - 1 - y, ny - 6), y - 1);
+    T* shadowValueRow = &shadowValueBuffer[y * nx];
+    for (x = 0; x < nx; ++x)
+    {
+      shadowValueRow[x] = static_cast<T>(tailSumBuffer[x + y * nx] - tailSumBuffer[x + (lastRow + 1) * nx]);
+    }
+    for (k = 0; k < nS && y + k <= lastRow; ++k)
     {
-      if (x >= xStart && x < xStop && y >= yStart && y < yStop)
+      const T* gaussianRow = &gaussianBuffer[(y + k) * nx];
+      T weight = static_cast<T>(shadowKernel[k]);
+      for (x = 0; x < nx; ++x)
       {
-        outputBuffer[idx] = inputBuffer[x + y * xInputSize];
-        ++idx;
+        shadowValueRow[x] -= weight * gaussianRow[x];
       }
     }
+    T modelSum = static_cast<T>(shadowModelSum[ny - 1 - y]);
+    for (x = 0; x < nx; ++x)
+    {
+      shadowValueRow[x] /= modelSum;
+    }
+  }
+}
+
+//-----------------------------------------------------------------------------
+// Convolves an image with the 3x3 Laplacian kernel [0 -1 0; -1 4 -1; 0 -1 0], pixels outside the image are zero.
+template <class T>
+void vtkSlicerBoneEnhancerCppLogic
+::Laplacian(const T* inputBuffer, T* outputBuffer, int nx, int ny)
+{
+  int x, y;
+  #pragma omp parallel for private(x) num_threads(this->GetNumberOfWorkerThreads())
+  for (y = 0; y < ny; ++y)
+  {
+    for (x = 0; x < nx; ++x)
+    {
+      int pixelIdx = x + y * nx;
+      T value = 4 * inputBuffer[pixelIdx];
+      if (x > 0) { value -= inputBuffer[pixelIdx - 1]; }
+      if (x < nx - 1) { value -= inputBuffer[pixelIdx + 1]; }
+      if (y > 0) { value -= inputBuffer[pixelIdx - nx]; }
+      if (y < ny - 1) { value -= inputBuffer[pixelIdx + nx]; }
+      outputBuffer[pixelIdx] = value;
+    }
   }
 }
 
 //-----------------------------------------------------------------------------
+template <class T>
 double vtkSlicerBoneEnhancerCppLogic
-::GetMaxPixelValue(const double* buffer, int size)
+::GetMaxPixelValue(const T* buffer, int size)
 {
   double maxPixelValue = 0;
   for(int i = 0; i < size; ++i)
@@ -355,8 +720,9 @@ double vtkSlicerBoneEnhancerCppLogic
 }
 
 //-----------------------------------------------------------------------------
+template <class T>
 void vtkSlicerBoneEnhancerCppLogic
-::Normalize(double* buffer, int size, bool doInverse, double maxValue /*=1.0*/)
+::Normalize(T* buffer, int size, bool doInverse, double maxValue /*=1.0*/)
 {
   double maxPixelValue = GetMaxPixelValue(buffer, size);
 
@@ -379,7 +745,7 @@ void vtkSlicerBoneEnhancerCppLogic
     return;
   }
 
-  double scaleFactor = maxValue / GetMaxPixelValue(buffer, size);
+  T scaleFactor = maxValue / maxPixelValue;
   if (!doInverse)
   {
     for (int i = 0; i < size; ++i)
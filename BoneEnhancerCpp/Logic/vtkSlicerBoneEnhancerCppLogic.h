@@ -31,11 +31,14 @@ limitations under the License.
 
 // STD includes
 #include <cstdlib>
+#include <vector>
 
 #include "vtkSlicerBoneEnhancerCppModuleLogicExport.h"
 
 class vtkMRMLScalarVolumeNode;
 class vtkDoubleArray;
+class vtkImageData;
+class BoneEnhancerConvolutionPlan;
 
 /// \ingroup Slicer_QtModules_ExtensionTemplate
 class VTK_SLICER_BONEENHANCERCPP_MODULE_LOGIC_EXPORT vtkSlicerBoneEnhancerCppLogic :
@@ -46,9 +49,60 @@ public:
   vtkTypeMacro(vtkSlicerBoneEnhancerCppLogic, vtkSlicerModuleLogic);
   void PrintSelf(ostream& os, vtkIndent indent);
 
-  /*! Image processing connector method. */
+  /*! Image processing connector method. Returns the runtime in seconds, or -1 if the algorithm is unknown. */
   float ImageProcessingConnector(vtkMRMLScalarVolumeNode* inputVolumeNode, vtkMRMLScalarVolumeNode* outputVolumeNode, vtkDoubleArray* params, std::string algorithmName, int firstSliceIndex, int lastSliceIndex);
 
+  /*! Convolves each slice of a double or float image with the Gaussian kernel of Foroughi2007 through a BoneEnhancerConvolutionPlan,
+      pixels outside the slice are zero. The output is allocated with the dimensions and scalar type of the input. Returns false if
+      the scalar type is not supported. Used to test the plan against the NumPy engine (Foroughi2007.convolveSeparable). */
+  bool GaussianConvolution(vtkImageData* inputImageData, vtkImageData* outputImageData, double smoothingSigma);
+
+  /*! Number of threads used for processing, slices are distributed across them. Zero (default) uses the OpenMP default. */
+  vtkSetMacro(NumberOfThreads, int);
+  vtkGetMacro(NumberOfThreads, int);
+
+  /*! Releases the scratch buffers, convolution plans and kernels which are kept between calls for the last slice size and
+      parameters. They are allocated again by the next call. Called automatically when the scene is closed. */
+  void ReleaseBuffers();
+
+  /*! Stages of Foroughi2007 which are timed separately when instrumentation is enabled. */
+  enum Stage
+  {
+    StageConversion = 0,
+    StageGaussian,
+    StageLaplacianOfGaussian,
+    StageReflectionNumber,
+    StageShadowValue,
+    StageNormalization,
+    StageBoneSurfaceProbability,
+    NumberOfStages
+  };
+
+  /*! Returns the name of a stage, the same as in the NumPy engine (Foroughi2007.STAGE_NAMES). */
+  static const char* GetStageName(int stage);
+
+  /*! Collecting the per-stage and per-slice times of each call, off by default. When off, the instrumentation
+      only costs a branch per stage, and only the number of skipped slices, the allocated bytes and the threads are reported. */
+  vtkSetMacro(InstrumentationEnabled, bool);
+  vtkGetMacro(InstrumentationEnabled, bool);
+  vtkBooleanMacro(InstrumentationEnabled, bool);
+
+  /*! Wall time of a stage in the last call, in seconds, summed over the slices (and thus over the threads). */
+  double GetStageTime(int stage);
+
+  /*! Times of the slices processed by the last call, one tuple per slice of (slice index, start time relative to the
+      start of the call, duration, worker thread, 1 if skipped as all-zero) with times in seconds. Empty if instrumentation is off. */
+  vtkDoubleArray* GetSliceTimes();
+
+  /*! Number of slices the last call skipped, because all their pixels are zero. */
+  vtkGetMacro(NumberOfSkippedSlices, int);
+
+  /*! Bytes of scratch memory the last call allocated, zero if the pooled buffers were reused. */
+  vtkGetMacro(NumberOfAllocatedBytes, vtkIdType);
+
+  /*! Number of worker threads the last call distributed the slices across. */
+  vtkGetMacro(NumberOfThreadsUsed, int);
+
 protected:
   vtkSlicerBoneEnhancerCppLogic();
   virtual ~vtkSlicerBoneEnhancerCppLogic();
@@ -59,25 +113,107 @@ protected:
   virtual void UpdateFromMRMLScene();
   virtual void OnMRMLSceneNodeAdded(vtkMRMLNode* node);
   virtual void OnMRMLSceneNodeRemoved(vtkMRMLNode* node);
+  virtual void OnMRMLSceneEndClose();
   
 private:
   vtkSlicerBoneEnhancerCppLogic(const vtkSlicerBoneEnhancerCppLogic&); // Not implemented
   void operator=(const vtkSlicerBoneEnhancerCppLogic&); // Not implemented
 
-  /*! 2D convolution using Intel MKL. */
-  void Conv2(const double* inputBuffer, const double* kernelBuffer, double* tempBuffer, double* outputBuffer, int nx, int ny, int kx, int ky);
-
-  /*! Performs cropping of a 2D matrix stored in a buffer. */
-  void ResizeMatrix(const double* inputBuffer, double* outputBuffer, int xClipping, int yClipping, int xInputSize, int yInputSize);
+  /*! Scratch buffers owned by a worker thread, in the internal precision TReal, and the data it shares with the other workers. */
+  template <class TReal>
+  struct SliceBuffers
+  {
+    TReal* Input;
+    TReal* Gaussian;
+    TReal* LaplacianOfGaussian;
+    TReal* ReflectionNumber;
+    TReal* ShadowValue;
+    double* ShadowTailSum;
+    const double* ShadowModelSum;
+    const double* ShadowKernel;
+    int NumberOfShadowKernelWeights;
+    BoneEnhancerConvolutionPlan* GaussianPlan;
+    double* StageTimes;
+  };
+
+  /*! Scratch memory of a worker thread, kept between calls and only reallocated when the slice size or the precision changes. */
+  struct PooledBuffers
+  {
+    int Nx;
+    int Ny;
+    int ScalarSize;
+    void* Input;
+    void* Gaussian;
+    void* LaplacianOfGaussian;
+    void* ReflectionNumber;
+    void* ShadowValue;
+    double* ShadowTailSum;
+  };
+
+  /*! Points the scratch buffers of a worker thread to its pooled memory, which is allocated if it does not fit nx*ny slices in precision TReal. */
+  template <class TReal>
+  void GetSliceBuffers(int worker, int nx, int ny, SliceBuffers<TReal>& buffers);
+
+  /*! Frees the memory of pooled buffers. */
+  static void FreePooledBuffers(PooledBuffers& pooledBuffers);
+
+  /*! Recalculates the shadow model sum and the shadow kernel, only if ny or shadowSigma changed since the last call. */
+  void UpdateShadowModel(int ny, double shadowSigma);
+
+  /*! Returns the number of threads to use for processing. */
+  int GetNumberOfWorkerThreads();
+
+  /*! Convolution of an image stored in a buffer with the 3x3 Laplacian kernel. */
+  template <class T>
+  void Laplacian(const T* inputBuffer, T* outputBuffer, int nx, int ny);
+
+  /*! Calculates the shadow value of all pixels in a slice in linear time per column. */
+  template <class T>
+  void ShadowValue(const T* gaussianBuffer, const double* shadowModelSum, const double* shadowKernel, int nS, double* tailSumBuffer, T* shadowValueBuffer, int nx, int ny);
 
   /*! Returns the maximum value of an image stored in a buffer. */
-  double GetMaxPixelValue(const double* buffer, int size);
+  template <class T>
+  double GetMaxPixelValue(const T* buffer, int size);
 
   /*! Normalizes an image stored in a buffer. */
-  void Normalize(double* buffer, int size, bool doInverse, double maxValue=1.0);
-
-  /*! Extracts the bone surface probability from an US volume. */
-  void Foroughi2007(double* inputBuffer, double* outputBuffer, double smoothingSigma, int transducerMargin, double shadowSigma, double boneThreshold, double blurredVSBLoG, double shadowVSIntensity, int nx, int ny, int nz, int firstSliceIndex, int lastSliceIndex);
+  template <class T>
+  void Normalize(T* buffer, int size, bool doInverse, double maxValue=1.0);
+
+  /*! Selects the output scalar type of Foroughi2007. */
+  template <class TInput>
+  void Foroughi2007Dispatch(TInput* inputBuffer, void* outputBuffer, int outputScalarType, double smoothingSigma, int transducerMargin, double shadowSigma, double boneThreshold, double blurredVSBLoG, double shadowVSIntensity, int nx, int ny, int nz, int firstSliceIndex, int lastSliceIndex);
+
+  /*! Extracts the bone surface probability from an US volume. Computations are done in double precision for double input, and in single precision otherwise. */
+  template <class TInput, class TOutput>
+  void Foroughi2007(const TInput* inputBuffer, TOutput* outputBuffer, double smoothingSigma, int transducerMargin, double shadowSigma, double boneThreshold, double blurredVSBLoG, double shadowVSIntensity, int nx, int ny, int nz, int firstSliceIndex, int lastSliceIndex);
+
+  /*! Extracts the bone surface probability from a single US slice. Returns false if the slice is skipped because all its pixels are zero. */
+  template <class TInput, class TOutput, class TReal>
+  bool Foroughi2007Slice(const TInput* inputBuffer, TOutput* outputBuffer, SliceBuffers<TReal>& buffers, int transducerMargin, double boneThreshold, double blurredVSBLoG, double shadowVSIntensity, int nx, int ny);
+
+  /*! Separable Gaussian convolutions of the worker threads, reused across slices and calls. */
+  std::vector<BoneEnhancerConvolutionPlan*> GaussianPlans;
+
+  /*! Scratch buffers of the worker threads, reused across slices and calls. */
+  std::vector<PooledBuffers> BufferPool;
+
+  /*! Cumulative sum of the shadow model and the shadow kernel, for ShadowModelNy rows and ShadowModelSigma. */
+  std::vector<double> ShadowModelSum;
+  std::vector<double> ShadowKernel;
+  int ShadowModelNy;
+  double ShadowModelSigma;
+
+  int NumberOfThreads;
+
+  /*! Instrumentation of the last call. WorkerStageTimes holds NumberOfStages times per worker thread, which are summed into StageTimes. */
+  bool InstrumentationEnabled;
+  double StageTimes[NumberOfStages];
+  std::vector<double> WorkerStageTimes;
+  vtkDoubleArray* SliceTimes;
+  double CallStartTime;
+  int NumberOfSkippedSlices;
+  vtkIdType NumberOfAllocatedBytes;
+  int NumberOfThreadsUsed;
 };
 
 #endif
@@ -1,9 +1,32 @@
 import os
+import multiprocessing
+import threading
+import time
+import timeit
 import unittest
+import collections
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+import numpy
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 from vtk.util import numpy_support
+from BoneEnhancerPyLib import Foroughi2007
+from BoneEnhancerPyLib import SyntheticData
+from BoneEnhancerPyLib import SurfaceExtraction
+from BoneEnhancerPyLib import Benchmark
+from BoneEnhancerPyLib import Instrumentation
+from BoneEnhancerPyLib import ImageIO
+from BoneEnhancerPyLib import BatchProcessing
+from BoneEnhancerPyLib import OutOfCore
+from BoneEnhancerPyLib import Incremental
+from BoneEnhancerPyLib import FastShadow
+from BoneEnhancerPyLib import CoarseToFine
+from BoneEnhancerPyLib import RegionOfInterest
+from BoneEnhancerPyLib import Algorithms
 
 class BoneEnhancerPy(ScriptedLoadableModule):
 
@@ -33,36 +56,24 @@ class BoneEnhancerPyWidget(ScriptedLoadableModuleWidget):
 
     ScriptedLoadableModuleWidget.setup(self)
     
-    # Add default algorithm parameters to Slicer.ini
     self.settings = slicer.app.userSettings() 
-    self.settings.beginGroup(self.moduleName + '/Foroughi2007')
-    if not self.settings.allKeys(): # If no keys     
-      self.settings.setValue('SmoothingSigma', 5.0)
-      self.settings.setValue('TransducerMargin', 60)
-      self.settings.setValue('ShadowSigma', 6.0)
-      self.settings.setValue('BoneThreshold', 0.4)
-      self.settings.setValue('BlurredVsBLoG', 3)
-      self.settings.setValue('ShadowVsIntensity', 5)      
-    smoothingSigma = float(self.settings.value('SmoothingSigma'))
-    transducerMargin = float(self.settings.value('TransducerMargin'))
-    shadowSigma = float(self.settings.value('ShadowSigma'))
-    boneThreshold = float(self.settings.value('BoneThreshold'))
-    blurredVsBLoG = float(self.settings.value('BlurredVsBLoG'))
-    shadowVsIntensity = float(self.settings.value('ShadowVsIntensity'))
-    self.settings.endGroup()
     
     ############################################################# Define algorithms    
-    self.foroughi2007 = AlgorithmParams("Foroughi2007 (with minor modifications)",
-          {"Smoothing Sigma" : (1, 1, 1, 10, smoothingSigma, "Smoothing Sigma ToolTip"),
-           "Transducer Margin" : (0, 1, 0, 300, transducerMargin, "Transducer Margin ToolTip"),
-           "Shadow Sigma" : (1, 1, 1, 10, shadowSigma, "Shadow Sigma ToolTip"),
-           "Bone Threshold" : (1, 0.1, 0, 1, boneThreshold, "Bone Threshold ToolTip"),
-           "Blurred vs. BLoG" : (1, 0.1, 0, 10, blurredVsBLoG, "Blurred vs. BLoG ToolTip"),
-           "Shadow vs. Intensity" : (1, 0.1, 0, 10, shadowVsIntensity, "Shadow vs. Intensity ToolTip")})            
-    self.algorithms = [self.foroughi2007]
+    # The sliders of each registered algorithm (see BoneEnhancerPyLib/Algorithms.py), set to the values in Slicer.ini
+    self.algorithms = []
+    for algorithm in Algorithms.getAlgorithms():
+      self.settings.beginGroup(self.moduleName + '/' + algorithm.name)
+      values = dict((parameter.name, self.settings.value(parameter.name, parameter.default)) for parameter in algorithm.parameterDeclarations)
+      self.settings.endGroup()
+      self.algorithms.append(AlgorithmParams.fromAlgorithm(algorithm, values))
+    self.foroughi2007 = self.algorithms[0]
     
-    # Set default algorithm
+    # Set default algorithm, the one selected last
     self.defaultAlgorithm = self.foroughi2007
+    selectedAlgorithmName = self.settings.value(self.moduleName + '/Algorithm', self.foroughi2007.algorithm.name)
+    for algorithm in self.algorithms:
+      if algorithm.algorithm.name == selectedAlgorithmName:
+        self.defaultAlgorithm = algorithm
     
     ############################################################ BoneEnhancer
     boneEnhancerCollapsibleButton = ctk.ctkCollapsibleButton()
@@ -82,6 +93,25 @@ class BoneEnhancerPyWidget(ScriptedLoadableModuleWidget):
     self.ultrasoundImageSelector.setToolTip( "Pick the input to the algorithm." )
     boneEnhancerFormLayout.addRow("Ultrasound Image: ", self.ultrasoundImageSelector)
 
+    # The input is processed in its own scalar type, the output type is chosen here
+    self.outputTypeSelector = qt.QComboBox()
+    for outputTypeName, outputType in [("double", vtk.VTK_DOUBLE), ("float", vtk.VTK_FLOAT), ("unsigned short", vtk.VTK_UNSIGNED_SHORT), ("unsigned char", vtk.VTK_UNSIGNED_CHAR)]:
+      self.outputTypeSelector.addItem(outputTypeName, outputType)
+    self.outputTypeSelector.setCurrentIndex(max(self.outputTypeSelector.findText(self.settings.value(self.moduleName + '/OutputScalarType', 'double')), 0))
+    self.outputTypeSelector.setToolTip( "Scalar type of the bone enhanced image. The BSP is between 0 and 255, so unsigned char uses the least memory." )
+    boneEnhancerFormLayout.addRow("Output Type: ", self.outputTypeSelector)
+
+    self.roiSelector = slicer.qMRMLNodeComboBox()
+    self.roiSelector.nodeTypes = ["vtkMRMLMarkupsROINode", "vtkMRMLAnnotationROINode"]
+    self.roiSelector.selectNodeUponCreation = True
+    self.roiSelector.addEnabled = True
+    self.roiSelector.removeEnabled = True
+    self.roiSelector.noneEnabled = True
+    self.roiSelector.showHidden = False
+    self.roiSelector.setMRMLScene( slicer.mrmlScene )
+    self.roiSelector.setToolTip( "If set, Apply only processes the voxels inside the ROI, and the output is zero outside it." )
+    boneEnhancerFormLayout.addRow("Region of Interest: ", self.roiSelector)
+
     # Select algorithm
     self.algorithmGroupBox = ctk.ctkCollapsibleGroupBox()
     self.algorithmGroupBox.setTitle("Select Algorithm")
@@ -101,6 +131,13 @@ class BoneEnhancerPyWidget(ScriptedLoadableModuleWidget):
     for algorithm in self.algorithms:     
       self.parametersFormLayout.addWidget(algorithm.getSliderWidget())
       algorithm.paramChangedCallback = self.onParameterChanged
+
+    # Slider changes are previewed on the Red slice once the user pauses, and written to the settings once the user stops
+    self.preview = PreviewPipeline(self.logic)
+    self.settingsTimer = qt.QTimer()
+    self.settingsTimer.setSingleShot(True)
+    self.settingsTimer.setInterval(1000)
+    self.settingsTimer.connect('timeout()', self.writeParamsToSettings)
                   
     # Runtime
     self.runtimeGroupBox = ctk.ctkCollapsibleGroupBox()
@@ -123,22 +160,45 @@ class BoneEnhancerPyWidget(ScriptedLoadableModuleWidget):
                                            qproperty-alignment: AlignCenter}")
     runtimeFormLayout.addRow(self.runtimeLabel)
     
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.setFormat("%v / %m slices")
+    self.progressBar.hide()
+    runtimeFormLayout.addRow(self.progressBar)
+    
     self.applyButton = qt.QPushButton("Apply")
-    self.applyButton.toolTip = "Run the algorithm."
+    self.applyButton.toolTip = "Run the algorithm in the background. Click again to cancel."
     self.applyButton.enabled = False
     self.applyButton.checkable = True
     boneEnhancerFormLayout.addRow(self.applyButton)
+
+    self.extractSurfaceCheckBox = qt.QCheckBox("Extract bone surface")
+    self.extractSurfaceCheckBox.toolTip = "After Apply, extract the bone surface of every slice from the BSP by dynamic programming, into the 'BoneSurface' label volume."
+    boneEnhancerFormLayout.addRow(self.extractSurfaceCheckBox)
+
+    self.streamingButton = qt.QPushButton("Start Streaming")
+    self.streamingButton.toolTip = "Enhance the newest frame whenever the input is updated, e.g. by a live US source. Frames are dropped if processing is slower than the frame rate."
+    self.streamingButton.enabled = False
+    self.streamingButton.checkable = True
+    boneEnhancerFormLayout.addRow(self.streamingButton)
        
     ############################################################ Connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.streamingButton.connect('clicked(bool)', self.onStreamingButton)
     self.ultrasoundImageSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.outputTypeSelector.connect("currentIndexChanged(int)", self.onOutputTypeChanged)
     
     self.layout.addStretch(1)    
     self.defaultAlgorithm.GetRadioButton().checked = True
     self.onSelect()
   
   def cleanup(self):
-    pass
+    self.logic.cancelProcessing()
+    self.logic.stopStreaming()
+    self.logic.releaseBuffers()
+    self.preview.cancel()
+    if self.settingsTimer.isActive():
+      self.settingsTimer.stop()
+      self.writeParamsToSettings()
     
   def getCheckedAlgorithm(self):
     for algorithm in self.algorithms:     
@@ -149,92 +209,596 @@ class BoneEnhancerPyWidget(ScriptedLoadableModuleWidget):
     for algorithm in self.algorithms:     
       if algorithm.GetRadioButton().checked:
         algorithm.getSliderWidget().show()               
+        if algorithm.algorithm:
+          self.settings.setValue(self.moduleName + '/Algorithm', algorithm.algorithm.name)
       else:      
         algorithm.getSliderWidget().hide()
         
   def onSelect(self):
+    self.preview.clear()
+    if self.logic.isStreaming():
+      self.streamingButton.checked = False
+      self.onStreamingButton()
     self.applyButton.enabled = self.ultrasoundImageSelector.currentNode() and (self.getCheckedAlgorithm().getName() != 'Example Algorithm')
+    self.streamingButton.enabled = self.applyButton.enabled
+    
+  def onOutputTypeChanged(self):
+    self.settings.setValue(self.moduleName + '/OutputScalarType', self.outputTypeSelector.currentText)
+
+  def getOutputScalarType(self):
+    return self.outputTypeSelector.itemData(self.outputTypeSelector.currentIndex)
+
+  # Returns the output volume of the input (see BoneEnhancerPyLogic.getOutputVolume), which is created, or reallocated if its scalar type
+  # or dimensions do not match
+  def getBoneEnhancedImage(self):
+    if self.logic.isProcessing():
+      return self.logic.backgroundProcessing.boneEnhancedImage
+    if self.logic.isStreaming():
+      return self.logic.streamingProcessing.boneEnhancedImage
+    return self.logic.getOutputVolume(self.ultrasoundImageSelector.currentNode(), self.getOutputScalarType())
     
   def onApplyButton(self):
-    boneEnhancedImage = slicer.util.getNode('BoneEnhancedImage')    
-    if not boneEnhancedImage:
-      boneEnhancedImage = self.logic.createVolumeNode(self.ultrasoundImageSelector.currentNode(), 'BoneEnhancedImage')  
-      
-    if self.ultrasoundImageSelector.currentNode().GetImageData().GetScalarType() is not vtk.VTK_DOUBLE:
-      logging.info('Input image scalar type not double! Casting to double.')
-      self.logic.castVolumeNodeToDouble(self.ultrasoundImageSelector.currentNode())   
+    # Unchecking the button while processing cancels it
+    if not self.applyButton.checked:
+      self.logic.cancelProcessing()
+      return
       
-    self.logic.calculateBoneEnhancedImage(self.ultrasoundImageSelector.currentNode(), boneEnhancedImage, self.getCheckedAlgorithm().GetParamsVTK(), self.getCheckedAlgorithm().getName(), self.runtimeLabel, self.applyButton)
+    boneEnhancedImage = self.getBoneEnhancedImage()
+    self.logic.updateSliceViews(boneEnhancedImage, self.ultrasoundImageSelector.currentNode())
+    # The region of interest is small compared to the volume, it is processed at once
+    if self.roiSelector.currentNode():
+      self.logic.calculateBoneEnhancedImageROI(self.ultrasoundImageSelector.currentNode(), boneEnhancedImage, self.getCheckedAlgorithm().GetParameters(),
+                                               self.getCheckedAlgorithm().getName(), self.roiSelector.currentNode(), self.runtimeLabel)
+      self.applyButton.checked = False
+      return
+    self.applyButton.text = "Cancel"
+    self.streamingButton.enabled = False
+    self.progressBar.show()
+    # Only the slices whose input or parameters changed since they were computed are processed
+    self.logic.calculateBoneEnhancedImageAsync(self.ultrasoundImageSelector.currentNode(), boneEnhancedImage, self.getCheckedAlgorithm().GetParameters(), self.getCheckedAlgorithm().getName(),
+                                               self.onProcessingProgress, self.onProcessingFinished, incremental=True)
+    
+  def onStreamingButton(self):
+    if not self.streamingButton.checked:
+      self.logic.stopStreaming()
+      self.streamingButton.text = "Start Streaming"
+      self.applyButton.enabled = self.ultrasoundImageSelector.currentNode() is not None
+      return
 
+    self.logic.cancelProcessing()
+    self.preview.cancel()
+    boneEnhancedImage = self.getBoneEnhancedImage()
     self.logic.updateSliceViews(boneEnhancedImage, self.ultrasoundImageSelector.currentNode())
+    self.streamingButton.text = "Stop Streaming"
+    self.applyButton.enabled = False
+    self.logic.startStreaming(self.ultrasoundImageSelector.currentNode(), boneEnhancedImage, self.getCheckedAlgorithm().GetParameters(), self.getCheckedAlgorithm().getName(), self.onStreamingStatistics)
+
+  def onStreamingStatistics(self, framesPerSecond, latency, numberOfDroppedFrames):
+    self.runtimeLabel.setText('%.1f fps, %.0f ms latency, %d dropped' % (framesPerSecond, 1000 * latency, numberOfDroppedFrames))
+
+  def onProcessingProgress(self, numberOfProcessedSlices, numberOfSlices, runtime):
+    self.progressBar.maximum = numberOfSlices
+    self.progressBar.value = numberOfProcessedSlices
+    self.runtimeLabel.setText(str(round(runtime, 3)) + ' s.')
+    
+  def onProcessingFinished(self, completed, runtime):
+    self.applyButton.checked = False
+    self.applyButton.text = "Apply"
+    self.streamingButton.enabled = self.ultrasoundImageSelector.currentNode() is not None
+    self.progressBar.hide()
+    message = str(round(runtime, 3)) + ' s.'
+    self.runtimeLabel.setText(message if completed else 'Cancelled after ' + message)
+    instrumentation = self.logic.backgroundProcessing.instrumentation
+    self.runtimeLabel.toolTip = instrumentation.summary() if instrumentation else ''
+    if completed and self.extractSurfaceCheckBox.checked:
+      inputVolumeNode = self.logic.backgroundProcessing.inputVolumeNode
+      boneEnhancedImage = self.logic.backgroundProcessing.boneEnhancedImage
+      surface, labelVolumeNode = self.logic.extractBoneSurface(boneEnhancedImage, self.logic.getSurfaceVolume(inputVolumeNode))
+      self.logic.updateSliceViews(boneEnhancedImage, inputVolumeNode, labelVolumeNode)
+      logging.info('Bone surface found in %d of %d columns' % ((surface >= 0).sum(), surface.size))
     
   def onParameterChanged(self):    
-    self.writeParamsToSettings()
+    self.settingsTimer.start()
     
     if self.ultrasoundImageSelector.currentNode():
-      boneEnhancedImage = slicer.util.getNode('BoneEnhancedImage')
-      if not boneEnhancedImage:
-        boneEnhancedImage = self.logic.createVolumeNode(self.ultrasoundImageSelector.currentNode(), 'BoneEnhancedImage')
+      # The next streamed frame is processed with the new parameters
+      if self.logic.isStreaming():
+        self.logic.streamingProcessing.setParameters(self.getCheckedAlgorithm().GetParameters())
+        return
 
-      if self.ultrasoundImageSelector.currentNode().GetImageData().GetScalarType() is not vtk.VTK_DOUBLE:
-        logging.info('Input image scalar type not double! Casting to double.')
-        self.logic.castVolumeNodeToDouble(self.ultrasoundImageSelector.currentNode())
+      # The background processing is writing the same output volume
+      if self.logic.isProcessing():
+        return
+
+      boneEnhancedImage = self.getBoneEnhancedImage()
 
       sliceWidget = slicer.app.layoutManager().sliceWidget('Red')
       sliceLogic = sliceWidget.sliceLogic()
       redSliceIndex = int(sliceWidget.sliceLogic().GetSliceOffset())
 
-      self.logic.calculateBoneEnhancedImage(self.ultrasoundImageSelector.currentNode(), boneEnhancedImage, self.getCheckedAlgorithm().GetParamsVTK(), self.getCheckedAlgorithm().getName(), None, None, redSliceIndex, redSliceIndex)
+      self.preview.request(self.ultrasoundImageSelector.currentNode(), boneEnhancedImage, self.getCheckedAlgorithm().GetParameters(), self.getCheckedAlgorithm().getName(), redSliceIndex)
   
   def writeParamsToSettings(self):
-    algorithmName = self.getCheckedAlgorithm().getName().split(' ', 1)[0]
-    if algorithmName == 'Foroughi2007':
-      params = self.getCheckedAlgorithm().GetParamsVTK()
-      blurredVSBLoG = params.GetValue(0);
-      boneThreshold = params.GetValue(1);
-      shadowSigma = params.GetValue(2);
-      shadowVSIntensity = params.GetValue(3);
-      smoothingSigma = params.GetValue(4);
-      transducerMargin = params.GetValue(5);	    
-      self.settings.beginGroup(self.moduleName + '/' + algorithmName) 
-      self.settings.setValue('BlurredVsBLoG', blurredVSBLoG)
-      self.settings.setValue('BoneThreshold', boneThreshold)
-      self.settings.setValue('ShadowSigma', shadowSigma)
-      self.settings.setValue('ShadowVsIntensity', shadowVSIntensity)             
-      self.settings.setValue('SmoothingSigma', smoothingSigma)
-      self.settings.setValue('TransducerMargin', transducerMargin)   
-      self.settings.endGroup()
+    algorithm = self.getCheckedAlgorithm()
+    if algorithm.algorithm is None:
+      return
+    self.settings.beginGroup(self.moduleName + '/' + algorithm.algorithm.name)
+    for name, value in algorithm.GetParameters().items():
+      self.settings.setValue(name, value)
+    self.settings.endGroup()
       
 ############################################################ BoneEnhancerPyLogic
 class BoneEnhancerPyLogic(ScriptedLoadableModuleLogic):
 
+  # Roles of the node references from an input volume to its output volume and to the label volume of its bone surface
+  OUTPUT_REFERENCE_ROLE = 'BoneEnhancedImage'
+  SURFACE_REFERENCE_ROLE = 'BoneSurface'
+
   def __init__(self):        
     self.ModuleLayoutID = -1    
     self.setLayout()
+    # Use the Intel MKL engine if the BoneEnhancerCpp module is available, otherwise the NumPy engine
+    self.engine = 'cpp' if hasattr(slicer.modules, 'boneenhancercpp') else 'numpy'
+    self.numberOfThreads = 0
+    self.backgroundProcessing = None
+    self.streamingProcessing = None
+    self.benchmarkNodes = None
+    self.instrumentationEnabled = False
+    self.instrumentationLogFilePath = None
+    self.instrumentation = None
+    self.instrumentationHistory = collections.deque(maxlen=100)
+    # Output volume node -> (its image data, Incremental.SliceTracker)
+    self.sliceTrackers = {}
   
-  # IMPORTANT: paramsVTK given to the ImageProcessingConnector are sorted alphabetically. 
+  # Sets the number of threads across which slices are distributed, 0 uses all cores.
+  def setNumberOfThreads(self, numberOfThreads):
+    self.numberOfThreads = max(int(numberOfThreads), 0)
+    if hasattr(slicer.modules, 'boneenhancercpp'):
+      slicer.modules.boneenhancercpp.logic().SetNumberOfThreads(self.numberOfThreads)
+
+  # Releases the scratch buffers and kernels which the C++ engine keeps between calls, they are also released when the scene is closed.
+  def releaseBuffers(self):
+    if hasattr(slicer.modules, 'boneenhancercpp'):
+      slicer.modules.boneenhancercpp.logic().ReleaseBuffers()
+
+  # Enables collecting the instrumentation of each BSP extraction (see BoneEnhancerPyLib/Instrumentation.py): the time of each stage
+  # and slice, the number of slices skipped as all-zero, the allocated bytes and the threads used. Each record is logged, and appended
+  # as a JSON line to logFilePath if it is given. Nothing is collected while it is disabled.
+  def setInstrumentationEnabled(self, enabled, logFilePath=None):
+    self.instrumentationEnabled = bool(enabled)
+    self.instrumentationLogFilePath = logFilePath
+    if hasattr(slicer.modules, 'boneenhancercpp'):
+      slicer.modules.boneenhancercpp.logic().SetInstrumentationEnabled(self.instrumentationEnabled)
+
+  def isInstrumentationEnabled(self):
+    return self.instrumentationEnabled
+
+  # Returns the instrumentation of the last BSP extraction, None if none was instrumented.
+  def getInstrumentation(self):
+    return self.instrumentation
+
+  # Writes the instrumentation of the last (up to 100) BSP extractions to a trace file, in the Chrome trace event format.
+  def writeInstrumentationTrace(self, filePath):
+    Instrumentation.writeTrace(self.instrumentationHistory, filePath)
+
+  # Returns a started instrumentation record for a BSP extraction, None if instrumentation is disabled.
+  def startInstrumentation(self, name):
+    if not self.instrumentationEnabled:
+      return None
+    engine = self.getEngine(name)
+    instrumentation = Instrumentation.Instrumentation(engine, name)
+    # The C++ engine reports the bytes it allocates itself
+    instrumentation.start(traceMemory=(engine == 'numpy'))
+    return instrumentation
+
+  def finishInstrumentation(self, instrumentation):
+    if instrumentation is None:
+      return
+    instrumentation.stop()
+    self.instrumentation = instrumentation
+    self.instrumentationHistory.append(instrumentation)
+    logging.info('Instrumentation ' + instrumentation.summary())
+    if self.instrumentationLogFilePath:
+      instrumentation.appendToLog(self.instrumentationLogFilePath)
+
+  # Adds the instrumentation of the last ImageProcessingConnector call, started at callStartTime (timeit.default_timer).
+  def addCppInstrumentation(self, instrumentation, callStartTime):
+    cppLogic = slicer.modules.boneenhancercpp.logic()
+    instrumentation.addStageTimes(dict((cppLogic.GetStageName(stage), cppLogic.GetStageTime(stage)) for stage in range(cppLogic.NumberOfStages)))
+    sliceTimes = cppLogic.GetSliceTimes()
+    for i in range(sliceTimes.GetNumberOfTuples()):
+      sliceIndex, startTime, duration, worker, skipped = sliceTimes.GetTuple(i)
+      instrumentation.addSliceTime(sliceIndex, callStartTime + startTime, duration, int(worker), skipped > 0)
+    instrumentation.numberOfAllocatedBytes += cppLogic.GetNumberOfAllocatedBytes()
+    instrumentation.numberOfThreads = max(instrumentation.numberOfThreads, cppLogic.GetNumberOfThreadsUsed())
+
+  def getNumberOfThreads(self):
+    if self.numberOfThreads > 0:
+      return self.numberOfThreads
+    return multiprocessing.cpu_count()
+  
+  def setEngine(self, engine):
+    if engine not in ['cpp', 'numpy']:
+      raise ValueError('Unknown engine: ' + str(engine))
+    if engine == 'cpp' and not hasattr(slicer.modules, 'boneenhancercpp'):
+      raise ValueError('The BoneEnhancerCpp module is not available')
+    self.engine = engine
+
+  # Returns the engine which runs an algorithm: the selected engine, or the NumPy engine if the algorithm has no C++ implementation.
+  def getEngine(self, name):
+    return self.engine if self.engine in self.getAlgorithm(name).engines else 'numpy'
+
+  # Returns the registered algorithm (see BoneEnhancerPyLib/Algorithms.py) of a name, or of the title its radio button shows.
+  def getAlgorithm(self, name):
+    return Algorithms.getAlgorithm(name)
+
+  # Returns the parameters of an algorithm as a dictionary of parameter name -> value. paramsVTK is a dictionary, as the widget
+  # passes it (AlgorithmParams.GetParameters), or a vtkDoubleArray of the values sorted alphabetically by parameter name, as given
+  # to the ImageProcessingConnector.
+  def getParameters(self, name, paramsVTK):
+    if isinstance(paramsVTK, dict):
+      return self.getAlgorithm(name).parameters(paramsVTK)
+    return self.getAlgorithm(name).parametersFromList([paramsVTK.GetValue(i) for i in range(paramsVTK.GetNumberOfTuples())])
+
+  # Returns the parameters of an algorithm as the key of the slices computed with them (see Incremental.SliceTracker).
+  def getSliceParameters(self, name, paramsVTK):
+    return dict(self.getParameters(name, paramsVTK), Algorithm=self.getAlgorithm(name).name)
+
+  # Returns the parameters as a vtkDoubleArray for the ImageProcessingConnector, sorted alphabetically by parameter name.
+  def getParamsVTK(self, name, paramsVTK):
+    if not isinstance(paramsVTK, dict):
+      return paramsVTK
+    algorithm = self.getAlgorithm(name)
+    return numpy_support.numpy_to_vtk(num_array=algorithm.parametersToList(paramsVTK), deep=True, array_type=vtk.VTK_DOUBLE)
+
+  # Extracts the BSP with the ImageProcessingConnector of BoneEnhancerCpp, which takes the algorithm by its registered name and the
+  # parameters as a vtkDoubleArray (see getParamsVTK), converted here. Returns the runtime in seconds, raises ValueError if the
+  # C++ logic does not know the algorithm.
+  def runImageProcessingConnector(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, firstSlice=-1, lastSlice=-1):
+    algorithm = self.getAlgorithm(name)
+    runtime = slicer.modules.boneenhancercpp.logic().ImageProcessingConnector(inputVolumeNode, boneEnhancedImage, self.getParamsVTK(name, paramsVTK),
+                                                                              algorithm.name, firstSlice, lastSlice)
+    if runtime < 0:
+      raise ValueError('BoneEnhancerCpp has no algorithm ' + algorithm.name)
+    return runtime
+
   def calculateBoneEnhancedImage(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, runtimeLabel=None, applyButton=None, firstSlice=-1, lastSlice=-1):
     logging.info('Extracting BSP started')
-    runtime = slicer.modules.boneenhancercpp.logic().ImageProcessingConnector(inputVolumeNode, boneEnhancedImage, paramsVTK, name, firstSlice, lastSlice)
+    self.checkOutputVolume(inputVolumeNode, boneEnhancedImage)
+    wasModifying = boneEnhancedImage.StartModify()
+    instrumentation = self.startInstrumentation(name)
+    if self.getEngine(name) == 'cpp':
+      callStartTime = timeit.default_timer()
+      runtime = self.runImageProcessingConnector(inputVolumeNode, boneEnhancedImage, paramsVTK, name, firstSlice, lastSlice)
+      if instrumentation:
+        self.addCppInstrumentation(instrumentation, callStartTime)
+    else:
+      runtime = self.calculateBoneEnhancedImageNumpy(inputVolumeNode, boneEnhancedImage, paramsVTK, name, firstSlice, lastSlice, instrumentation)
+    self.finishInstrumentation(instrumentation)
+    self.invalidateSlices(boneEnhancedImage, None if firstSlice < 0 or lastSlice < firstSlice else [(firstSlice, lastSlice)])
     runtime = str(round(runtime, 3)) 
     message = runtime + ' s.'
     if runtimeLabel:
       runtimeLabel.setText(message)
     logging.info('Extracting BSP completed (' + message + ')')
     
-    boneEnhancedImage.Modified()
+    self.publishOutput(boneEnhancedImage, inputVolumeNode, wasModifying)
     if applyButton:
       applyButton.checked = False
     
     return True
 
-  def updateSliceViews(self, boneEnhancedImage, USVolumeNode):
+  # Starts processing in the background and returns immediately. progressCallback(numberOfProcessedSlices, numberOfSlices, runtime)
+  # is called whenever slices have been published into boneEnhancedImage, finishedCallback(completed, runtime) once at the end.
+  # sliceRanges, a list of (first, last) slice ranges, replaces firstSlice and lastSlice. If incremental is True, only the stale
+  # slices among them are processed (see calculateBoneEnhancedImageIncremental), and the slices done before a cancel stay up to date.
+  def calculateBoneEnhancedImageAsync(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, progressCallback=None, finishedCallback=None, firstSlice=-1, lastSlice=-1,
+                                      sliceRanges=None, incremental=False):
+    self.cancelProcessing()
+    self.checkOutputVolume(inputVolumeNode, boneEnhancedImage)
+    numberOfSlices = inputVolumeNode.GetImageData().GetDimensions()[2]
+    if sliceRanges is None and firstSlice >= 0 and lastSlice >= firstSlice:
+      sliceRanges = [(firstSlice, lastSlice)]
+    tracker = self.getSliceTracker(boneEnhancedImage)
+    staleKeys = None
+    if incremental:
+      outputArray = self.getVolumeArray(boneEnhancedImage)
+      sliceIndices, staleKeys = tracker.staleSlices(self.getVolumeArray(inputVolumeNode), self.getSliceParameters(name, paramsVTK), outputArray.dtype, sliceRanges)
+      # All-zero slices are not processed, they must not keep an earlier BSP
+      outputArray[sliceIndices] = 0
+    else:
+      sliceIndices = Incremental.sliceIndices(sliceRanges, numberOfSlices)
+      tracker.invalidate(Incremental.sliceRanges(sliceIndices))
+    logging.info('Extracting BSP of %d slices started in the background' % len(sliceIndices))
+    self.backgroundProcessing = BackgroundProcessing(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, progressCallback=progressCallback, finishedCallback=finishedCallback,
+                                                     sliceIndices=sliceIndices, sliceTracker=tracker if staleKeys is not None else None, staleKeys=staleKeys)
+    self.backgroundProcessing.start()
+    return self.backgroundProcessing
+
+  def cancelProcessing(self):
+    if self.isProcessing():
+      logging.info('Extracting BSP cancelled')
+      self.backgroundProcessing.cancel()
+
+  def isProcessing(self):
+    return self.backgroundProcessing is not None and self.backgroundProcessing.isRunning()
+
+  # Starts extracting the BSP of every new frame of inputVolumeNode, until stopStreaming is called. statisticsCallback(framesPerSecond,
+  # latency, numberOfDroppedFrames) is called whenever a frame has been published into boneEnhancedImage.
+  def startStreaming(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, statisticsCallback=None):
+    self.stopStreaming()
+    self.checkOutputVolume(inputVolumeNode, boneEnhancedImage)
+    self.streamingProcessing = StreamingProcessing(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, statisticsCallback)
+    self.streamingProcessing.start()
+    return self.streamingProcessing
+
+  def stopStreaming(self):
+    if self.isStreaming():
+      self.streamingProcessing.stop()
+
+  def isStreaming(self):
+    return self.streamingProcessing is not None and self.streamingProcessing.isRunning()
+
+  # Returns the Incremental.SliceTracker of an output volume, which records the input and parameters each of its slices was
+  # computed with. The tracker is reset when the image data of the volume is replaced, except by allocateImageData.
+  def getSliceTracker(self, boneEnhancedImage):
+    imageData, tracker = self.sliceTrackers.get(boneEnhancedImage, (None, None))
+    if tracker is None or imageData is not boneEnhancedImage.GetImageData():
+      tracker = Incremental.SliceTracker()
+      self.sliceTrackers[boneEnhancedImage] = (boneEnhancedImage.GetImageData(), tracker)
+    return tracker
+
+  # Marks slices of an output volume as stale, so that the next incremental extraction recomputes them. sliceRanges is a list
+  # of (first, last) slice ranges, None is all slices. Call it when the output is modified by something else than this logic.
+  def invalidateSlices(self, boneEnhancedImage, sliceRanges=None):
+    if boneEnhancedImage in self.sliceTrackers:
+      self.sliceTrackers[boneEnhancedImage][1].invalidate(sliceRanges)
+
+  # Returns the slices among sliceRanges (a list of (first, last) slice ranges, None is all slices) that an incremental extraction
+  # would recompute, as (first, last) ranges: the slices which were never computed, or whose input or parameters changed since.
+  def getStaleSliceRanges(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, sliceRanges=None):
+    tracker = self.getSliceTracker(boneEnhancedImage)
+    stale, staleKeys = tracker.staleSlices(self.getVolumeArray(inputVolumeNode), self.getSliceParameters(name, paramsVTK),
+                                           self.getVolumeArray(boneEnhancedImage).dtype, sliceRanges)
+    return Incremental.sliceRanges(stale)
+
+  # Extracts the BSP of the stale slices among sliceRanges only (see getStaleSliceRanges), the other slices of boneEnhancedImage keep
+  # their BSP. The ranges need not be contiguous. Returns the recomputed slices as (first, last) ranges.
+  def calculateBoneEnhancedImageIncremental(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, sliceRanges=None, runtimeLabel=None):
+    startTime = time.time()
+    self.checkOutputVolume(inputVolumeNode, boneEnhancedImage)
+    tracker = self.getSliceTracker(boneEnhancedImage)
+    outputArray = self.getVolumeArray(boneEnhancedImage)
+    stale, staleKeys = tracker.staleSlices(self.getVolumeArray(inputVolumeNode), self.getSliceParameters(name, paramsVTK), outputArray.dtype, sliceRanges)
+    staleRanges = Incremental.sliceRanges(stale)
+    logging.info('Extracting BSP of %d stale slices started' % len(stale))
+    if stale:
+      wasModifying = boneEnhancedImage.StartModify()
+      instrumentation = self.startInstrumentation(name)
+      # All-zero slices are not processed, they must not keep an earlier BSP
+      outputArray[stale] = 0
+      if self.getEngine(name) == 'cpp':
+        for firstSlice, lastSlice in staleRanges:
+          callStartTime = timeit.default_timer()
+          self.runImageProcessingConnector(inputVolumeNode, boneEnhancedImage, paramsVTK, name, firstSlice, lastSlice)
+          if instrumentation:
+            self.addCppInstrumentation(instrumentation, callStartTime)
+      else:
+        self.calculateBoneEnhancedImageNumpy(inputVolumeNode, boneEnhancedImage, paramsVTK, name, instrumentation=instrumentation, sliceIndices=stale)
+      tracker.markComputed(staleKeys)
+      self.finishInstrumentation(instrumentation)
+      self.publishOutput(boneEnhancedImage, inputVolumeNode, wasModifying)
+    message = str(round(time.time() - startTime, 3)) + ' s.'
+    if runtimeLabel:
+      runtimeLabel.setText(message)
+    logging.info('Extracting BSP completed (' + message + ')')
+    return staleRanges
+
+  # NumPy counterpart of the ImageProcessingConnector, returns the runtime in seconds. The stage and slice times are added to
+  # instrumentation, if it is not None. sliceIndices, if given, are the slices to process instead of firstSlice to lastSlice.
+  # The output is not published, call publishOutput once the batch of extractions is done.
+  def calculateBoneEnhancedImageNumpy(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, firstSlice=-1, lastSlice=-1, instrumentation=None, sliceIndices=None):
+    startTime = time.time()
+    stageTimes = {} if instrumentation else None
+    sliceTimes = [] if instrumentation else None
+    self.getAlgorithm(name).process(self.getVolumeArray(inputVolumeNode), self.getParameters(name, paramsVTK), firstSliceIndex=firstSlice, lastSliceIndex=lastSlice,
+                                    outputVolume=self.getVolumeArray(boneEnhancedImage), numberOfThreads=self.getNumberOfThreads(),
+                                    stageTimes=stageTimes, sliceTimes=sliceTimes, sliceIndices=sliceIndices)
+    if instrumentation:
+      instrumentation.addForoughi2007Times(stageTimes, sliceTimes)
+    return time.time() - startTime
+
+  # Returns the index box ((firstSlice, lastSlice), (firstRow, lastRow), (firstColumn, lastColumn)), last included, of the voxels of
+  # inputVolumeNode inside roi (see BoneEnhancerPyLib/RegionOfInterest.py). roi is an index box, which is clipped to the volume, or an
+  # ROI node (markups or annotation), whose bounds are mapped to the voxels of the volume. Transforms of the volume are not applied.
+  def getROIBox(self, inputVolumeNode, roi):
+    nx, ny, nz = inputVolumeNode.GetImageData().GetDimensions()
+    if isinstance(roi, (tuple, list)) or roi is None:
+      return RegionOfInterest.clipBox(roi, (nz, ny, nx))
+    bounds = [0.0] * 6
+    roi.GetRASBounds(bounds)
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    inputVolumeNode.GetRASToIJKMatrix(rasToIjkMatrix)
+    corners = numpy.array([rasToIjkMatrix.MultiplyPoint([r, a, s, 1.0])[:3] for r in bounds[0:2] for a in bounds[2:4] for s in bounds[4:6]])
+    # The voxels whose centers are inside the ROI
+    firstIndex = numpy.ceil(corners.min(axis=0) - 1e-6).astype(int)
+    lastIndex = numpy.floor(corners.max(axis=0) + 1e-6).astype(int)
+    return RegionOfInterest.clipBox([(firstIndex[axis], lastIndex[axis]) for axis in (2, 1, 0)], (nz, ny, nx))
+
+  # Extracts the BSP of the voxels inside roi only (see getROIBox), the output is zero outside it. Each slice of the region is processed
+  # as an image of its own, with the TransducerMargin counted from the top of the volume. Returns the index box of the region.
+  def calculateBoneEnhancedImageROI(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, roi, runtimeLabel=None):
+    logging.info('Extracting BSP in ROI started')
+    startTime = time.time()
+    self.checkOutputVolume(inputVolumeNode, boneEnhancedImage)
+    box = self.getROIBox(inputVolumeNode, roi)
+    params = self.getParameters(name, paramsVTK)
+    instrumentation = self.startInstrumentation(name)
+    inputArray = self.getVolumeArray(inputVolumeNode)
+    outputArray = self.getVolumeArray(boneEnhancedImage)
+    if self.getEngine(name) == 'cpp':
+      # The connector processes whole slices, so the region is processed through volume nodes of its size
+      region = RegionOfInterest.boxSlices(box)
+      regionInputNode = self.createVolumeNodeFromArray(inputArray[region])
+      regionOutputNode = slicer.vtkMRMLScalarVolumeNode()
+      self.allocateImageData(regionInputNode, regionOutputNode, boneEnhancedImage.GetImageData().GetScalarType())
+      callStartTime = timeit.default_timer()
+      self.runImageProcessingConnector(regionInputNode, regionOutputNode, RegionOfInterest.regionParameters(params, box), name)
+      if instrumentation:
+        self.addCppInstrumentation(instrumentation, callStartTime)
+      outputArray[...] = 0
+      outputArray[region] = self.getVolumeArray(regionOutputNode)
+    else:
+      stageTimes = {} if instrumentation else None
+      sliceTimes = [] if instrumentation else None
+      RegionOfInterest.processRegion(self.getAlgorithm(name), inputArray, params, box, outputVolume=outputArray, numberOfThreads=self.getNumberOfThreads(),
+                                     stageTimes=stageTimes, sliceTimes=sliceTimes)
+      if instrumentation:
+        instrumentation.addForoughi2007Times(stageTimes, sliceTimes)
+    self.finishInstrumentation(instrumentation)
+    self.invalidateSlices(boneEnhancedImage)
+    self.publishOutput(boneEnhancedImage, inputVolumeNode)
+    message = str(round(time.time() - startTime, 3)) + ' s.'
+    if runtimeLabel:
+      runtimeLabel.setText(message)
+    logging.info('Extracting BSP in ROI %s completed (%s)' % (box, message))
+    return box
+
+  # Extracts the bone surface of every slice of a BSP volume (see SurfaceExtraction.boneSurface). Returns the surface row of
+  # every slice and column as a (nz, nx) array, -1 where there is no bone, and a label volume which is 1 on the surface. The
+  # label volume is created if labelVolumeNode is None.
+  def extractBoneSurface(self, boneEnhancedImage, labelVolumeNode=None, maximumJump=SurfaceExtraction.DEFAULT_MAXIMUM_JUMP,
+                         smoothness=SurfaceExtraction.DEFAULT_SMOOTHNESS, minimumBSP=SurfaceExtraction.DEFAULT_MINIMUM_BSP):
+    startTime = time.time()
+    bspArray = self.getVolumeArray(boneEnhancedImage)
+    surface = SurfaceExtraction.boneSurface(bspArray, maximumJump, smoothness, minimumBSP)
+    if not labelVolumeNode:
+      labelVolumeNode = slicer.vtkMRMLLabelMapVolumeNode()
+      labelVolumeNode.SetName(slicer.mrmlScene.GenerateUniqueName('BoneSurface'))
+      slicer.mrmlScene.AddNode(labelVolumeNode)
+    self.allocateImageData(boneEnhancedImage, labelVolumeNode, vtk.VTK_UNSIGNED_CHAR)
+    self.checkOutputVolume(boneEnhancedImage, labelVolumeNode)
+    SurfaceExtraction.surfaceLabelVolume(surface, bspArray.shape, outputVolume=self.getVolumeArray(labelVolumeNode))
+    self.publishOutput(labelVolumeNode, boneEnhancedImage)
+    logging.info('Extracting bone surface completed (' + str(round(time.time() - startTime, 3)) + ' s.)')
+    return surface, labelVolumeNode
+
+  # Benchmarks the NumPy engine, and the C++ engine if it is available, on the sample data and on synthetic sweeps of the given
+  # sizes (see BoneEnhancerPyLib/Benchmark.py). The results are written to outputFilePath as JSON, and compared with the results
+  # in baselineFilePath. Returns the results and the regressions.
+  def runBenchmark(self, sizes=Benchmark.DEFAULT_SIZES, threadCounts=None, repetitions=3, outputFilePath=None, baselineFilePath=None, threshold=Benchmark.DEFAULT_THRESHOLD):
+    engines = {'numpy' : Benchmark.numpyEngine}
+    if hasattr(slicer.modules, 'boneenhancercpp'):
+      engines['cpp'] = self.benchmarkCppEngine
+      # The C++ engine only times its stages with instrumentation enabled
+      slicer.modules.boneenhancercpp.logic().SetInstrumentationEnabled(True)
+    numberOfThreads = self.numberOfThreads
+    try:
+      results = Benchmark.runBenchmark(Benchmark.datasets(sizes), engines, threadCounts, repetitions, log=logging.info)
+    finally:
+      self.benchmarkNodes = None
+      self.setNumberOfThreads(numberOfThreads)
+      self.setInstrumentationEnabled(self.instrumentationEnabled, self.instrumentationLogFilePath)
+    if outputFilePath:
+      Benchmark.writeResults(results, outputFilePath)
+    regressions = []
+    if baselineFilePath:
+      regressions = Benchmark.compareResults(results, Benchmark.readResults(baselineFilePath), threshold)
+      for regression in regressions:
+        logging.warning('Benchmark regression: ' + Benchmark.formatRegression(regression))
+    return results, regressions
+
+  # Benchmark engine running the ImageProcessingConnector on a NumPy volume, through volume nodes which are not added to the
+  # scene and are kept while the same volume is benchmarked. Adds the stage times to stageTimes, returns the runtime in seconds.
+  def benchmarkCppEngine(self, volume, numberOfThreads, params, stageTimes):
+    if self.benchmarkNodes is None or self.benchmarkNodes[0] is not volume:
+      inputVolumeNode = self.createVolumeNodeFromArray(volume)
+      boneEnhancedImage = slicer.vtkMRMLScalarVolumeNode()
+      self.allocateImageData(inputVolumeNode, boneEnhancedImage, vtk.VTK_DOUBLE)
+      self.benchmarkNodes = (volume, inputVolumeNode, boneEnhancedImage)
+    volume, inputVolumeNode, boneEnhancedImage = self.benchmarkNodes
+    self.setNumberOfThreads(numberOfThreads)
+    cppLogic = slicer.modules.boneenhancercpp.logic()
+    runtime = self.runImageProcessingConnector(inputVolumeNode, boneEnhancedImage, params, Algorithms.FOROUGHI2007.name)
+    for stage in range(cppLogic.NumberOfStages):
+      stageTimes[cppLogic.GetStageName(stage)] = stageTimes.get(cppLogic.GetStageName(stage), 0.0) + cppLogic.GetStageTime(stage)
+    return runtime
+
+  # Sets the output volume's geometry to be the same as the input volume. The output is not modified if it already is.
+  def copyGeometry(self, inputVolumeNode, boneEnhancedImage):
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    inputVolumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    outputIjkToRasMatrix = vtk.vtkMatrix4x4()
+    boneEnhancedImage.GetIJKToRASMatrix(outputIjkToRasMatrix)
+    if any(ijkToRasMatrix.GetElement(i, j) != outputIjkToRasMatrix.GetElement(i, j) for i in range(4) for j in range(4)):
+      boneEnhancedImage.SetIJKToRASMatrix(ijkToRasMatrix)
+
+  # Returns the output volume bound to inputVolumeNode. The binding is a node reference of the input, so it survives renaming the
+  # output and is saved with the scene. If there is no output, one is created (named name) and bound. The image data of the output is
+  # only reallocated if its scalar type or dimensions do not match the input (see allocateImageData), otherwise it is reused.
+  # role and className select another output of the input, e.g. the label volume of its bone surface (see getSurfaceVolume).
+  def getOutputVolume(self, inputVolumeNode, scalarType=vtk.VTK_DOUBLE, name='BoneEnhancedImage', role=OUTPUT_REFERENCE_ROLE, className='vtkMRMLScalarVolumeNode'):
+    boneEnhancedImage = inputVolumeNode.GetNodeReference(role)
+    if boneEnhancedImage is None:
+      boneEnhancedImage = self.createVolumeNode(inputVolumeNode, name, scalarType, className)
+      self.bindOutputVolume(inputVolumeNode, boneEnhancedImage, role)
+    else:
+      self.allocateImageData(inputVolumeNode, boneEnhancedImage, scalarType)
+    return boneEnhancedImage
+
+  # Returns the label volume of the bone surface of inputVolumeNode (see extractBoneSurface), bound to it as its output volume is.
+  def getSurfaceVolume(self, inputVolumeNode):
+    return self.getOutputVolume(inputVolumeNode, vtk.VTK_UNSIGNED_CHAR, 'BoneSurface', self.SURFACE_REFERENCE_ROLE, 'vtkMRMLLabelMapVolumeNode')
+
+  # Makes boneEnhancedImage the output volume of inputVolumeNode (see getOutputVolume), None unbinds it.
+  def bindOutputVolume(self, inputVolumeNode, boneEnhancedImage, role=OUTPUT_REFERENCE_ROLE):
+    inputVolumeNode.SetNodeReferenceID(role, boneEnhancedImage.GetID() if boneEnhancedImage else None)
+
+  # Returns the BSP of the output volume of inputVolumeNode as a (nz, ny, nx) NumPy array which shares memory with its image data
+  # (no copy), None if it has no output.
+  def getOutputArray(self, inputVolumeNode):
+    boneEnhancedImage = inputVolumeNode.GetNodeReference(self.OUTPUT_REFERENCE_ROLE)
+    if boneEnhancedImage is None or boneEnhancedImage.GetImageData() is None:
+      return None
+    return self.getVolumeArray(boneEnhancedImage)
+
+  # Raises ValueError if the image data of the output volume does not have the dimensions of the input, the engines write into it
+  # through a raw pointer.
+  def checkOutputVolume(self, inputVolumeNode, boneEnhancedImage):
+    inputImageData = inputVolumeNode.GetImageData()
+    imageData = boneEnhancedImage.GetImageData()
+    if inputImageData is None:
+      raise ValueError('The input volume %s has no image data' % inputVolumeNode.GetName())
+    if imageData is None or imageData.GetDimensions() != inputImageData.GetDimensions() or imageData.GetNumberOfScalarComponents() != 1:
+      raise ValueError('The output volume %s does not match the dimensions of the input volume %s %s, call allocateImageData or getOutputVolume first'
+                       % (boneEnhancedImage.GetName(), inputVolumeNode.GetName(), inputImageData.GetDimensions()))
+
+  # Signals that a batch of writes into the image data of boneEnhancedImage is done, with a single ModifiedEvent and ImageDataModifiedEvent
+  # of the node, so the views are rendered once. The geometry of inputVolumeNode is copied, if it is given. If the batch started with
+  # boneEnhancedImage.StartModify(), pass its result as wasModifying: the events of the batch (e.g. of the C++ engine) are coalesced too.
+  def publishOutput(self, boneEnhancedImage, inputVolumeNode=None, wasModifying=None):
+    if wasModifying is None:
+      wasModifying = boneEnhancedImage.StartModify()
+    if inputVolumeNode:
+      self.copyGeometry(inputVolumeNode, boneEnhancedImage)
+    boneEnhancedImage.GetImageData().Modified()
+    boneEnhancedImage.EndModify(wasModifying)
+
+  # Returns the voxels of a volume node as a (nz, ny, nx) NumPy array, sharing memory with the image data.
+  def getVolumeArray(self, volumeNode):
+    imageData = volumeNode.GetImageData()
+    nx, ny, nz = imageData.GetDimensions()
+    return numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(nz, ny, nx)
+
+  def updateSliceViews(self, boneEnhancedImage, USVolumeNode, labelVolumeNode=None):
     layoutManager = slicer.app.layoutManager()   
     # Update bone enhanced image
     for name in ['RedBone', 'YellowBone', 'GreenBone']:      
       sliceWidget = layoutManager.sliceWidget(name)    
       sliceLogic = sliceWidget.sliceLogic()
       sliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(boneEnhancedImage.GetID()) 
+      if labelVolumeNode:
+        sliceLogic.GetSliceCompositeNode().SetLabelVolumeID(labelVolumeNode.GetID())
       sliceLogic.FitSliceToAll()    
     # Update ultrasound image
     for name in ['Red', 'Yellow', 'Green']:      
@@ -304,19 +868,18 @@ class BoneEnhancerPyLogic(ScriptedLoadableModuleLogic):
       
     layoutManager.setLayout(self.ModuleLayoutID)
     
-  def createVolumeNode(self, inputVolumeNode, name):
+  def createVolumeNode(self, inputVolumeNode, name, scalarType=vtk.VTK_DOUBLE, className='vtkMRMLScalarVolumeNode'):
     inputImageData = inputVolumeNode.GetImageData()
     imageSize=inputImageData.GetDimensions()
     imageSpacing=inputVolumeNode.GetSpacing()
     imageOrigin=inputVolumeNode.GetOrigin()
-    voxelType=vtk.VTK_DOUBLE 
     # Create an empty image volume
     imageData=vtk.vtkImageData()
     imageData.SetDimensions(imageSize)
-    imageData.AllocateScalars(voxelType, 1)    
+    imageData.AllocateScalars(scalarType, 1)    
     # Create volume node
     scene = slicer.mrmlScene
-    volumeNode=slicer.vtkMRMLScalarVolumeNode()
+    volumeNode=getattr(slicer, className)()
     volumeNode.SetSpacing(imageSpacing)
     volumeNode.SetOrigin(imageOrigin)
     volumeNode.SetAndObserveImageData(imageData)
@@ -326,29 +889,494 @@ class BoneEnhancerPyLogic(ScriptedLoadableModuleLogic):
     
     return volumeNode
 
-  def castVolumeNodeToDouble(self, volumeNode):
-    castFilter = vtk.vtkImageCast()
-    castFilter.SetInputData(volumeNode.GetImageData())
-    castFilter.SetOutputScalarTypeToDouble()
-    castFilter.Update()
-    
-    volumeNode.SetAndObserveImageData(castFilter.GetOutput())
-        
+  # Returns a volume node with a copy of a (nz, ny, nx) array as image data, which is added to the scene if a name is given.
+  def createVolumeNodeFromArray(self, volume, name=None):
+    nz, ny, nx = volume.shape
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(nx, ny, nz)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(numpy.ravel(volume), deep=True, array_type=numpy_support.get_vtk_array_type(volume.dtype)))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetAndObserveImageData(imageData)
+    if name:
+      volumeNode.SetName(slicer.mrmlScene.GenerateUniqueName(name))
+      slicer.mrmlScene.AddNode(volumeNode)
+    return volumeNode
+
+  # Replaces the image data of volumeNode with an empty one of the given scalar type if its scalar type
+  # or dimensions differ from the input volume. Returns True if the image data was replaced. If only the
+  # number of slices differs, e.g. because the sweep grew, the slices which still exist are kept and stay
+  # up to date for incremental extraction, and new slices are zero.
+  def allocateImageData(self, inputVolumeNode, volumeNode, scalarType):
+    imageData = volumeNode.GetImageData()
+    imageSize = inputVolumeNode.GetImageData().GetDimensions()
+    if imageData and imageData.GetScalarType() == scalarType and imageData.GetDimensions() == imageSize:
+      return False
+    newImageData = vtk.vtkImageData()
+    newImageData.SetDimensions(imageSize)
+    newImageData.AllocateScalars(scalarType, 1)
+    if imageData and imageData.GetScalarType() == scalarType and imageData.GetDimensions()[:2] == imageSize[:2]:
+      nx, ny, nz = imageSize
+      newArray = numpy_support.vtk_to_numpy(newImageData.GetPointData().GetScalars()).reshape(nz, ny, nx)
+      numberOfKeptSlices = min(nz, imageData.GetDimensions()[2])
+      newArray[:numberOfKeptSlices] = self.getVolumeArray(volumeNode)[:numberOfKeptSlices]
+      newArray[numberOfKeptSlices:] = 0
+      if volumeNode in self.sliceTrackers:
+        self.sliceTrackers[volumeNode] = (newImageData, self.sliceTrackers[volumeNode][1])
+    volumeNode.SetAndObserveImageData(newImageData)
     return True
-    
+
+############################################################ BackgroundProcessing
+# Extracts the BSP slice by slice without blocking the Qt main thread. The NumPy engine runs on a worker
+# thread, the C++ engine processes one slice per worker thread in each iteration of the Qt event loop.
+# Finished slices are published into the output volume on the main thread, at most once per timer tick.
+class BackgroundProcessing:
+
+  def __init__(self, logic, inputVolumeNode, boneEnhancedImage, paramsVTK, name, firstSlice=-1, lastSlice=-1, progressCallback=None, finishedCallback=None,
+               sliceIndices=None, sliceTracker=None, staleKeys=None):
+    self.logic = logic
+    self.inputVolumeNode = inputVolumeNode
+    self.boneEnhancedImage = boneEnhancedImage
+    self.paramsVTK = paramsVTK
+    self.name = name
+    self.progressCallback = progressCallback
+    self.finishedCallback = finishedCallback
+    # Keep the image data alive while the worker thread is accessing its memory
+    self.inputImageData = inputVolumeNode.GetImageData()
+    self.outputImageData = boneEnhancedImage.GetImageData()
+    numberOfSlices = self.inputImageData.GetDimensions()[2]
+    if firstSlice < 0 or lastSlice < 0 or firstSlice > lastSlice:
+      firstSlice = 0
+      lastSlice = numberOfSlices - 1
+    if sliceIndices is None:
+      sliceIndices = range(firstSlice, min(lastSlice, numberOfSlices - 1) + 1)
+    self.sliceIndices = list(sliceIndices)
+    # Slices which are processed are marked as computed with the keys of staleKeys in sliceTracker, if it is given
+    self.sliceTracker = sliceTracker
+    self.staleKeys = staleKeys
+    self.numberOfProcessedSlices = 0
+    self.cancelled = False
+    self.cancelEvent = threading.Event()
+    self.processedSlices = queue.Queue()
+    self.thread = None
+    self.error = None
+    self.startTime = 0
+    self.instrumentation = None
+    self.stageTimes = None
+    self.sliceTimes = None
+    self.timer = qt.QTimer()
+    self.timer.connect('timeout()', self.onTimeout)
+
+  def start(self):
+    self.startTime = time.time()
+    self.instrumentation = self.logic.startInstrumentation(self.name)
+    if self.instrumentation:
+      self.stageTimes = {}
+      self.sliceTimes = []
+    self.logic.copyGeometry(self.inputVolumeNode, self.boneEnhancedImage)
+    if self.logic.getEngine(self.name) == 'numpy':
+      self.thread = threading.Thread(target=self.runNumpyEngine)
+      self.thread.daemon = True
+      self.thread.start()
+      self.timer.setInterval(100)
+    else:
+      self.timer.setInterval(0)
+    self.timer.start()
+
+  def cancel(self):
+    self.cancelled = True
+    self.cancelEvent.set()
+
+  def isRunning(self):
+    return self.timer.isActive()
+
+  def getRuntime(self):
+    return time.time() - self.startTime
+
+  # Worker thread, only touches NumPy arrays and reports the number of finished slices through the queue
+  def runNumpyEngine(self):
+    try:
+      inputArray = self.logic.getVolumeArray(self.inputVolumeNode)
+      outputArray = self.logic.getVolumeArray(self.boneEnhancedImage)
+      algorithm = self.logic.getAlgorithm(self.name)
+      params = self.logic.getParameters(self.name, self.paramsVTK)
+      numberOfThreads = self.logic.getNumberOfThreads()
+      for chunkStart in range(0, len(self.sliceIndices), numberOfThreads):
+        if self.cancelEvent.is_set():
+          break
+        chunk = self.sliceIndices[chunkStart:chunkStart + numberOfThreads]
+        algorithm.process(inputArray, params, outputVolume=outputArray, numberOfThreads=numberOfThreads, stageTimes=self.stageTimes,
+                          sliceTimes=self.sliceTimes, sliceIndices=chunk)
+        self.processedSlices.put(len(chunk))
+    except Exception as e:
+      self.error = e
+
+  def processNextSlicesCpp(self):
+    if self.cancelled or self.numberOfProcessedSlices >= len(self.sliceIndices):
+      return 0
+    numberOfThreads = self.logic.getNumberOfThreads()
+    chunk = self.sliceIndices[self.numberOfProcessedSlices:self.numberOfProcessedSlices + numberOfThreads]
+    # The connector processes a range of slices, the slices of the chunk need not be contiguous
+    for firstSlice, lastSlice in Incremental.sliceRanges(chunk):
+      callStartTime = timeit.default_timer()
+      self.logic.runImageProcessingConnector(self.inputVolumeNode, self.boneEnhancedImage, self.paramsVTK, self.name, firstSlice, lastSlice)
+      if self.instrumentation:
+        self.logic.addCppInstrumentation(self.instrumentation, callStartTime)
+    return len(chunk)
+
+  def onTimeout(self):
+    numberOfNewSlices = 0
+    if self.thread:
+      finished = not self.thread.is_alive()
+      while True:
+        try:
+          numberOfNewSlices += self.processedSlices.get_nowait()
+        except queue.Empty:
+          break
+    else:
+      numberOfNewSlices = self.processNextSlicesCpp()
+      finished = self.cancelled or self.numberOfProcessedSlices + numberOfNewSlices >= len(self.sliceIndices)
+
+    # Publish the finished slices
+    if numberOfNewSlices > 0:
+      if self.sliceTracker:
+        self.sliceTracker.markComputed(self.staleKeys, self.sliceIndices[self.numberOfProcessedSlices:self.numberOfProcessedSlices + numberOfNewSlices])
+      self.numberOfProcessedSlices += numberOfNewSlices
+      self.logic.publishOutput(self.boneEnhancedImage)
+      if self.progressCallback:
+        self.progressCallback(self.numberOfProcessedSlices, len(self.sliceIndices), self.getRuntime())
+
+    if finished:
+      self.timer.stop()
+      if self.error:
+        logging.error('Extracting BSP failed: ' + str(self.error))
+      completed = not self.cancelled and self.error is None
+      message = str(round(self.getRuntime(), 3)) + ' s.'
+      logging.info('Extracting BSP ' + ('completed' if completed else 'stopped') + ' (' + message + ')')
+      if self.instrumentation and self.thread:
+        self.instrumentation.addForoughi2007Times(self.stageTimes, self.sliceTimes)
+      self.logic.finishInstrumentation(self.instrumentation)
+      if self.finishedCallback:
+        self.finishedCallback(completed, self.getRuntime())
+
+############################################################ PreviewPipeline
+# Computes the BSP of a single slice for previewing parameter changes. Requests are debounced, so that a burst
+# of slider events results in one computation. The computation runs with the NumPy engine on a worker thread and
+# reuses the intermediate results of the slice that do not depend on the changed parameter (see
+# Foroughi2007.SliceCache), other algorithms compute the whole slice. A computation that is overtaken by a newer request stops at the next stage and its
+# result is dropped, then the newest request is computed.
+class PreviewPipeline:
+
+  def __init__(self, logic, delayMs=150):
+    self.logic = logic
+    self.cache = Foroughi2007.SliceCache()
+    self.generation = 0
+    self.pendingRequest = None
+    self.thread = None
+    self.result = None
+    self.debounceTimer = qt.QTimer()
+    self.debounceTimer.setSingleShot(True)
+    self.debounceTimer.setInterval(delayMs)
+    self.debounceTimer.connect('timeout()', self.startComputation)
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(20)
+    self.pollTimer.connect('timeout()', self.onPoll)
+
+  def request(self, inputVolumeNode, boneEnhancedImage, paramsVTK, name, sliceIndex):
+    self.generation += 1
+    self.pendingRequest = (self.generation, inputVolumeNode, boneEnhancedImage, self.logic.getAlgorithm(name), self.logic.getParameters(name, paramsVTK), sliceIndex)
+    self.debounceTimer.start()
+
+  def clear(self):
+    self.cancel()
+    self.cache.clear()
+
+  def cancel(self):
+    self.generation += 1
+    self.pendingRequest = None
+    self.debounceTimer.stop()
+
+  def isComputing(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  def startComputation(self):
+    # A running computation starts the pending request when it is done
+    if self.isComputing() or not self.pendingRequest:
+      return
+    generation, inputVolumeNode, boneEnhancedImage, algorithm, params, sliceIndex = self.pendingRequest
+    self.pendingRequest = None
+    inputArray = self.logic.getVolumeArray(inputVolumeNode)
+    if sliceIndex < 0 or sliceIndex >= inputArray.shape[0]:
+      return
+    self.result = None
+    def compute():
+      if algorithm is Algorithms.FOROUGHI2007:
+        bsp = self.cache.compute(sliceIndex, inputArray[sliceIndex], isCancelled=lambda: self.generation != generation, **algorithm.keywordParameters(params))
+      else:
+        bsp = algorithm.processSlice(inputArray[sliceIndex], params)
+      self.result = (generation, inputVolumeNode, boneEnhancedImage, sliceIndex, bsp)
+    self.thread = threading.Thread(target=compute)
+    self.thread.daemon = True
+    self.thread.start()
+    self.pollTimer.start()
+
+  def onPoll(self):
+    if self.isComputing():
+      return
+    self.pollTimer.stop()
+    if self.result:
+      generation, inputVolumeNode, boneEnhancedImage, sliceIndex, bsp = self.result
+      # Results of stale requests are dropped
+      if generation == self.generation and bsp is not None:
+        outputArray = self.logic.getVolumeArray(boneEnhancedImage)
+        outputArray[sliceIndex] = Foroughi2007.castToType(bsp, outputArray.dtype)
+        self.logic.invalidateSlices(boneEnhancedImage, [(sliceIndex, sliceIndex)])
+        self.logic.publishOutput(boneEnhancedImage, inputVolumeNode)
+    self.result = None
+    if self.pendingRequest and not self.debounceTimer.isActive():
+      self.startComputation()
+
+############################################################ StreamingProcessing
+# Extracts the BSP of a live frame node, e.g. a tracked US frame which an external source keeps updating. Only
+# the newest frame is processed: frames which arrive while the previous one is processed replace each other and
+# all but the last one are dropped, so the latency does not grow when processing is slower than the frame rate.
+# The NumPy engine processes frames with a preallocated pipeline of the algorithm (e.g. Foroughi2007.FramePipeline) on a persistent worker thread,
+# the C++ engine in the Qt event loop. The first slice of the input volume is the frame.
+class StreamingProcessing:
+
+  def __init__(self, logic, inputVolumeNode, boneEnhancedImage, paramsVTK, name, statisticsCallback=None, numberOfFramesForStatistics=30):
+    self.logic = logic
+    self.inputVolumeNode = inputVolumeNode
+    self.boneEnhancedImage = boneEnhancedImage
+    self.paramsVTK = paramsVTK
+    self.name = name
+    self.statisticsCallback = statisticsCallback
+    self.observerTag = None
+    self.pipeline = None
+    self.thread = None
+    self.frameReady = threading.Event()
+    self.frameDone = threading.Event()
+    self.stopped = True
+    self.processing = False
+    self.frameBuffer = None
+    self.result = None
+    self.error = None
+    # Arrival time of the newest frame which is not processed yet, None if there is none
+    self.pendingFrameTime = None
+    self.processingFrameTime = None
+    self.numberOfReceivedFrames = 0
+    self.numberOfProcessedFrames = 0
+    self.numberOfDroppedFrames = 0
+    self.publishTimes = collections.deque(maxlen=numberOfFramesForStatistics)
+    self.latencies = collections.deque(maxlen=numberOfFramesForStatistics)
+    self.processTimer = qt.QTimer()
+    self.processTimer.setSingleShot(True)
+    self.processTimer.setInterval(0)
+    self.processTimer.connect('timeout()', self.processPendingFrame)
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(2)
+    self.pollTimer.connect('timeout()', self.onPoll)
+
+  def start(self):
+    self.stopped = False
+    self.logic.copyGeometry(self.inputVolumeNode, self.boneEnhancedImage)
+    self.logic.invalidateSlices(self.boneEnhancedImage, [(0, 0)])
+    if self.logic.getEngine(self.name) == 'numpy':
+      self.thread = threading.Thread(target=self.runNumpyEngine)
+      self.thread.daemon = True
+      self.thread.start()
+    self.observerTag = self.inputVolumeNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onFrameReceived)
+    logging.info('Streaming BSP extraction started')
+
+  def stop(self):
+    if self.stopped:
+      return
+    self.stopped = True
+    if self.observerTag is not None:
+      self.inputVolumeNode.RemoveObserver(self.observerTag)
+      self.observerTag = None
+    self.processTimer.stop()
+    self.pollTimer.stop()
+    self.frameReady.set()
+    if self.thread:
+      self.thread.join()
+      self.thread = None
+    logging.info('Streaming BSP extraction stopped (' + self.getStatisticsText() + ')')
+
+  def isRunning(self):
+    return not self.stopped
+
+  def setParameters(self, paramsVTK):
+    # Used for the next frame, which the worker thread does not start before the current one is published
+    self.paramsVTK = paramsVTK
+
+  def onFrameReceived(self, caller=None, event=None):
+    self.numberOfReceivedFrames += 1
+    if self.pendingFrameTime is not None:
+      self.numberOfDroppedFrames += 1
+    self.pendingFrameTime = time.time()
+    if not self.processing:
+      self.processTimer.start()
+
+  def processPendingFrame(self):
+    if self.stopped or self.processing or self.pendingFrameTime is None:
+      return
+    self.processingFrameTime = self.pendingFrameTime
+    self.pendingFrameTime = None
+    # The source may switch to another frame size, the output follows it before anything is written into it
+    if self.logic.allocateImageData(self.inputVolumeNode, self.boneEnhancedImage, self.boneEnhancedImage.GetImageData().GetScalarType()):
+      self.logic.copyGeometry(self.inputVolumeNode, self.boneEnhancedImage)
+      self.logic.invalidateSlices(self.boneEnhancedImage, [(0, 0)])
+    try:
+      self.logic.checkOutputVolume(self.inputVolumeNode, self.boneEnhancedImage)
+    except ValueError as e:
+      logging.error('Streaming BSP extraction dropped a frame: ' + str(e))
+      self.numberOfDroppedFrames += 1
+      return
+    if self.logic.getEngine(self.name) == 'cpp':
+      self.logic.runImageProcessingConnector(self.inputVolumeNode, self.boneEnhancedImage, self.paramsVTK, self.name, 0, 0)
+      self.publishFrame()
+      return
+    # The source overwrites the frame in place, so the worker gets a copy
+    frame = self.logic.getVolumeArray(self.inputVolumeNode)[0]
+    algorithm = self.logic.getAlgorithm(self.name)
+    params = self.logic.getParameters(self.name, self.paramsVTK)
+    if self.pipeline is None or self.pipeline.shape != frame.shape or self.pipeline.dtype != Foroughi2007.realType(frame.dtype):
+      self.pipeline = algorithm.createPipeline(frame.shape, frame.dtype, params)
+      self.frameBuffer = numpy.empty_like(frame)
+    else:
+      algorithm.setPipelineParameters(self.pipeline, params)
+    numpy.copyto(self.frameBuffer, frame)
+    self.processing = True
+    self.frameDone.clear()
+    self.frameReady.set()
+    self.pollTimer.start()
+
+  # Worker thread, waits for frames and only touches NumPy arrays
+  def runNumpyEngine(self):
+    while True:
+      self.frameReady.wait()
+      self.frameReady.clear()
+      if self.stopped:
+        return
+      try:
+        self.result = self.pipeline.process(self.frameBuffer)
+      except Exception as e:
+        self.error = e
+        self.result = None
+      self.frameDone.set()
+
+  def onPoll(self):
+    if not self.frameDone.is_set():
+      return
+    self.pollTimer.stop()
+    self.processing = False
+    if self.error:
+      logging.error('Streaming BSP extraction failed: ' + str(self.error))
+      self.error = None
+    elif self.result is not None:
+      outputArray = self.logic.getVolumeArray(self.boneEnhancedImage)
+      if outputArray.shape[1:] == self.result.shape:
+        outputArray[0] = Foroughi2007.castToType(self.result, outputArray.dtype)
+    self.publishFrame()
+    if self.pendingFrameTime is not None:
+      self.processPendingFrame()
+
+  def publishFrame(self):
+    self.logic.publishOutput(self.boneEnhancedImage)
+    now = time.time()
+    self.numberOfProcessedFrames += 1
+    self.publishTimes.append(now)
+    self.latencies.append(now - self.processingFrameTime)
+    if self.statisticsCallback:
+      self.statisticsCallback(self.getFramesPerSecond(), self.getLatency(), self.numberOfDroppedFrames)
+
+  # Returns the rate of processed frames over the last numberOfFramesForStatistics frames
+  def getFramesPerSecond(self):
+    if len(self.publishTimes) < 2 or self.publishTimes[-1] == self.publishTimes[0]:
+      return 0.0
+    return (len(self.publishTimes) - 1) / (self.publishTimes[-1] - self.publishTimes[0])
+
+  # Returns the mean time from receiving a frame to publishing its BSP, over the last numberOfFramesForStatistics frames
+  def getLatency(self):
+    if not self.latencies:
+      return 0.0
+    return sum(self.latencies) / len(self.latencies)
+
+  def getStatisticsText(self):
+    return '%.1f fps, %.0f ms latency, %d of %d frames dropped' % (self.getFramesPerSecond(), 1000 * self.getLatency(), self.numberOfDroppedFrames, self.numberOfReceivedFrames)
+
+############################################################ ReplayFrameSource
+# Local stand-in for a live US source, for testing the streaming mode. Copies the slices of a (nz, ny, nx) array,
+# e.g. a recorded or synthetic sweep, one by one into a single frame volume node at a fixed frame rate, and loops.
+class ReplayFrameSource:
+
+  def __init__(self, frames, framesPerSecond=25, frameVolumeNode=None, name='ReplayedFrame'):
+    self.frames = numpy.asarray(frames)
+    self.frameIndex = 0
+    self.numberOfSentFrames = 0
+    if frameVolumeNode is None:
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(self.frames.shape[2], self.frames.shape[1], 1)
+      imageData.AllocateScalars(numpy_support.get_vtk_array_type(self.frames.dtype), 1)
+      frameVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+      frameVolumeNode.SetAndObserveImageData(imageData)
+      frameVolumeNode.SetName(slicer.mrmlScene.GenerateUniqueName(name))
+      slicer.mrmlScene.AddNode(frameVolumeNode)
+    self.frameVolumeNode = frameVolumeNode
+    self.frameArray = numpy_support.vtk_to_numpy(frameVolumeNode.GetImageData().GetPointData().GetScalars()).reshape(self.frames.shape[1:])
+    self.frameArray[:] = self.frames[0]
+    self.timer = qt.QTimer()
+    self.timer.setInterval(int(round(1000.0 / framesPerSecond)))
+    self.timer.connect('timeout()', self.sendFrame)
+
+  # Returns a source replaying a synthetic sweep, see SyntheticData.syntheticSweep
+  @staticmethod
+  def createSyntheticSweep(numberOfFrames=50, ny=280, nx=440, framesPerSecond=25):
+    return ReplayFrameSource(SyntheticData.syntheticSweep(numberOfFrames, ny, nx), framesPerSecond, name='SyntheticSweepFrame')
+
+  def start(self):
+    self.timer.start()
+
+  def stop(self):
+    self.timer.stop()
+
+  def sendFrame(self):
+    self.frameArray[:] = self.frames[self.frameIndex]
+    self.frameIndex = (self.frameIndex + 1) % self.frames.shape[0]
+    self.numberOfSentFrames += 1
+    self.frameVolumeNode.GetImageData().Modified()
+
 ############################################################ AlgorithmParams
-# Defines parameters for an algorithm through a ctkSliderWidget, a QRadioButton and a QLabel.
+# Defines parameters for an algorithm through a ctkSliderWidget, a QRadioButton and a QLabel. params maps the label of each
+# parameter to (decimals, single step, minimum, maximum, value, tool tip). fromAlgorithm generates them from the parameter
+# declarations of a registered algorithm (see BoneEnhancerPyLib/Algorithms.py).
 class AlgorithmParams:
 
-  def __init__(self, name, params):
+  def __init__(self, name, params, algorithm=None):
     self.name = name
     self.params = params
-    self.paramKeys = sorted(params.keys(), key=str.lower) # Sort keys alphabetically
+    # Without an algorithm, the registered algorithm of the name, whose parameter declarations map the labels to the parameter names
+    self.algorithm = algorithm or Algorithms.getAlgorithm(name)
+    self.parameterNames = dict((parameter.label, parameter.name) for parameter in self.algorithm.parameterDeclarations)
+    # Sorted alphabetically by parameter name, the order of the parameters given to the ImageProcessingConnector
+    self.paramKeys = sorted(params.keys(), key=lambda paramKey: self.parameterNames[paramKey])
     self.CreateRadioButton()    
     self.CreateSliders()
     self.CreateLabels()
     self.createSlidersWidget()
     self.paramChangedCallback = None
+
+  # Returns the sliders of a registered algorithm, set to values (parameter name -> value, the defaults where missing)
+  @staticmethod
+  def fromAlgorithm(algorithm, values=None):
+    values = algorithm.parameters(values)
+    params = dict((parameter.label, (parameter.decimals, parameter.step, parameter.minimum, parameter.maximum, values[parameter.name], parameter.toolTip))
+                  for parameter in algorithm.parameterDeclarations)
+    algorithmParams = AlgorithmParams(algorithm.title, params, algorithm)
+    profile = algorithm.profile
+    algorithmParams.GetRadioButton().setToolTip('%s. About %.0f%% of the time per slice of Foroughi2007%s.' % (profile.description, 100 * profile.relativeCost,
+                                                ', fast enough for streaming live frames' if profile.realTime else ''))
+    return algorithmParams
   
   def __del__(self):
     for paramKey in self.paramKeys:
@@ -406,6 +1434,10 @@ class AlgorithmParams:
       params.append(self.sliders[param].value)    
     paramsVtkDoubleArray = numpy_support.numpy_to_vtk(num_array=params, deep=True, array_type=vtk.VTK_DOUBLE)
     return paramsVtkDoubleArray
+
+  # Returns the parameters as a dictionary of parameter name -> value
+  def GetParameters(self):
+    return self.algorithm.parameters(dict((self.parameterNames[param], self.sliders[param].value) for param in self.paramKeys))
     
   def onParamChanged(self):
     if self.paramChangedCallback:
@@ -414,35 +1446,75 @@ class AlgorithmParams:
 ############################################################ BoneEnhancerPyTest
 class BoneEnhancerPyTest(ScriptedLoadableModuleTest):
 
+  # Parameters the sample volume is enhanced with by test_BSP
+  SAMPLE_PARAMETERS = {'BlurredVsBLoG' : 1, 'BoneThreshold' : 0.3, 'ShadowSigma' : 2, 'ShadowVsIntensity' : 5, 'SmoothingSigma' : 3, 'TransducerMargin' : 15}
+
   def setUp(self):
     slicer.mrmlScene.Clear(0)
     layoutManager = slicer.app.layoutManager()
     layoutManager.setLayout(1)
+    # Foroughi2007 with the default parameters, unless a test needs others
+    self.name = Algorithms.FOROUGHI2007.title
+    self.paramsVTK = self.getParamsVTK()
+
+  # Returns the parameters of Foroughi2007 in the order of the ImageProcessingConnector, the defaults unless given by name
+  def getParamsVTK(self, **params):
+    return numpy_support.numpy_to_vtk(num_array=Algorithms.FOROUGHI2007.parametersToList(params), deep=True, array_type=vtk.VTK_DOUBLE)
+
+  # Loads the sample US volume and returns its node. Returns None if it is not available (outside a source tree),
+  # and tells which test is skipped if testName is given.
+  def loadSampleVolume(self, testName=None):
+    if not os.path.exists(Benchmark.SAMPLE_DATA_PATH):
+      if testName:
+        self.delayDisplay('Sample data not found, skipping %s test' % testName)
+      return None
+    slicer.util.loadVolume(Benchmark.SAMPLE_DATA_PATH)
+    return slicer.util.getNode(pattern="US_Lumbar_SingleSlice_Double")
     
   def runTest(self):
     self.setUp()
     self.test_BSP()
+    self.setUp()
+    self.test_NumpyEngine()
+    self.setUp()
+    self.test_ShadowValue()
+    self.setUp()
+    self.test_ConvolutionPlan()
+    self.setUp()
+    self.test_BackgroundProcessing()
+    self.setUp()
+    self.test_SliceCache()
+    self.setUp()
+    self.test_NativeScalarTypes()
+    self.setUp()
+    self.test_Streaming()
+    self.setUp()
+    self.test_BoneSurface()
+    self.setUp()
+    self.test_Benchmark()
+    self.setUp()
+    self.test_Instrumentation()
+    self.setUp()
+    self.test_BatchProcessing()
+    self.setUp()
+    self.test_OutOfCore()
+    self.setUp()
+    self.test_Incremental()
+    self.setUp()
+    self.test_Algorithms()
+    self.setUp()
+    self.test_RegionOfInterest()
+    self.setUp()
+    self.test_CoarseToFine()
+    self.setUp()
+    self.test_OutputManagement()
 
   def test_BSP(self):
     self.delayDisplay("Testing BSP")
-    
-    import urllib
-    downloads = (('http://slicer.kitware.com/midas3/download/item/210901/US_Lumbar_SingleSlice_Double.mha', 
-                 'US_Lumbar_SingleSlice_Double.mha', slicer.util.loadVolume),)        
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        logging.info('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-      else:
-        self.delayDisplay('Test failed, no volume loader')
-        return
-    self.delayDisplay('Finished with download and loading')
-    volumeNode = slicer.util.getNode(pattern="US_Lumbar_SingleSlice_Double")
+
+    volumeNode = self.loadSampleVolume('BSP')
+    if not volumeNode:
+      return
  
     params = AlgorithmParams("Foroughi2007 (with minor modifications)",
               {"Smoothing Sigma" : (1, 1, 1, 10, 3, "Smoothing Sigma ToolTip"),
@@ -455,5 +1527,647 @@ class BoneEnhancerPyTest(ScriptedLoadableModuleTest):
     logic = BoneEnhancerPyLogic()
     self.assertTrue(logic.createVolumeNode(volumeNode, 'BoneEnhancedImage'))    
     self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, slicer.util.getNode('BoneEnhancedImage'), params.GetParamsVTK(), 'Foroughi2007 (with minor modifications)'))
+    bspArray = logic.getVolumeArray(slicer.util.getNode('BoneEnhancedImage'))
+    self.assertAlmostEqual(bspArray.max(), 255.0)
+    self.assertGreater(numpy.count_nonzero(bspArray), 0)
+
+    # The labels map to the parameter names of the registered algorithm, so the named parameters give the same BSP
+    self.assertEqual(params.GetParameters(), Algorithms.FOROUGHI2007.parameters(self.SAMPLE_PARAMETERS))
+    namedBoneEnhancedImage = logic.createVolumeNode(volumeNode, 'NamedBoneEnhancedImage')
+    self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, namedBoneEnhancedImage, params.GetParameters(), params.getName()))
+    self.assertTrue(numpy.array_equal(logic.getVolumeArray(namedBoneEnhancedImage), bspArray))
     self.assertTrue(logic.updateSliceViews(slicer.util.getNode('BoneEnhancedImage'), volumeNode))        
     self.delayDisplay('Testing BSP passed!')
+
+  def test_NumpyEngine(self):
+    self.delayDisplay("Testing NumPy engine")
+
+    volumeNode = self.loadSampleVolume('NumPy engine')
+    if not volumeNode:
+      return
+
+    paramsVTK = self.getParamsVTK(**self.SAMPLE_PARAMETERS)
+    logic = BoneEnhancerPyLogic()
+    inputArray = numpy.array(logic.getVolumeArray(volumeNode))
+    numpyImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImageNumpy')
+    logic.setEngine('numpy')
+    self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, numpyImage, paramsVTK, self.name))
+    numpyArray = logic.getVolumeArray(numpyImage)
+    self.assertTrue(numpy.array_equal(inputArray, logic.getVolumeArray(volumeNode)))
+    self.assertAlmostEqual(numpyArray.max(), 255.0)
+
+    if hasattr(slicer.modules, 'boneenhancercpp'):
+      cppImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImageCpp')
+      logic.setEngine('cpp')
+      self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, cppImage, paramsVTK, self.name))
+      difference = numpy.abs(numpyArray - logic.getVolumeArray(cppImage))
+      self.assertLessEqual(difference.max(), Foroughi2007.TOLERANCE)
+      # The pooled buffers are reused by the next call, and allocated again after being released
+      cppArray = numpy.array(logic.getVolumeArray(cppImage))
+      for releaseBuffers in [False, True]:
+        if releaseBuffers:
+          logic.releaseBuffers()
+        logic.getVolumeArray(cppImage)[:] = 0
+        self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, cppImage, paramsVTK, self.name))
+        self.assertTrue(numpy.array_equal(cppArray, logic.getVolumeArray(cppImage)))
+    self.delayDisplay('Testing NumPy engine passed!')
+
+  def test_ShadowValue(self):
+    self.delayDisplay("Testing shadow value runtime")
+
+    volumeNode = self.loadSampleVolume('shadow value')
+    if not volumeNode:
+      return
+    image = BoneEnhancerPyLogic().getVolumeArray(volumeNode)[0]
+    gaussian = Foroughi2007.normalize(Foroughi2007.convolveSeparable(image, Foroughi2007.gaussianKernel(5.0)), False)
+
+    # Stack the sample image to simulate deeper frames
+    for depthFactor in [1, 2, 4, 8]:
+      deepGaussian = numpy.tile(gaussian, (depthFactor, 1))
+      startTime = time.time()
+      direct = Foroughi2007.shadowValueDirect(deepGaussian, 6.0)
+      directRuntime = time.time() - startTime
+      startTime = time.time()
+      linear = Foroughi2007.shadowValue(deepGaussian, 6.0)
+      linearRuntime = time.time() - startTime
+      self.assertTrue(numpy.allclose(direct, linear, rtol=1e-9, atol=1e-12))
+      logging.info('Shadow value, depth %d: %.4f s. (direct), %.4f s. (linear), speedup %.1fx' % (deepGaussian.shape[0], directRuntime, linearRuntime, directRuntime / max(linearRuntime, 1e-9)))
+    self.delayDisplay('Testing shadow value runtime passed!')
+
+  def test_ConvolutionPlan(self):
+    self.delayDisplay("Testing convolution plan")
+    if not hasattr(slicer.modules, 'boneenhancercpp'):
+      self.delayDisplay('BoneEnhancerCpp not found, skipping convolution plan test')
+      return
+    # Neither the slices nor the kernels are square, so swapped operands or axes do not go unnoticed
+    volume = numpy.random.RandomState(3).uniform(0, 255, (3, 41, 67))
+    volumeNode = BoneEnhancerPyLogic().createVolumeNodeFromArray(volume)
+    floatVolumeNode = BoneEnhancerPyLogic().createVolumeNodeFromArray(volume.astype(numpy.float32))
+    for inputVolumeNode, tolerance in [(volumeNode, 1e-9), (floatVolumeNode, 1e-4)]:
+      inputArray = BoneEnhancerPyLogic().getVolumeArray(inputVolumeNode)
+      for smoothingSigma in [1.0, 2.5, 5.0]:
+        outputImageData = vtk.vtkImageData()
+        self.assertTrue(slicer.modules.boneenhancercpp.logic().GaussianConvolution(inputVolumeNode.GetImageData(), outputImageData, smoothingSigma))
+        self.assertEqual(outputImageData.GetDimensions(), (67, 41, 3))
+        outputArray = numpy_support.vtk_to_numpy(outputImageData.GetPointData().GetScalars()).reshape(volume.shape)
+        self.assertEqual(outputArray.dtype, inputArray.dtype)
+        for z in range(volume.shape[0]):
+          expected = Foroughi2007.convolveSeparable(inputArray[z].astype(numpy.float64), Foroughi2007.gaussianKernel(smoothingSigma))
+          self.assertTrue(numpy.allclose(outputArray[z], expected, rtol=tolerance, atol=tolerance))
+    self.delayDisplay('Testing convolution plan passed!')
+
+  def test_BackgroundProcessing(self):
+    self.delayDisplay("Testing background processing")
+
+    volumeNode = self.loadSampleVolume('background processing')
+    if not volumeNode:
+      return
+    paramsVTK = self.getParamsVTK(**self.SAMPLE_PARAMETERS)
+
+    logic = BoneEnhancerPyLogic()
+    synchronousImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImageSynchronous')
+    self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, synchronousImage, paramsVTK, self.name))
+
+    results = []
+    def onFinished(completed, runtime):
+      results.append(completed)
+    backgroundImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImageBackground')
+    logic.calculateBoneEnhancedImageAsync(volumeNode, backgroundImage, paramsVTK, self.name, finishedCallback=onFinished)
+    while logic.isProcessing():
+      slicer.app.processEvents()
+      time.sleep(0.01)
+    self.assertEqual(results, [True])
+    self.assertTrue(numpy.array_equal(logic.getVolumeArray(synchronousImage), logic.getVolumeArray(backgroundImage)))
+
+    # Cancelling before the first slice is finished
+    logic.calculateBoneEnhancedImageAsync(volumeNode, backgroundImage, paramsVTK, self.name, finishedCallback=onFinished)
+    logic.cancelProcessing()
+    while logic.isProcessing():
+      slicer.app.processEvents()
+      time.sleep(0.01)
+    self.assertEqual(results, [True, False])
+    self.delayDisplay('Testing background processing passed!')
+
+  def test_SliceCache(self):
+    self.delayDisplay("Testing preview slice cache")
+
+    volumeNode = self.loadSampleVolume('slice cache')
+    if not volumeNode:
+      return
+    image = BoneEnhancerPyLogic().getVolumeArray(volumeNode)[0]
+
+    cache = Foroughi2007.SliceCache()
+    params = {'smoothingSigma' : 5.0, 'transducerMargin' : 60, 'shadowSigma' : 6.0, 'boneThreshold' : 0.4, 'blurredVSBLoG' : 3.0, 'shadowVSIntensity' : 5.0}
+    for name, value in [(None, None), ('shadowVSIntensity', 3.0), ('boneThreshold', 0.5), ('shadowSigma', 4.0), ('smoothingSigma', 3.0)]:
+      if name:
+        params[name] = value
+      self.assertTrue(numpy.array_equal(cache.compute(0, image, **params), Foroughi2007.foroughi2007Slice(image, **params)))
+    self.assertIsNone(cache.compute(0, image, isCancelled=lambda: True, **dict(params, smoothingSigma=4.0)))
+    # Edited voxels are not hidden by the cached stages of the slice
+    editedImage = numpy.array(image)
+    editedImage[editedImage.shape[0] // 2:] *= 0.5
+    self.assertTrue(numpy.array_equal(cache.compute(0, editedImage, **params), Foroughi2007.foroughi2007Slice(editedImage, **params)))
+    self.delayDisplay('Testing preview slice cache passed!')
+
+  def test_NativeScalarTypes(self):
+    self.delayDisplay("Testing unsigned char input and output")
+
+    volumeNode = self.loadSampleVolume('scalar type')
+    if not volumeNode:
+      return
+
+    logic = BoneEnhancerPyLogic()
+    doubleImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImageDouble')
+    self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, doubleImage, self.paramsVTK, self.name))
+    doubleArray = logic.getVolumeArray(doubleImage)
+
+    # The input is rounded to unsigned char, which changes the BSP less than the rounding of the output
+    uint8Volume = logic.createVolumeNode(volumeNode, 'US_Lumbar_SingleSlice_UnsignedChar', vtk.VTK_UNSIGNED_CHAR)
+    logic.getVolumeArray(uint8Volume)[:] = numpy.clip(numpy.rint(logic.getVolumeArray(volumeNode)), 0, 255)
+    inputArray = numpy.array(logic.getVolumeArray(uint8Volume))
+    for engine in ['numpy', 'cpp']:
+      if engine == 'cpp' and not hasattr(slicer.modules, 'boneenhancercpp'):
+        continue
+      logic.setEngine(engine)
+      uint8Image = logic.createVolumeNode(volumeNode, 'BoneEnhancedImageUnsignedChar', vtk.VTK_UNSIGNED_CHAR)
+      self.assertTrue(logic.calculateBoneEnhancedImage(uint8Volume, uint8Image, self.paramsVTK, self.name))
+      # The input is neither cast nor modified
+      self.assertEqual(uint8Volume.GetImageData().GetScalarType(), vtk.VTK_UNSIGNED_CHAR)
+      self.assertTrue(numpy.array_equal(inputArray, logic.getVolumeArray(uint8Volume)))
+      uint8Array = logic.getVolumeArray(uint8Image)
+      self.assertEqual(uint8Array.dtype, numpy.uint8)
+      self.assertLessEqual(numpy.abs(uint8Array.astype(numpy.float64) - doubleArray).max(), 1.0)
+
+    # Both engines convert NaN to zero, out of range values to the limits of integer types, and normalize by the maximum without NaN
+    self.assertEqual(Foroughi2007.castToType(numpy.array([numpy.nan, -1e9, 1e9, 3.6]), numpy.int16).tolist(), [0, -32768, 32767, 4])
+    self.assertEqual(Foroughi2007.castToType(Foroughi2007.normalize(numpy.array([numpy.nan, 1.0, 4.0]), False, 255), numpy.int16).tolist(), [0, 64, 255])
+    self.assertEqual(Foroughi2007.maxPixelValue(numpy.array([numpy.nan, -1.0])), 0)
+    # A negative ShadowVsIntensity turns the BSP of the pixels without shadow into NaN
+    nanParamsVTK = self.getParamsVTK(ShadowVsIntensity=-1)
+    int16Arrays = []
+    for engine in ['numpy', 'cpp']:
+      if engine == 'cpp' and not hasattr(slicer.modules, 'boneenhancercpp'):
+        continue
+      logic.setEngine(engine)
+      int16Image = logic.createVolumeNode(volumeNode, 'BoneEnhancedImageShort', vtk.VTK_SHORT)
+      self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, int16Image, nanParamsVTK, self.name))
+      int16Arrays.append(numpy.array(logic.getVolumeArray(int16Image)))
+      self.assertEqual(int16Arrays[-1].min(), 0)
+    if len(int16Arrays) == 2:
+      self.assertLessEqual(numpy.abs(int16Arrays[0].astype(numpy.int32) - int16Arrays[1]).max(), 1)
+    self.delayDisplay('Testing unsigned char input and output passed!')
+
+  def test_Streaming(self):
+    self.delayDisplay("Testing streaming")
+
+    # The sample image is replayed if available, otherwise a synthetic sweep
+    logic = BoneEnhancerPyLogic()
+    volumeNode = self.loadSampleVolume()
+    if volumeNode:
+      frames = numpy.array(logic.getVolumeArray(volumeNode))
+    else:
+      frames = SyntheticData.syntheticSweep(10)
+    params = {'smoothingSigma' : 5.0, 'transducerMargin' : 60, 'shadowSigma' : 6.0, 'boneThreshold' : 0.4, 'blurredVSBLoG' : 3.0, 'shadowVSIntensity' : 5.0}
+
+    # The preallocated pipeline computes the same BSP as foroughi2007Slice, also after a parameter change
+    pipeline = Foroughi2007.FramePipeline(frames.shape[1:], frames.dtype, **params)
+    for name, value in [(None, None), ('shadowSigma', 4.0), ('smoothingSigma', 3.0)]:
+      if name:
+        params[name] = value
+        pipeline.setParameters(**params)
+      self.assertTrue(numpy.array_equal(pipeline.process(frames[-1]), Foroughi2007.foroughi2007Slice(frames[-1], **params)))
+
+    logic.setEngine('numpy')
+    source = ReplayFrameSource(frames, framesPerSecond=30)
+    boneEnhancedImage = logic.createVolumeNode(source.frameVolumeNode, 'BoneEnhancedImageStreaming')
+    streaming = logic.startStreaming(source.frameVolumeNode, boneEnhancedImage, self.paramsVTK, self.name)
+    source.start()
+    startTime = time.time()
+    while time.time() - startTime < 2.0:
+      slicer.app.processEvents()
+      time.sleep(0.001)
+    source.stop()
+    # Let the last frame be published
+    while streaming.processing or streaming.pendingFrameTime is not None:
+      slicer.app.processEvents()
+      time.sleep(0.001)
+    logic.stopStreaming()
+    self.assertFalse(logic.isStreaming())
+    self.delayDisplay(streaming.getStatisticsText())
+
+    # Every frame is either processed or dropped
+    self.assertGreater(streaming.numberOfProcessedFrames, 0)
+    self.assertEqual(streaming.numberOfProcessedFrames + streaming.numberOfDroppedFrames, streaming.numberOfReceivedFrames)
+    self.assertGreater(streaming.getLatency(), 0)
+    lastFrame = frames[(source.frameIndex - 1) % frames.shape[0]]
+    expected = Foroughi2007.foroughi2007Slice(lastFrame, **dict(params, shadowSigma=6.0, smoothingSigma=5.0))
+    self.assertLessEqual(numpy.abs(logic.getVolumeArray(boneEnhancedImage)[0] - expected).max(), Foroughi2007.TOLERANCE)
+
+    # The output and the pipeline follow a source which switches to another frame size
+    smallFrame = numpy.ascontiguousarray(lastFrame[:-10, :lastFrame.shape[1] // 2])
+    expected = Foroughi2007.foroughi2007Slice(smallFrame, **dict(params, shadowSigma=6.0, smoothingSigma=5.0))
+    engines = ['numpy', 'cpp'] if hasattr(slicer.modules, 'boneenhancercpp') else ['numpy']
+    for engine in engines:
+      logic.setEngine(engine)
+      frameVolumeNode = logic.createVolumeNodeFromArray(lastFrame[numpy.newaxis], 'Frame')
+      boneEnhancedImage = logic.createVolumeNode(frameVolumeNode, 'BoneEnhancedImageStreaming')
+      streaming = logic.startStreaming(frameVolumeNode, boneEnhancedImage, self.paramsVTK, self.name)
+      frameVolumeNode.SetAndObserveImageData(logic.createVolumeNodeFromArray(smallFrame[numpy.newaxis]).GetImageData())
+      while streaming.processing or streaming.pendingFrameTime is not None:
+        slicer.app.processEvents()
+        time.sleep(0.001)
+      logic.stopStreaming()
+      self.assertEqual(streaming.numberOfProcessedFrames, 1)
+      self.assertEqual(logic.getVolumeArray(boneEnhancedImage).shape, (1,) + smallFrame.shape)
+      self.assertLessEqual(numpy.abs(logic.getVolumeArray(boneEnhancedImage)[0] - expected).max(), Foroughi2007.TOLERANCE)
+    self.delayDisplay('Testing streaming passed!')
+
+  def test_BoneSurface(self):
+    self.delayDisplay("Testing bone surface extraction")
+
+    volumeNode = self.loadSampleVolume('bone surface')
+    if not volumeNode:
+      return
+
+    logic = BoneEnhancerPyLogic()
+    logic.setEngine('numpy')
+    boneEnhancedImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImage')
+    self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, boneEnhancedImage, self.paramsVTK, self.name))
+    surface, labelVolumeNode = logic.extractBoneSurface(boneEnhancedImage)
+    bspArray = logic.getVolumeArray(boneEnhancedImage)
+
+    # The vectorized paths are the ones of the direct dynamic programming
+    cost = SurfaceExtraction.internalCost(bspArray)
+    paths = SurfaceExtraction.optimalPaths(cost)
+    self.assertTrue(numpy.array_equal(paths, SurfaceExtraction.optimalPathsDirect(cost)))
+    self.assertLessEqual(numpy.abs(numpy.diff(paths, axis=1)).max(), SurfaceExtraction.DEFAULT_MAXIMUM_JUMP)
+
+    # Bone is found in part of the columns, on pixels with high BSP, below the transducer margin
+    boneColumns = numpy.nonzero(surface[0] >= 0)[0]
+    self.assertGreater(len(boneColumns), 0)
+    self.assertLess(len(boneColumns), surface.shape[1])
+    self.assertTrue(numpy.array_equal(surface[0, boneColumns], paths[0, boneColumns]))
+    self.assertTrue((bspArray[0, surface[0, boneColumns], boneColumns] >= SurfaceExtraction.DEFAULT_MINIMUM_BSP).all())
+    self.assertGreater(surface[0, boneColumns].min(), 60)
+
+    # The label volume marks exactly one pixel per bone column
+    labelArray = logic.getVolumeArray(labelVolumeNode)
+    self.assertEqual(labelVolumeNode.GetImageData().GetScalarType(), vtk.VTK_UNSIGNED_CHAR)
+    self.assertEqual(labelArray.sum(), len(boneColumns))
+    self.assertTrue((labelArray[0, surface[0, boneColumns], boneColumns] == 1).all())
+
+    # On a synthetic sweep the surface is found where it was placed
+    sweep = SyntheticData.syntheticSweep(10)
+    found = SurfaceExtraction.boneSurface(Foroughi2007.foroughi2007(sweep))
+    expected = SyntheticData.syntheticSurface(10, sweep.shape[1], sweep.shape[2])
+    self.assertLessEqual(numpy.median(numpy.abs(found[found >= 0] - expected[found >= 0])), 2)
+    self.delayDisplay('Testing bone surface extraction passed!')
+
+  def test_Benchmark(self):
+    self.delayDisplay("Testing benchmark")
+
+    logic = BoneEnhancerPyLogic()
+    filePath = os.path.join(slicer.app.temporaryPath, 'BoneEnhancerBenchmark.json')
+    results, regressions = logic.runBenchmark(sizes=[(2, 64, 96)], threadCounts=[1, 2], repetitions=1, outputFilePath=filePath)
+    self.assertEqual(regressions, [])
+    engines = ['numpy', 'cpp'] if hasattr(slicer.modules, 'boneenhancercpp') else ['numpy']
+    datasets = 2 if os.path.exists(Benchmark.SAMPLE_DATA_PATH) else 1
+    self.assertEqual(len(results['results']), datasets * len(engines) * 2)
+    for result in results['results']:
+      self.assertGreater(result['total']['median'], 0)
+      if result['engine'] == 'numpy':
+        self.assertEqual(sorted(result['stages'].keys()), sorted(Foroughi2007.STAGE_NAMES))
+
+    # Comparing with the same results finds no regression, comparing with a twice as fast baseline finds every total slower
+    baseline = Benchmark.readResults(filePath)
+    self.assertEqual(Benchmark.compareResults(results, baseline), [])
+    for result in baseline['results']:
+      result['total']['median'] /= 2
+    regressions = Benchmark.compareResults(results, baseline, minimumDifference=0)
+    self.assertEqual(len([regression for regression in regressions if regression['metric'] == 'total']), len(results['results']))
+    self.delayDisplay('Testing benchmark passed!')
+
+  def test_Instrumentation(self):
+    self.delayDisplay("Testing instrumentation")
+
+    logic = BoneEnhancerPyLogic()
+    # The third slice is all zero and skipped
+    sweep = SyntheticData.syntheticSweep(4, 128, 96)
+    sweep[2] = 0
+    volumeNode = logic.createVolumeNodeFromArray(sweep, 'Sweep')
+    logFilePath = os.path.join(slicer.app.temporaryPath, 'BoneEnhancerInstrumentation.jsonl')
+    if os.path.exists(logFilePath):
+      os.remove(logFilePath)
+
+    engines = ['numpy', 'cpp'] if hasattr(slicer.modules, 'boneenhancercpp') else ['numpy']
+    for engine in engines:
+      logic.setEngine(engine)
+      boneEnhancedImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImage')
+      # Nothing is collected while instrumentation is disabled
+      logic.setInstrumentationEnabled(False)
+      previousInstrumentation = logic.getInstrumentation()
+      self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, boneEnhancedImage, self.paramsVTK, self.name))
+      expectedArray = numpy.array(logic.getVolumeArray(boneEnhancedImage))
+      self.assertIs(logic.getInstrumentation(), previousInstrumentation)
+
+      logic.setInstrumentationEnabled(True, logFilePath)
+      self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, boneEnhancedImage, self.paramsVTK, self.name))
+      self.assertTrue(numpy.array_equal(expectedArray, logic.getVolumeArray(boneEnhancedImage)))
+      instrumentation = logic.getInstrumentation()
+      self.assertEqual(instrumentation.engine, engine)
+      self.assertEqual(sorted(sliceTime.sliceIndex for sliceTime in instrumentation.sliceTimes), [0, 1, 2, 3])
+      self.assertEqual([sliceTime.sliceIndex for sliceTime in instrumentation.sliceTimes if sliceTime.skipped], [2])
+      self.assertEqual(instrumentation.numberOfSkippedSlices, 1)
+      self.assertGreaterEqual(instrumentation.numberOfThreads, 1)
+      self.assertGreater(instrumentation.stageTimes['gaussian'], 0)
+      self.assertEqual(sorted(instrumentation.stageTimes.keys()), sorted(Foroughi2007.STAGE_NAMES))
+      logic.setInstrumentationEnabled(False)
+      self.assertIsNone(logic.startInstrumentation(self.name))
+
+    # One JSON line per instrumented extraction, and a trace event for each extraction and slice
+    import json
+    with open(logFilePath) as f:
+      records = [json.loads(line) for line in f]
+    self.assertEqual([record['engine'] for record in records], engines)
+    traceFilePath = os.path.join(slicer.app.temporaryPath, 'BoneEnhancerInstrumentation.json')
+    logic.writeInstrumentationTrace(traceFilePath)
+    with open(traceFilePath) as f:
+      self.assertEqual(len(json.load(f)['traceEvents']), 5 * len(engines))
+    self.delayDisplay('Testing instrumentation passed!')
+
+  def test_BatchProcessing(self):
+    self.delayDisplay("Testing batch processing")
+
+    directory = os.path.join(slicer.app.temporaryPath, 'BoneEnhancerBatch')
+    inputDirectory = os.path.join(directory, 'Input')
+    if not os.path.isdir(inputDirectory):
+      os.makedirs(inputDirectory)
+    sweep = SyntheticData.syntheticSweep(3, 128, 96)
+    sweep[1] = 0
+    inputFilePaths = []
+    for extension in ['.mha', '.nrrd']:
+      inputFilePaths.append(os.path.join(inputDirectory, 'Sweep' + extension))
+      with ImageIO.ImageWriter(inputFilePaths[-1], sweep.shape, sweep.dtype) as writer:
+        for image in sweep:
+          writer.writeSlice(image)
+
+    # The parameters and the output type are read from the keys the widget writes
+    settingsFilePath = os.path.join(directory, 'Slicer.ini')
+    with open(settingsFilePath, 'w') as f:
+      f.write('[BoneEnhancerPy]\n')
+      for name, value in sorted(self.SAMPLE_PARAMETERS.items()):
+        f.write('Foroughi2007\\%s=%s\n' % (name, value))
+      f.write('OutputScalarType=unsigned char\n')
+    params, outputTypeName = BatchProcessing.readSettings(settingsFilePath)
+    self.assertEqual(params['SmoothingSigma'], 3)
+    self.assertEqual(outputTypeName, 'unsigned char')
+
+    outputDirectory = os.path.join(directory, 'Output')
+    results = BatchProcessing.processFiles(inputFilePaths + [os.path.join(inputDirectory, 'Missing.mha')], outputDirectory, params,
+                                           BatchProcessing.OUTPUT_TYPES[outputTypeName], numberOfProcesses=1)
+    self.assertEqual(len(results), 3)
+    self.assertIsNotNone(results[-1]['error'])
+    expectedArray = Foroughi2007.foroughi2007(sweep, outputVolume=numpy.zeros(sweep.shape, dtype=numpy.uint8), **Foroughi2007.keywordParameters(params))
+    for result in results[:2]:
+      self.assertIsNone(result['error'])
+      self.assertEqual(result['numberOfSkippedSlices'], 1)
+      outputArray = ImageIO.readImage(result['output'])[0]
+      self.assertEqual(outputArray.dtype, numpy.uint8)
+      self.assertTrue(numpy.array_equal(expectedArray, outputArray))
+    self.delayDisplay('Testing batch processing passed!')
+
+  def test_OutOfCore(self):
+    self.delayDisplay("Testing out-of-core processing")
+
+    directory = os.path.join(slicer.app.temporaryPath, 'BoneEnhancerOutOfCore')
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    sweep = SyntheticData.syntheticSweep(7, 128, 96)
+    sweep[3] = 0
+    expectedArray = Foroughi2007.foroughi2007(sweep)
+
+    # A .raw input needs its shape and type, a MetaImage has them in its header
+    rawFilePath = os.path.join(directory, 'Sweep.raw')
+    sweep.tofile(rawFilePath)
+    self.assertRaises(ValueError, ImageIO.MemoryMappedImage, rawFilePath)
+    metaImageFilePath = os.path.join(directory, 'Sweep.mha')
+    with ImageIO.ImageWriter(metaImageFilePath, sweep.shape, sweep.dtype) as writer:
+      for image in sweep:
+        writer.writeSlice(image)
+    self.assertTrue(ImageIO.isUncompressed(metaImageFilePath))
+
+    # Slabs of 3 slices, the last one is shorter
+    self.assertEqual(OutOfCore.slabRanges(7, 3), [(0, 2), (3, 5), (6, 6)])
+    for inputFilePath, outputFilePath in [(rawFilePath, os.path.join(directory, 'Sweep_BSP.raw')), (metaImageFilePath, os.path.join(directory, 'Sweep_BSP.mha'))]:
+      progress = []
+      result = OutOfCore.foroughi2007OutOfCore(inputFilePath, outputFilePath, slabSize=3, inputShape=sweep.shape, inputType=sweep.dtype, progressCallback=progress.append)
+      self.assertEqual(progress, [3, 6, 7])
+      self.assertEqual(result['numberOfSkippedSlices'], 1)
+      outputArray = ImageIO.MemoryMappedImage(outputFilePath, sweep.shape, numpy.float64).slab(0, sweep.shape[0] - 1)
+      self.assertTrue(numpy.array_equal(expectedArray, outputArray))
+      del outputArray
+    self.delayDisplay('Testing out-of-core processing passed!')
+
+  def test_Incremental(self):
+    self.delayDisplay("Testing incremental extraction")
+    logic = BoneEnhancerPyLogic()
+    otherParamsVTK = self.getParamsVTK(BoneThreshold=0.3)
+    sweep = SyntheticData.syntheticSweep(12, 128, 96)
+    params = Algorithms.FOROUGHI2007.keywordParameters(logic.getParameters(self.name, self.paramsVTK))
+
+    engines = ['numpy', 'cpp'] if hasattr(slicer.modules, 'boneenhancercpp') else ['numpy']
+    for engine in engines:
+      logic.setEngine(engine)
+      volumeNode = logic.createVolumeNodeFromArray(sweep[:8], 'Sweep')
+      boneEnhancedImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImage')
+      self.assertEqual(logic.calculateBoneEnhancedImageIncremental(volumeNode, boneEnhancedImage, self.paramsVTK, self.name), [(0, 7)])
+      self.assertEqual(logic.calculateBoneEnhancedImageIncremental(volumeNode, boneEnhancedImage, self.paramsVTK, self.name), [])
+
+      # Edited frames, one of which becomes all zero, are the only ones recomputed
+      inputArray = logic.getVolumeArray(volumeNode)
+      inputArray[2] = inputArray[2] // 2
+      inputArray[5] = 0
+      self.assertEqual(logic.getStaleSliceRanges(volumeNode, boneEnhancedImage, self.paramsVTK, self.name), [(2, 2), (5, 5)])
+      self.assertEqual(logic.calculateBoneEnhancedImageIncremental(volumeNode, boneEnhancedImage, self.paramsVTK, self.name), [(2, 2), (5, 5)])
+      expectedArray = Foroughi2007.foroughi2007(inputArray, **params)
+      self.assertTrue(numpy.allclose(expectedArray, logic.getVolumeArray(boneEnhancedImage), atol=Foroughi2007.TOLERANCE))
+
+      # New parameters only for the given non-contiguous ranges, and a full extraction makes its slices stale
+      self.assertEqual(logic.calculateBoneEnhancedImageIncremental(volumeNode, boneEnhancedImage, otherParamsVTK, self.name, [(0, 1), (6, 9)]), [(0, 1), (6, 7)])
+      self.assertEqual(logic.getStaleSliceRanges(volumeNode, boneEnhancedImage, self.paramsVTK, self.name), [(0, 1), (6, 7)])
+      self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, boneEnhancedImage, self.paramsVTK, self.name, firstSlice=3, lastSlice=3))
+      self.assertEqual(logic.calculateBoneEnhancedImageIncremental(volumeNode, boneEnhancedImage, self.paramsVTK, self.name), [(0, 1), (3, 3), (6, 7)])
+      self.assertTrue(numpy.allclose(expectedArray, logic.getVolumeArray(boneEnhancedImage), atol=Foroughi2007.TOLERANCE))
+
+      # A grown sweep only computes the appended frames
+      grownSweep = numpy.concatenate([inputArray, sweep[8:]])
+      volumeNode.SetAndObserveImageData(logic.createVolumeNodeFromArray(grownSweep).GetImageData())
+      self.assertTrue(logic.allocateImageData(volumeNode, boneEnhancedImage, vtk.VTK_DOUBLE))
+      self.assertEqual(logic.calculateBoneEnhancedImageIncremental(volumeNode, boneEnhancedImage, self.paramsVTK, self.name), [(8, 11)])
+      expectedArray = Foroughi2007.foroughi2007(grownSweep, **params)
+      self.assertTrue(numpy.allclose(expectedArray, logic.getVolumeArray(boneEnhancedImage), atol=Foroughi2007.TOLERANCE))
+
+      # In the background, only the invalidated slices
+      logic.invalidateSlices(boneEnhancedImage, [(4, 4), (10, 10)])
+      processing = logic.calculateBoneEnhancedImageAsync(volumeNode, boneEnhancedImage, self.paramsVTK, self.name, incremental=True)
+      self.assertEqual(processing.sliceIndices, [4, 10])
+      while logic.isProcessing():
+        slicer.app.processEvents()
+        time.sleep(0.01)
+      self.assertEqual(logic.getStaleSliceRanges(volumeNode, boneEnhancedImage, self.paramsVTK, self.name), [])
+      self.assertTrue(numpy.allclose(expectedArray, logic.getVolumeArray(boneEnhancedImage), atol=Foroughi2007.TOLERANCE))
+    self.delayDisplay('Testing incremental extraction passed!')
+
+  def test_Algorithms(self):
+    self.delayDisplay("Testing algorithms")
+    logic = BoneEnhancerPyLogic()
+    self.assertEqual([algorithm.name for algorithm in Algorithms.getAlgorithms()][:2], ['Foroughi2007', 'FastShadow'])
+    self.assertIs(logic.getAlgorithm('Foroughi2007 (with minor modifications)'), Algorithms.FOROUGHI2007)
+    self.assertEqual(Algorithms.FOROUGHI2007.getParameterNames(), ['BlurredVsBLoG', 'BoneThreshold', 'ShadowSigma', 'ShadowVsIntensity', 'SmoothingSigma', 'TransducerMargin'])
+    self.assertRaises(ValueError, logic.getAlgorithm, 'Example Algorithm')
+    self.assertRaises(ValueError, Algorithms.FAST_SHADOW.parameters, {'ShadowSigma' : 6})
+
+    # The generated sliders give the parameters in the order of the ImageProcessingConnector
+    params = AlgorithmParams.fromAlgorithm(Algorithms.FOROUGHI2007, {'TransducerMargin' : 15, 'BoneThreshold' : 0.3})
+    self.assertEqual([params.GetParamsVTK().GetValue(i) for i in range(6)], [3, 0.3, 6, 5, 5, 15])
+    self.assertEqual(params.GetParameters(), Algorithms.FOROUGHI2007.parameters({'TransducerMargin' : 15, 'BoneThreshold' : 0.3}))
+
+    sweep = SyntheticData.syntheticSweep(6, 128, 96)
+    volumeNode = logic.createVolumeNodeFromArray(sweep, 'Sweep')
+    boneEnhancedImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImage')
+    fastShadow = AlgorithmParams.fromAlgorithm(Algorithms.FAST_SHADOW, {'ShadowOffset' : 8})
+    fastShadowParams = Algorithms.FAST_SHADOW.keywordParameters(fastShadow.GetParameters())
+    expectedArray = FastShadow.fastShadow(sweep, **fastShadowParams)
+    foroughi2007Array = Foroughi2007.foroughi2007(sweep, **Foroughi2007.keywordParameters(params.GetParameters()))
+    engines = ['numpy', 'cpp'] if hasattr(slicer.modules, 'boneenhancercpp') else ['numpy']
+    for engine in engines:
+      # FastShadow has no C++ implementation, it always runs with the NumPy engine
+      logic.setEngine(engine)
+      self.assertEqual(logic.getEngine(fastShadow.getName()), 'numpy')
+      self.assertEqual(logic.getEngine(params.getName()), engine)
+      logic.getVolumeArray(boneEnhancedImage)[:] = 0
+      self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, boneEnhancedImage, fastShadow.GetParameters(), fastShadow.getName()))
+      self.assertTrue(numpy.allclose(expectedArray, logic.getVolumeArray(boneEnhancedImage), atol=Foroughi2007.TOLERANCE))
+      # The widget passes named parameters, they are only put in the order of the ImageProcessingConnector for the C++ engine
+      self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, boneEnhancedImage, params.GetParameters(), params.getName()))
+      self.assertTrue(numpy.allclose(foroughi2007Array, logic.getVolumeArray(boneEnhancedImage), atol=Foroughi2007.TOLERANCE))
+
+    # The C++ logic still accepts the former title of Foroughi2007, and fails for unknown algorithms
+    if hasattr(slicer.modules, 'boneenhancercpp'):
+      cppLogic = slicer.modules.boneenhancercpp.logic()
+      logic.getVolumeArray(boneEnhancedImage)[:] = 0
+      self.assertGreaterEqual(cppLogic.ImageProcessingConnector(volumeNode, boneEnhancedImage, params.GetParamsVTK(), params.getName(), -1, -1), 0)
+      self.assertTrue(numpy.allclose(foroughi2007Array, logic.getVolumeArray(boneEnhancedImage), atol=Foroughi2007.TOLERANCE))
+      self.assertEqual(cppLogic.ImageProcessingConnector(volumeNode, boneEnhancedImage, params.GetParamsVTK(), 'Example Algorithm', -1, -1), -1)
+
+    # Changing the algorithm makes every slice stale
+    self.assertEqual(logic.calculateBoneEnhancedImageIncremental(volumeNode, boneEnhancedImage, fastShadow.GetParameters(), fastShadow.getName()), [(0, 5)])
+    self.assertEqual(logic.getStaleSliceRanges(volumeNode, boneEnhancedImage, fastShadow.GetParameters(), fastShadow.getName()), [])
+    self.assertEqual(logic.getStaleSliceRanges(volumeNode, boneEnhancedImage, params.GetParamsVTK(), params.getName()), [(0, 5)])
+
+    # The cheaper algorithm finds the bone surface close to Foroughi2007's
+    surface = SurfaceExtraction.boneSurface(expectedArray)
+    referenceSurface = SurfaceExtraction.boneSurface(foroughi2007Array)
+    found = (surface >= 0) & (referenceSurface >= 0)
+    self.assertGreater(found.sum(), 0)
+    self.assertLessEqual(numpy.median(numpy.abs(surface[found] - referenceSurface[found])), 3)
+    self.delayDisplay('Testing algorithms passed!')
+
+  def test_RegionOfInterest(self):
+    self.delayDisplay("Testing region of interest")
+    logic = BoneEnhancerPyLogic()
+    params = AlgorithmParams.fromAlgorithm(Algorithms.FOROUGHI2007, {'TransducerMargin' : 40})
+    sweep = SyntheticData.syntheticSweep(6, 128, 96)
+    volumeNode = logic.createVolumeNodeFromArray(sweep, 'Sweep')
+    boneEnhancedImage = logic.createVolumeNode(volumeNode, 'BoneEnhancedImage')
+    self.assertEqual(logic.getROIBox(volumeNode, ((-5, 2), (10, None), None)), ((0, 2), (10, 127), (0, 95)))
+    self.assertRaises(ValueError, logic.getROIBox, volumeNode, ((6, 9), None, None))
+
+    # An ROI node selects the voxels whose centers are inside it, the volume has an identity IJK to RAS matrix
+    roiNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsROINode')
+    roiNode.SetXYZ(50, 40, 2)
+    roiNode.SetRadiusXYZ(20, 10, 1.5)
+    self.assertEqual(logic.getROIBox(volumeNode, roiNode), ((1, 3), (30, 50), (30, 70)))
+
+    engines = ['numpy', 'cpp'] if hasattr(slicer.modules, 'boneenhancercpp') else ['numpy']
+    for engine in engines:
+      logic.setEngine(engine)
+      box = ((1, 4), (10, None), (8, 87))
+      logic.getVolumeArray(boneEnhancedImage)[:] = 1
+      self.assertEqual(logic.calculateBoneEnhancedImageROI(volumeNode, boneEnhancedImage, params.GetParamsVTK(), params.getName(), box), ((1, 4), (10, 127), (8, 87)))
+      outputArray = logic.getVolumeArray(boneEnhancedImage)
+      expectedArray = numpy.zeros(sweep.shape)
+      region = RegionOfInterest.boxSlices(((1, 4), (10, 127), (8, 87)))
+      expectedArray[region] = Foroughi2007.foroughi2007(sweep[region], **Foroughi2007.keywordParameters(dict(params.GetParameters(), TransducerMargin=30)))
+      self.assertTrue(numpy.allclose(expectedArray, outputArray, atol=Foroughi2007.TOLERANCE))
+      # Rows further above the transducer margin than the Gaussian kernel do not change the BSP
+      self.assertTrue(logic.calculateBoneEnhancedImageROI(volumeNode, boneEnhancedImage, params.GetParamsVTK(), params.getName(), (None, (10, None), None)))
+      self.assertTrue(numpy.allclose(Foroughi2007.foroughi2007(sweep, **Foroughi2007.keywordParameters(params.GetParameters())), outputArray, atol=Foroughi2007.TOLERANCE))
+    self.delayDisplay('Testing region of interest passed!')
+
+  def test_CoarseToFine(self):
+    self.delayDisplay("Testing coarse-to-fine extraction")
+    sweep = SyntheticData.syntheticSweep(4, 280, 440)
+    params = Algorithms.FOROUGHI2007.parameters()
+    fullResolution = Foroughi2007.foroughi2007(sweep, **Foroughi2007.keywordParameters(params))
+    self.assertTrue(numpy.array_equal(CoarseToFine.foroughi2007CoarseToFine(sweep, downsamplingFactor=1, **Foroughi2007.keywordParameters(params)), fullResolution))
+    self.assertEqual(CoarseToFine.coarseToFineSlice(numpy.zeros((64, 64)), **Foroughi2007.keywordParameters(params)).max(), 0)
+
+    # The bone surface is the same, the BSP differs slightly
+    result = CoarseToFine.compare(sweep, params, repetitions=1)
+    logging.info('Coarse-to-fine: %.2fx speedup, mean BSP difference %.3f' % (result['speedup'], result['meanAbsoluteDifference']))
+    self.assertLess(result['meanAbsoluteDifference'], 1.0)
+    self.assertGreaterEqual(result['numberOfAgreeingSurfaceColumns'], 0.95 * result['numberOfSurfaceColumns'])
+
+    # Registered as an algorithm, with a pipeline for streaming
+    algorithm = Algorithms.getAlgorithm('Foroughi2007CoarseToFine')
+    pipeline = algorithm.createPipeline(sweep.shape[1:], sweep.dtype, {})
+    self.assertTrue(numpy.allclose(pipeline.process(sweep[1]), algorithm.process(sweep, {})[1]))
+    self.delayDisplay('Testing coarse-to-fine extraction passed!')
+
+  def test_OutputManagement(self):
+    self.delayDisplay("Testing output management")
+    logic = BoneEnhancerPyLogic()
+    logic.setEngine('numpy')
+    params = AlgorithmParams.fromAlgorithm(Algorithms.FOROUGHI2007, {})
+    sweep = SyntheticData.syntheticSweep(3, 96, 64)
+    volumeNode = logic.createVolumeNodeFromArray(sweep, 'Sweep')
+    self.assertIsNone(logic.getOutputArray(volumeNode))
+
+    # The output is bound to the input, renaming it does not create another one, and its image data is reused
+    boneEnhancedImage = logic.getOutputVolume(volumeNode)
+    imageData = boneEnhancedImage.GetImageData()
+    boneEnhancedImage.SetName('Renamed')
+    self.assertIs(logic.getOutputVolume(volumeNode), boneEnhancedImage)
+    self.assertIs(boneEnhancedImage.GetImageData(), imageData)
+    self.assertIsNot(logic.getOutputVolume(volumeNode, vtk.VTK_FLOAT).GetImageData(), imageData)
+    self.assertEqual(boneEnhancedImage.GetImageData().GetScalarType(), vtk.VTK_FLOAT)
+    otherVolumeNode = logic.createVolumeNodeFromArray(sweep[:2], 'Sweep')
+    self.assertIsNot(logic.getOutputVolume(otherVolumeNode), boneEnhancedImage)
+
+    # The whole volume is published with a single ModifiedEvent, into memory the NumPy view shares
+    outputArray = logic.getOutputArray(volumeNode)
+    modifiedEvents = []
+    observer = boneEnhancedImage.AddObserver(vtk.vtkCommand.ModifiedEvent, lambda caller, event: modifiedEvents.append(event))
+    self.assertTrue(logic.calculateBoneEnhancedImage(volumeNode, boneEnhancedImage, params.GetParamsVTK(), params.getName()))
+    boneEnhancedImage.RemoveObserver(observer)
+    self.assertEqual(len(modifiedEvents), 1)
+    self.assertTrue(numpy.allclose(outputArray, Foroughi2007.foroughi2007(sweep, **Foroughi2007.keywordParameters(params.GetParameters())), atol=Foroughi2007.TOLERANCE))
+    self.assertTrue(numpy.shares_memory(outputArray, logic.getVolumeArray(boneEnhancedImage)))
+
+    # Outputs which do not match the input are not written, removed outputs are recreated
+    self.assertRaises(ValueError, logic.calculateBoneEnhancedImage, otherVolumeNode, boneEnhancedImage, params.GetParamsVTK(), params.getName())
+    slicer.mrmlScene.RemoveNode(boneEnhancedImage)
+    self.assertIsNone(logic.getOutputArray(volumeNode))
+    self.assertIsNotNone(logic.getOutputVolume(volumeNode).GetScene())
+
+    # The label volume of the bone surface is bound to the input in the same way
+    labelVolumeNode = logic.getSurfaceVolume(volumeNode)
+    self.assertTrue(labelVolumeNode.IsA('vtkMRMLLabelMapVolumeNode'))
+    labelVolumeNode.SetName('RenamedSurface')
+    self.assertIs(logic.getSurfaceVolume(volumeNode), labelVolumeNode)
+    self.assertIsNot(logic.getSurfaceVolume(otherVolumeNode), labelVolumeNode)
+    surface, surfaceVolumeNode = logic.extractBoneSurface(logic.getOutputVolume(volumeNode), labelVolumeNode)
+    self.assertIs(surfaceVolumeNode, labelVolumeNode)
+    self.assertEqual(logic.getVolumeArray(labelVolumeNode).shape, sweep.shape)
+    self.delayDisplay('Testing output management passed!')
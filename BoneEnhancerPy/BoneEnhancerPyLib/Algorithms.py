@@ -0,0 +1,168 @@
+"""
+Registry of the bone enhancement algorithms.
+
+Each Algorithm declares its parameters by name, with their type, default, range and
+user interface hints (Parameter), a performance profile (Profile), the engines which
+implement it, and the functions which extract the BSP of a volume, of a slice and of
+consecutive frames. The module generates its parameter sliders and settings from the
+declarations and looks algorithms up here by name, so registering an Algorithm
+(registerAlgorithm) makes it available everywhere:
+
+  algorithm = Algorithms.getAlgorithm('FastShadow')
+  bsp = algorithm.process(volume, algorithm.parameters({'SmoothingSigma' : 3}))
+
+Parameters are dictionaries of parameter name -> value. Where they are a list, e.g. the
+vtkDoubleArray of the C++ ImageProcessingConnector, they are in alphabetical order of
+the names (parametersFromList, parametersToList).
+"""
+
+import collections
+
+from BoneEnhancerPyLib import Foroughi2007
+from BoneEnhancerPyLib import FastShadow
+from BoneEnhancerPyLib import CoarseToFine
+
+# A parameter, type is int or float. label, step, decimals and toolTip are used by the user interface.
+Parameter = collections.namedtuple('Parameter', ['name', 'label', 'type', 'default', 'minimum', 'maximum', 'step', 'decimals', 'toolTip'])
+
+# Performance profile: the time per slice relative to Foroughi2007, whether the algorithm keeps up with live
+# ultrasound frame rates, and the quality it trades for speed
+Profile = collections.namedtuple('Profile', ['relativeCost', 'realTime', 'description'])
+
+#-----------------------------------------------------------------------------
+class Algorithm:
+  """A bone enhancement algorithm.
+
+  volumeFunction(inputVolume, **keywordParameters, firstSliceIndex, lastSliceIndex, outputVolume, numberOfThreads,
+  stageTimes, sliceTimes, sliceIndices) extracts the BSP of a volume as Foroughi2007.foroughi2007, sliceFunction(image,
+  **keywordParameters) the BSP of a slice, and pipelineClass(shape, dtype, **keywordParameters) consecutive frames as
+  Foroughi2007.FramePipeline. keywordParameters(params) maps parameters to the keyword arguments of these functions.
+  engines are the engines which implement the algorithm, 'cpp' is the ImageProcessingConnector of BoneEnhancerCpp.
+  """
+
+  def __init__(self, name, title, parameters, profile, keywordParameters, volumeFunction, sliceFunction, pipelineClass, engines=('numpy',)):
+    self.name = name
+    self.title = title
+    self.parameterDeclarations = tuple(parameters)
+    self.profile = profile
+    self.keywordParameters = keywordParameters
+    self.volumeFunction = volumeFunction
+    self.sliceFunction = sliceFunction
+    self.pipelineClass = pipelineClass
+    self.engines = tuple(engines)
+
+  def getParameterNames(self):
+    """Returns the parameter names in alphabetical order, which is the order of parameter lists."""
+    return sorted(parameter.name for parameter in self.parameterDeclarations)
+
+  def getParameter(self, name):
+    for parameter in self.parameterDeclarations:
+      if parameter.name == name:
+        return parameter
+    raise ValueError('%s has no parameter %s' % (self.name, name))
+
+  def defaultParameters(self):
+    return dict((parameter.name, parameter.default) for parameter in self.parameterDeclarations)
+
+  def parameters(self, values=None):
+    """Returns a complete dictionary of parameters: values (a dictionary of numbers, or strings as read from the settings)
+    converted to the parameter types, and the defaults of the parameters which are not in values. Raises ValueError for
+    unknown parameters."""
+    params = self.defaultParameters()
+    for name, value in (values or {}).items():
+      params[name] = self.getParameter(name).type(float(value))
+    return params
+
+  def parametersFromList(self, values):
+    """Returns the parameters of a list in the order of getParameterNames."""
+    names = self.getParameterNames()
+    if len(values) != len(names):
+      raise ValueError('%s expects %d parameters, got %d' % (self.name, len(names), len(values)))
+    return self.parameters(dict(zip(names, values)))
+
+  def parametersToList(self, params):
+    params = self.parameters(params)
+    return [float(params[name]) for name in self.getParameterNames()]
+
+  def process(self, inputVolume, params, **options):
+    """Extracts the BSP of a volume, options are the slice selection, output, threading and timing keyword arguments of volumeFunction."""
+    options.update(self.keywordParameters(self.parameters(params)))
+    return self.volumeFunction(inputVolume, **options)
+
+  def processSlice(self, image, params):
+    """Returns the BSP of a 2D slice."""
+    return self.sliceFunction(image, **self.keywordParameters(self.parameters(params)))
+
+  def createPipeline(self, shape, dtype, params):
+    """Returns a pipeline which extracts the BSP of frames of the given shape and type with its process(image) method."""
+    return self.pipelineClass(shape, dtype, **self.keywordParameters(self.parameters(params)))
+
+  def setPipelineParameters(self, pipeline, params):
+    pipeline.setParameters(**self.keywordParameters(self.parameters(params)))
+
+#-----------------------------------------------------------------------------
+# Registered algorithms, by name, in the order they were registered
+_algorithms = collections.OrderedDict()
+
+def registerAlgorithm(algorithm):
+  """Registers an algorithm, replacing any algorithm of the same name."""
+  _algorithms[algorithm.name] = algorithm
+
+def getAlgorithms():
+  """Returns the registered algorithms, in the order they were registered."""
+  return list(_algorithms.values())
+
+def getAlgorithm(name):
+  """Returns the algorithm of a name or title. The title may have a suffix after the name, as the
+  title 'Foroughi2007 (with minor modifications)' of Foroughi2007. Raises ValueError if there is none."""
+  if name in _algorithms:
+    return _algorithms[name]
+  for algorithm in _algorithms.values():
+    if name == algorithm.title or name.split(' ', 1)[0] == algorithm.name:
+      return algorithm
+  raise ValueError('Unknown algorithm: ' + str(name))
+
+#-----------------------------------------------------------------------------
+def _fastShadowKeywordParameters(params):
+  return {'smoothingSigma' : params['SmoothingSigma'],
+          'transducerMargin' : params['TransducerMargin'],
+          'shadowOffset' : params['ShadowOffset'],
+          'boneThreshold' : params['BoneThreshold'],
+          'intensityPower' : params['IntensityPower'],
+          'shadowVSIntensity' : params['ShadowVsIntensity']}
+
+def _coarseToFineKeywordParameters(params):
+  return dict(Foroughi2007.keywordParameters(params), downsamplingFactor=params['DownsamplingFactor'],
+              candidateThreshold=params['CandidateThreshold'], bandWidth=params['BandWidth'])
+
+FOROUGHI2007 = Algorithm('Foroughi2007', 'Foroughi2007 (with minor modifications)',
+  [Parameter('SmoothingSigma', 'Smoothing Sigma', float, 5.0, 1, 10, 1, 1, 'Sigma of the Gaussian blur, in pixels'),
+   Parameter('TransducerMargin', 'Transducer Margin', int, 60, 0, 300, 1, 0, 'Number of rows below the transducer which are not bone'),
+   Parameter('ShadowSigma', 'Shadow Sigma', float, 6.0, 1, 10, 1, 1, 'Sigma of the shadow model, in pixels'),
+   Parameter('BoneThreshold', 'Bone Threshold', float, 0.4, 0, 1, 0.1, 1, 'Minimum blurred intensity of bone, between 0 and 1'),
+   Parameter('BlurredVsBLoG', 'Blurred vs. BLoG', float, 3.0, 0, 10, 0.1, 1, 'Weight of the blurred intensity against its Laplacian of Gaussian in the reflection number'),
+   Parameter('ShadowVsIntensity', 'Shadow vs. Intensity', float, 5.0, 0, 10, 0.1, 1, 'Weight of the shadow value against the reflection number')],
+  Profile(1.0, False, 'Reflection number and shadow model, the reference quality'),
+  Foroughi2007.keywordParameters, Foroughi2007.foroughi2007, Foroughi2007.foroughi2007Slice, Foroughi2007.FramePipeline, engines=('numpy', 'cpp'))
+
+FAST_SHADOW = Algorithm('FastShadow', 'FastShadow (real-time)',
+  [Parameter('SmoothingSigma', 'Smoothing Sigma', float, 5.0, 1, 10, 1, 1, 'Sigma of the (box filter approximated) Gaussian blur, in pixels'),
+   Parameter('TransducerMargin', 'Transducer Margin', int, 60, 0, 300, 1, 0, 'Number of rows below the transducer which are not bone'),
+   Parameter('ShadowOffset', 'Shadow Offset', int, 12, 1, 50, 1, 0, 'Number of rows below a pixel where its shadow starts'),
+   Parameter('BoneThreshold', 'Bone Threshold', float, 0.4, 0, 1, 0.1, 1, 'Minimum blurred intensity of bone, between 0 and 1'),
+   Parameter('IntensityPower', 'Intensity Power', float, 3.0, 0, 10, 0.1, 1, 'Exponent of the blurred intensity in the BSP'),
+   Parameter('ShadowVsIntensity', 'Shadow vs. Intensity', float, 5.0, 0, 10, 0.1, 1, 'Exponent of the shadow value in the BSP')],
+  Profile(0.45, True, 'Mean shadow below each pixel and blurred intensity, cumulative sums only; less sharp than Foroughi2007'),
+  _fastShadowKeywordParameters, FastShadow.fastShadow, FastShadow.fastShadowSlice, FastShadow.FramePipeline)
+
+FOROUGHI2007_COARSE_TO_FINE = Algorithm('Foroughi2007CoarseToFine', 'Foroughi2007CoarseToFine (refined around the bone)',
+  FOROUGHI2007.parameterDeclarations +
+  (Parameter('DownsamplingFactor', 'Downsampling Factor', int, 2, 1, 4, 1, 0, 'Downsampling factor of the coarse BSP, 1 is Foroughi2007'),
+   Parameter('CandidateThreshold', 'Candidate Threshold', float, 0.05, 0, 1, 0.01, 2, 'Fraction of the maximum coarse BSP of the bone candidates which are refined'),
+   Parameter('BandWidth', 'Band Width', int, 10, 0, 100, 1, 0, 'Number of rows refined at full resolution above and below the bone candidates')),
+  Profile(0.6, False, 'Foroughi2007 on a downsampled slice, refined at full resolution only in bands around the bone'),
+  _coarseToFineKeywordParameters, CoarseToFine.foroughi2007CoarseToFine, CoarseToFine.coarseToFineSlice, CoarseToFine.FramePipeline)
+
+registerAlgorithm(FOROUGHI2007)
+registerAlgorithm(FAST_SHADOW)
+registerAlgorithm(FOROUGHI2007_COARSE_TO_FINE)
@@ -0,0 +1,213 @@
+"""
+Headless batch enhancement of volume files, without Slicer.
+
+Extracts the BSP of every MetaImage (.mha, .mhd) or NRRD (.nrrd, .nhdr) file given as
+a path or a glob pattern, with the NumPy engine, and writes it next to the other outputs
+as <name>_BSP<extension> with the geometry of the input. Files are processed
+concurrently by a bounded pool of worker processes. Each worker keeps one engine
+(BatchEngine) for all its files, so the kernels and buffers of a slice size are only
+set up once per worker, and writes each output slice by slice as it is computed.
+Uncompressed inputs are read a slab of slices at a time through memory maps
+(OutOfCore), so the memory used does not grow with the length of a sweep.
+
+The Foroughi2007 parameters and the output type are taken from the command line, or
+else from the Slicer settings file the module writes them to (--settings), or else the
+defaults:
+
+  python -m BoneEnhancerPyLib.BatchProcessing --output-dir bsp "sweeps/*.mha" other.nrrd
+  python -m BoneEnhancerPyLib.BatchProcessing --output-dir bsp --settings ~/.config/NA-MIC/Slicer.ini "sweeps/*.nrrd"
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import timeit
+import numpy
+
+try:
+  import configparser
+except ImportError:
+  import ConfigParser as configparser
+
+from BoneEnhancerPyLib import Algorithms
+from BoneEnhancerPyLib import Foroughi2007
+from BoneEnhancerPyLib import ImageIO
+from BoneEnhancerPyLib import OutOfCore
+
+# Output types, named as in the module's output type selector (and the OutputScalarType setting)
+OUTPUT_TYPES = {'double' : numpy.float64, 'float' : numpy.float32, 'unsigned short' : numpy.uint16, 'unsigned char' : numpy.uint8}
+
+# Suffix of the output file names
+OUTPUT_SUFFIX = '_BSP'
+
+# Command line options of the parameters, in the order of Algorithms.FOROUGHI2007.getParameterNames()
+PARAMETER_OPTIONS = ('--blurred-vs-blog', '--bone-threshold', '--shadow-sigma', '--shadow-vs-intensity', '--smoothing-sigma', '--transducer-margin')
+
+#-----------------------------------------------------------------------------
+def readSettings(filePath, moduleName='BoneEnhancerPy'):
+  """Returns the Foroughi2007 parameters (named as declared by Algorithms.FOROUGHI2007) and the output type name which
+  the module saved in a Slicer settings (.ini) file, or the defaults of the ones which are not in the file."""
+  parser = configparser.RawConfigParser()
+  parser.optionxform = str
+  parser.read(filePath)
+  values = {}
+  outputTypeName = 'double'
+  if parser.has_section(moduleName):
+    for name in Algorithms.FOROUGHI2007.getParameterNames():
+      # QSettings stores the keys of the Foroughi2007 group as Foroughi2007\<name> in the module's section
+      key = 'Foroughi2007\\' + name
+      if parser.has_option(moduleName, key):
+        values[name] = parser.get(moduleName, key)
+    if parser.has_option(moduleName, 'OutputScalarType'):
+      outputTypeName = parser.get(moduleName, 'OutputScalarType')
+  return Algorithms.FOROUGHI2007.parameters(values), outputTypeName
+
+#-----------------------------------------------------------------------------
+def expandInputs(patterns):
+  """Returns the files matching a list of paths and glob patterns, in order and without duplicates."""
+  filePaths = []
+  for pattern in patterns:
+    matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    for filePath in matches:
+      if filePath not in filePaths:
+        filePaths.append(filePath)
+  return filePaths
+
+#-----------------------------------------------------------------------------
+def outputFilePath(inputFilePath, outputDirectory, suffix=OUTPUT_SUFFIX):
+  """Returns the output file of an input file, with the same extension (.nhdr and .mhd are written as .nrrd and .mha)."""
+  name, extension = os.path.splitext(os.path.basename(inputFilePath))
+  extension = {'.nhdr' : '.nrrd', '.mhd' : '.mha'}.get(extension.lower(), extension)
+  return os.path.join(outputDirectory, name + suffix + extension)
+
+#-----------------------------------------------------------------------------
+class BatchEngine:
+  """Extracts the BSP of volume files slice by slice. A Foroughi2007.FramePipeline is kept for each slice shape and
+  input precision, so only the first file of a shape sets up the kernels and buffers."""
+
+  def __init__(self, params):
+    self.params = Foroughi2007.keywordParameters(params)
+    self.pipelines = {}
+
+  def getPipeline(self, shape, dtype):
+    key = (tuple(shape), Foroughi2007.realType(dtype))
+    if key not in self.pipelines:
+      self.pipelines[key] = Foroughi2007.FramePipeline(shape, dtype, **self.params)
+    return self.pipelines[key]
+
+  def processFile(self, inputFilePath, outputFilePath, outputType=numpy.float64):
+    """Writes the BSP of a volume file to outputFilePath, one slice at a time. Returns a dictionary describing the result."""
+    startTime = timeit.default_timer()
+    if ImageIO.isUncompressed(inputFilePath):
+      # Memory map the input a slab at a time, so that the volume is never read into memory as a whole
+      inputImage = ImageIO.MemoryMappedImage(inputFilePath)
+      shape, dtype, header = inputImage.shape, inputImage.dtype, inputImage.header
+      slabs = (inputImage.slab(firstSlice, lastSlice) for firstSlice, lastSlice in OutOfCore.slabRanges(shape[0]))
+    else:
+      volume, header = ImageIO.readImage(inputFilePath)
+      shape, dtype, slabs = volume.shape, volume.dtype, [volume]
+    pipeline = self.getPipeline(shape[1:], dtype)
+    emptySlice = numpy.zeros(shape[1:], dtype=outputType)
+    numberOfSkippedSlices = 0
+    with ImageIO.ImageWriter(outputFilePath, shape, outputType, header) as writer:
+      for slab in slabs:
+        for image in slab:
+          bsp = pipeline.process(image)
+          if bsp is None:
+            numberOfSkippedSlices += 1
+            writer.writeSlice(emptySlice)
+          else:
+            writer.writeSlice(Foroughi2007.castToType(bsp, outputType))
+    return {'input' : inputFilePath, 'output' : outputFilePath, 'shape' : list(shape), 'numberOfSkippedSlices' : numberOfSkippedSlices,
+            'runtime' : timeit.default_timer() - startTime, 'process' : os.getpid(), 'error' : None}
+
+#-----------------------------------------------------------------------------
+# Engine of a worker process, created once by the pool initializer
+_workerEngine = None
+
+def _initializeWorker(params):
+  global _workerEngine
+  _workerEngine = BatchEngine(params)
+
+def _processFileInWorker(task):
+  inputFilePath, outputFilePath, outputType = task
+  try:
+    return _workerEngine.processFile(inputFilePath, outputFilePath, outputType)
+  except Exception as e:
+    return {'input' : inputFilePath, 'output' : outputFilePath, 'process' : os.getpid(), 'error' : '%s: %s' % (type(e).__name__, e)}
+
+#-----------------------------------------------------------------------------
+def processFiles(inputFilePaths, outputDirectory, params=None, outputType=numpy.float64, numberOfProcesses=0, suffix=OUTPUT_SUFFIX, log=None):
+  """Extracts the BSP of every input file into outputDirectory, using numberOfProcesses worker processes (0 uses all
+  cores, 1 processes the files in the calling process). params are named as declared by Algorithms.FOROUGHI2007, the
+  defaults where missing. Returns a result dictionary per file in the order the files finished, with the error message
+  of the files which failed."""
+  params = Algorithms.FOROUGHI2007.parameters(params)
+  if not os.path.isdir(outputDirectory):
+    os.makedirs(outputDirectory)
+  tasks = [(inputFilePath, outputFilePath(inputFilePath, outputDirectory, suffix), outputType) for inputFilePath in inputFilePaths]
+  if numberOfProcesses <= 0:
+    numberOfProcesses = multiprocessing.cpu_count()
+  numberOfProcesses = max(1, min(numberOfProcesses, len(tasks)))
+
+  results = []
+  def addResult(result):
+    results.append(result)
+    if log:
+      if result['error']:
+        log('FAILED %s: %s' % (result['input'], result['error']))
+      else:
+        log('%s -> %s (%.3f s)' % (result['input'], result['output'], result['runtime']))
+
+  if numberOfProcesses == 1:
+    _initializeWorker(params)
+    for task in tasks:
+      addResult(_processFileInWorker(task))
+  else:
+    pool = multiprocessing.Pool(numberOfProcesses, _initializeWorker, (params,))
+    try:
+      for result in pool.imap_unordered(_processFileInWorker, tasks):
+        addResult(result)
+    finally:
+      pool.close()
+      pool.join()
+  return results
+
+#-----------------------------------------------------------------------------
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Extracts the bone surface probability of MetaImage and NRRD files (Foroughi2007, NumPy engine).')
+  parser.add_argument('inputs', nargs='+', help='input files or glob patterns')
+  parser.add_argument('--output-dir', required=True, help='directory of the output files')
+  parser.add_argument('--suffix', default=OUTPUT_SUFFIX, help='suffix of the output file names (default %(default)s)')
+  parser.add_argument('--output-type', choices=sorted(OUTPUT_TYPES.keys()), help='output scalar type (default from --settings, or double)')
+  parser.add_argument('--settings', help='Slicer settings (.ini) file to read the parameters and the output type from')
+  parser.add_argument('--processes', type=int, default=0, help='number of worker processes (default: number of cores)')
+  for option, name in zip(PARAMETER_OPTIONS, Algorithms.FOROUGHI2007.getParameterNames()):
+    parser.add_argument(option, type=float, dest=name, help='%s (default from --settings, or %s)' % (name, Algorithms.FOROUGHI2007.getParameter(name).default))
+  args = parser.parse_args(argv)
+
+  if args.settings:
+    params, outputTypeName = readSettings(args.settings)
+  else:
+    params, outputTypeName = Algorithms.FOROUGHI2007.parameters(), 'double'
+  for name in Algorithms.FOROUGHI2007.getParameterNames():
+    if getattr(args, name) is not None:
+      params[name] = Algorithms.FOROUGHI2007.getParameter(name).type(getattr(args, name))
+  outputTypeName = args.output_type or outputTypeName
+  if outputTypeName not in OUTPUT_TYPES:
+    parser.error('unknown output type ' + outputTypeName)
+
+  inputFilePaths = expandInputs(args.inputs)
+  if not inputFilePaths:
+    parser.error('no input files')
+  log = lambda message: sys.stdout.write(message + '\n')
+  startTime = timeit.default_timer()
+  results = processFiles(inputFilePaths, args.output_dir, params, OUTPUT_TYPES[outputTypeName], args.processes, args.suffix, log)
+  numberOfFailedFiles = len([result for result in results if result['error']])
+  log('%d files processed in %.3f s, %d failed' % (len(results), timeit.default_timer() - startTime, numberOfFailedFiles))
+  return 1 if numberOfFailedFiles else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
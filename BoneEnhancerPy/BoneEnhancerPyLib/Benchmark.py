@@ -0,0 +1,196 @@
+"""
+Offline benchmark of the bone enhancement pipeline.
+
+Times the engines on the bundled sample image and on synthetic sweeps of several
+sizes (frames x depth x width), for several numbers of threads, with the time of
+each stage of the algorithm (Foroughi2007.STAGE_NAMES) where the engine reports it.
+Results are written as JSON, and can be compared with the results of an earlier
+run (the baseline) to flag regressions. Runs without Slicer on the NumPy engine:
+
+  python -m BoneEnhancerPyLib.Benchmark --output results.json
+  python -m BoneEnhancerPyLib.Benchmark --baseline results.json
+
+In Slicer, BoneEnhancerPyLogic.runBenchmark also benchmarks the C++ engine.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import timeit
+import numpy
+
+from BoneEnhancerPyLib import Algorithms
+from BoneEnhancerPyLib import Foroughi2007
+from BoneEnhancerPyLib import ImageIO
+from BoneEnhancerPyLib import SyntheticData
+
+# Version of the results format
+RESULTS_VERSION = 1
+
+# Synthetic sweep sizes, as frames x depth x width
+DEFAULT_SIZES = ((10, 280, 440), (50, 280, 440), (10, 560, 880))
+
+# A result is a regression if its median time exceeds the baseline by this fraction...
+DEFAULT_THRESHOLD = 0.1
+# ... and by at least this many seconds, so that the noise of very short stages is ignored
+DEFAULT_MINIMUM_DIFFERENCE = 0.002
+
+# Path of the bundled sample image
+SAMPLE_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'Data', 'US_Lumbar_SingleSlice_Double.mha')
+
+#-----------------------------------------------------------------------------
+def numpyEngine(volume, numberOfThreads, params, stageTimes):
+  """Runs the NumPy engine on a volume, adding the stage times to stageTimes. Returns the wall time."""
+  startTime = timeit.default_timer()
+  Foroughi2007.foroughi2007(volume, numberOfThreads=numberOfThreads, stageTimes=stageTimes, **Foroughi2007.keywordParameters(params))
+  return timeit.default_timer() - startTime
+
+#-----------------------------------------------------------------------------
+def parseSize(text):
+  """Returns the (frames, depth, width) tuple of a size given as FRAMESxDEPTHxWIDTH."""
+  size = tuple(int(value) for value in text.lower().split('x'))
+  if len(size) != 3:
+    raise ValueError('Expected a size as FRAMESxDEPTHxWIDTH, got ' + text)
+  return size
+
+#-----------------------------------------------------------------------------
+def datasets(sizes=DEFAULT_SIZES, sampleDataPath=SAMPLE_DATA_PATH):
+  """Returns the benchmark volumes as a list of (name, volume): the sample image if it exists,
+  then a synthetic sweep of each size."""
+  volumes = []
+  if sampleDataPath and os.path.exists(sampleDataPath):
+    volumes.append(('sample', ImageIO.readMetaImage(sampleDataPath)[0]))
+  for numberOfFrames, ny, nx in sizes:
+    volumes.append(('synthetic-%dx%dx%d' % (numberOfFrames, ny, nx), SyntheticData.syntheticSweep(numberOfFrames, ny, nx)))
+  return volumes
+
+#-----------------------------------------------------------------------------
+def defaultThreadCounts():
+  """Returns 1, 2, 4, ... up to the number of cores, and the number of cores."""
+  cpuCount = multiprocessing.cpu_count()
+  threadCounts = [1]
+  while threadCounts[-1] * 2 < cpuCount:
+    threadCounts.append(threadCounts[-1] * 2)
+  if cpuCount > 1:
+    threadCounts.append(cpuCount)
+  return threadCounts
+
+#-----------------------------------------------------------------------------
+def environment():
+  """Returns a description of the machine and software the benchmark ran on."""
+  return {'platform' : platform.platform(),
+          'processor' : platform.processor(),
+          'cpuCount' : multiprocessing.cpu_count(),
+          'python' : platform.python_version(),
+          'numpy' : numpy.__version__}
+
+#-----------------------------------------------------------------------------
+def runBenchmark(volumes, engines=None, threadCounts=None, repetitions=3, params=None, log=None):
+  """Times every engine on every volume with every number of threads.
+
+  volumes is a list of (name, volume), engines a dictionary of engine name -> function(volume,
+  numberOfThreads, params, stageTimes) returning the wall time, which adds the time of each stage
+  to the stageTimes dictionary if it can. params are named as declared by Algorithms.FOROUGHI2007, the defaults
+  where missing. Returns the results as a JSON serializable dictionary, with the median and minimum of the repetitions."""
+  if engines is None:
+    engines = {'numpy' : numpyEngine}
+  if threadCounts is None:
+    threadCounts = defaultThreadCounts()
+  params = Algorithms.FOROUGHI2007.parameters(params)
+  results = []
+  for datasetName, volume in volumes:
+    for engineName in sorted(engines.keys()):
+      for numberOfThreads in threadCounts:
+        times = []
+        stageTimes = dict((stageName, []) for stageName in Foroughi2007.STAGE_NAMES)
+        # The first run warms up caches and allocations and is not counted
+        engines[engineName](volume, numberOfThreads, params, {})
+        for repetition in range(repetitions):
+          repetitionStageTimes = {}
+          times.append(engines[engineName](volume, numberOfThreads, params, repetitionStageTimes))
+          for stageName, seconds in repetitionStageTimes.items():
+            stageTimes.setdefault(stageName, []).append(seconds)
+        result = {'dataset' : datasetName,
+                  'shape' : list(volume.shape),
+                  'dtype' : str(volume.dtype),
+                  'engine' : engineName,
+                  'threads' : numberOfThreads,
+                  'repetitions' : repetitions,
+                  'total' : {'median' : float(numpy.median(times)), 'min' : float(numpy.min(times))},
+                  'perSlice' : float(numpy.median(times)) / volume.shape[0],
+                  'stages' : dict((stageName, {'median' : float(numpy.median(seconds)), 'min' : float(numpy.min(seconds))})
+                                  for stageName, seconds in stageTimes.items() if seconds)}
+        results.append(result)
+        if log:
+          log('%-24s %-6s %2d threads: %8.4f s (%.2f ms/slice)' % (datasetName, engineName, numberOfThreads, result['total']['median'], 1000 * result['perSlice']))
+  return {'version' : RESULTS_VERSION, 'environment' : environment(), 'parameters' : params, 'results' : results}
+
+#-----------------------------------------------------------------------------
+def compareResults(results, baseline, threshold=DEFAULT_THRESHOLD, minimumDifference=DEFAULT_MINIMUM_DIFFERENCE):
+  """Compares results with the baseline results of the same dataset, engine and number of threads.
+  Returns the regressions, i.e. total or stage median times which are more than threshold (a fraction)
+  and minimumDifference (seconds) slower than the baseline, as a list of dictionaries."""
+  baselineResults = dict(((result['dataset'], result['engine'], result['threads']), result) for result in baseline['results'])
+  regressions = []
+  for result in results['results']:
+    key = (result['dataset'], result['engine'], result['threads'])
+    if key not in baselineResults:
+      continue
+    baselineResult = baselineResults[key]
+    metrics = [('total', result['total'], baselineResult['total'])]
+    metrics += [(stageName, result['stages'][stageName], baselineResult['stages'][stageName])
+                for stageName in sorted(result['stages'].keys()) if stageName in baselineResult.get('stages', {})]
+    for metric, current, previous in metrics:
+      difference = current['median'] - previous['median']
+      if difference > threshold * previous['median'] and difference > minimumDifference:
+        regressions.append({'dataset' : result['dataset'], 'engine' : result['engine'], 'threads' : result['threads'],
+                            'metric' : metric, 'baseline' : previous['median'], 'current' : current['median'],
+                            'ratio' : current['median'] / previous['median'] if previous['median'] > 0 else float('inf')})
+  return regressions
+
+#-----------------------------------------------------------------------------
+def writeResults(results, filePath):
+  with open(filePath, 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+
+#-----------------------------------------------------------------------------
+def readResults(filePath):
+  with open(filePath, 'r') as f:
+    return json.load(f)
+
+#-----------------------------------------------------------------------------
+def formatRegression(regression):
+  return '%(dataset)s %(engine)s %(threads)d threads, %(metric)s: %(baseline).4f s -> %(current).4f s (x%(ratio).2f)' % regression
+
+#-----------------------------------------------------------------------------
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Offline benchmark of the bone enhancement pipeline (NumPy engine).')
+  parser.add_argument('--output', help='write the results to this JSON file')
+  parser.add_argument('--baseline', help='compare the results with this JSON file, exit with 1 if there are regressions')
+  parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='relative slowdown which is a regression (default %(default)s)')
+  parser.add_argument('--sizes', default=','.join('%dx%dx%d' % size for size in DEFAULT_SIZES), help='synthetic sweep sizes, as FRAMESxDEPTHxWIDTH,... (default %(default)s)')
+  parser.add_argument('--threads', help='numbers of threads, as N,... (default 1, 2, 4, ... number of cores)')
+  parser.add_argument('--repetitions', type=int, default=3, help='timed runs per configuration (default %(default)s)')
+  parser.add_argument('--data', default=SAMPLE_DATA_PATH, help='sample image, skipped if it does not exist (default %(default)s)')
+  args = parser.parse_args(argv)
+
+  sizes = [parseSize(size) for size in args.sizes.split(',') if size]
+  threadCounts = [int(value) for value in args.threads.split(',')] if args.threads else None
+  log = lambda message: sys.stdout.write(message + '\n')
+  results = runBenchmark(datasets(sizes, args.data), threadCounts=threadCounts, repetitions=args.repetitions, log=log)
+  if args.output:
+    writeResults(results, args.output)
+  if args.baseline:
+    regressions = compareResults(results, readResults(args.baseline), args.threshold)
+    for regression in regressions:
+      log('REGRESSION ' + formatRegression(regression))
+    if regressions:
+      return 1
+    log('No regressions')
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
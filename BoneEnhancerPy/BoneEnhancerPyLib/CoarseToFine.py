@@ -0,0 +1,282 @@
+"""
+Coarse-to-fine Foroughi2007, which only computes the full resolution BSP around the bone.
+
+Each slice is downsampled by DownsamplingFactor (block mean) and processed with
+Foroughi2007, with the blur, shadow and transducer margin scaled down accordingly.
+The bone responses of this coarse BSP (above CandidateThreshold times its maximum)
+are the candidates. The slice is split into tiles of TILE_WIDTH columns, and in each
+tile with candidates the BSP is refined at full resolution in a band of rows around
+them, BandWidth rows above and below. The rest of the slice is zero. In the bands:
+- the Gaussian is computed at full resolution, normalized by the maximum of the full
+  resolution Gaussian estimated from the coarse one,
+- the shadow value uses the upsampled coarse Gaussian below the band,
+- the normalizations of the shadow value and the BSP are over the bands.
+Weak responses far from the candidates are lost, and the BSP differs slightly from the
+full resolution one; compare measures the speedup and the difference on a volume:
+
+  python -m BoneEnhancerPyLib.CoarseToFine
+"""
+
+import argparse
+import sys
+import timeit
+import numpy
+
+from BoneEnhancerPyLib import Foroughi2007
+from BoneEnhancerPyLib import ImageIO
+from BoneEnhancerPyLib import SurfaceExtraction
+
+# Number of columns of the tiles in which the bands are found
+TILE_WIDTH = 64
+
+# Maximum distance, in rows, of a bone surface found in the coarse-to-fine BSP from the full resolution one to be counted as agreeing
+SURFACE_TOLERANCE = 3
+
+#-----------------------------------------------------------------------------
+def downsample(image, factor):
+  """Returns the means of factor x factor blocks of a 2D image, in the floating point type of the algorithm.
+  The last rows and columns are repeated to fill the last blocks."""
+  image = numpy.asarray(image, dtype=Foroughi2007.realType(image.dtype))
+  ny, nx = image.shape
+  paddedShape = (-(-ny // factor) * factor, -(-nx // factor) * factor)
+  if paddedShape != image.shape:
+    image = numpy.pad(image, ((0, paddedShape[0] - ny), (0, paddedShape[1] - nx)), mode='edge')
+  # Sums of strided views, which is much faster than a mean over the axes of a reshaped view
+  coarse = image[0::factor, 0::factor].copy()
+  for i in range(factor):
+    for j in range(factor):
+      if i or j:
+        coarse += image[i::factor, j::factor]
+  coarse /= factor * factor
+  return coarse
+
+#-----------------------------------------------------------------------------
+def upsample(image, factor, shape):
+  """Repeats every pixel of a downsampled image factor x factor times, cropped to shape."""
+  return numpy.repeat(numpy.repeat(image, factor, axis=0), factor, axis=1)[:shape[0], :shape[1]]
+
+#-----------------------------------------------------------------------------
+def coarseSlice(image, factor, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, timer=None):
+  """Processes the downsampled slice as Foroughi2007.foroughi2007Slice. Returns its BSP, its Gaussian before
+  normalization, and the maximum of its masked shadow value. The stages are timed with timer (a Foroughi2007.StageTimer)."""
+  timer = timer or Foroughi2007.StageTimer(None)
+  coarse = downsample(image, factor)
+  dtype = coarse.dtype
+  timer.stop('conversion')
+  gaussian = Foroughi2007.convolveSeparable(coarse, Foroughi2007.gaussianKernel(smoothingSigma / factor, dtype))
+  unnormalizedGaussian = gaussian.copy()
+  timer.stop('gaussian')
+  Foroughi2007.normalize(gaussian, False)
+  timer.stop('normalization')
+  laplacianOfGaussian = Foroughi2007.positiveLaplacianOfGaussian(gaussian)
+  timer.stop('laplacianOfGaussian')
+  mask = Foroughi2007.boneCandidateMask(gaussian, transducerMargin // factor, boneThreshold)
+  reflection = Foroughi2007.reflectionNumber(gaussian, laplacianOfGaussian, mask, blurredVSBLoG)
+  timer.stop('reflectionNumber')
+  with numpy.errstate(invalid='ignore', divide='ignore'):
+    shadow = Foroughi2007.maskedShadowValue(Foroughi2007.shadowValue(gaussian, shadowSigma / factor), mask, False)
+  maximumShadow = max(shadow.max(), 0.0)
+  Foroughi2007.normalize(shadow, True)
+  timer.stop('shadowValue')
+  bsp = Foroughi2007.boneSurfaceProbability(shadow, reflection, shadowVSIntensity)
+  timer.stop('boneSurfaceProbability')
+  return bsp, unnormalizedGaussian, maximumShadow
+
+#-----------------------------------------------------------------------------
+def candidateBands(coarseBSP, factor, shape, candidateThreshold, bandWidth, tileWidth=TILE_WIDTH):
+  """Returns the (firstRow, lastRow, firstColumn, lastColumn) bands, last excluded, at full resolution around the
+  candidates of the coarse BSP, one per tile of tileWidth columns which has any."""
+  ny, nx = shape
+  maximum = coarseBSP.max()
+  if not maximum > 0:
+    return []
+  candidateRows = coarseBSP >= candidateThreshold * maximum
+  tileWidth = max(tileWidth // factor, 1) * factor
+  bands = []
+  for firstColumn in range(0, nx, tileWidth):
+    lastColumn = min(firstColumn + tileWidth, nx)
+    rows = numpy.nonzero(candidateRows[:, firstColumn // factor:-(-lastColumn // factor)].any(axis=1))[0]
+    if len(rows):
+      bands.append((max(rows[0] * factor - bandWidth, 0), min((rows[-1] + 1) * factor + bandWidth, ny), firstColumn, lastColumn))
+  return bands
+
+#-----------------------------------------------------------------------------
+def coarseToFineSlice(image, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity,
+                      downsamplingFactor=2, candidateThreshold=0.05, bandWidth=10, stageTimes=None):
+  """Extracts the BSP (0-255) from a single 2D slice of shape (ny, nx), refined at full resolution only in bands
+  around the candidates of the downsampled slice. A downsamplingFactor of 1 is Foroughi2007.foroughi2007Slice.
+  If stageTimes is a dictionary, the wall time of each stage is added to it (see Foroughi2007.STAGE_NAMES)."""
+  factor = int(downsamplingFactor)
+  if factor <= 1:
+    return Foroughi2007.foroughi2007Slice(image, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, stageTimes)
+  timer = Foroughi2007.StageTimer(stageTimes)
+  dtype = Foroughi2007.realType(image.dtype)
+  ny, nx = image.shape
+  coarseBSP, coarseGaussian, coarseMaximumShadow = coarseSlice(image, factor, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG,
+                                                                shadowVSIntensity, timer)
+  bands = candidateBands(coarseBSP, factor, image.shape, candidateThreshold, int(bandWidth))
+  timer.stop('boneSurfaceProbability')
+  bsp = numpy.zeros(image.shape, dtype=dtype)
+  if not bands:
+    return bsp
+
+  # Full resolution Gaussian of the bands, from five rows above (for the shadow value) to the row below, and from the column
+  # left to the column right (for the LoG), before normalization
+  kernel = Foroughi2007.gaussianKernel(smoothingSigma, dtype)
+  radius = len(kernel) // 2
+  gaussians = []
+  for firstRow, lastRow, firstColumn, lastColumn in bands:
+    top, bottom, left, right = max(firstRow - 5, 0), min(lastRow + 1, ny), max(firstColumn - 1, 0), min(lastColumn + 1, nx)
+    inputTop, inputLeft = max(top - radius, 0), max(left - radius, 0)
+    block = numpy.asarray(image[inputTop:min(bottom + radius, ny), inputLeft:min(right + radius, nx)], dtype=dtype)
+    gaussian = Foroughi2007.convolveSeparable(block, kernel)
+    gaussians.append((top, left, gaussian[top - inputTop:bottom - inputTop, left - inputLeft:right - inputLeft]))
+  # The coarse Gaussian is a mean over factor x factor pixels, with a kernel which sums to less
+  coarseKernelSum = Foroughi2007.gaussianKernel(smoothingSigma / factor, dtype).sum()
+  coarseScale = (kernel.sum() / coarseKernelSum) ** 2
+  maximumGaussian = max(max(gaussian.max() for top, left, gaussian in gaussians), coarseScale * coarseGaussian.max())
+  timer.stop('gaussian')
+  if not maximumGaussian > 0:
+    return bsp
+  for top, left, gaussian in gaussians:
+    gaussian /= maximumGaussian
+  # Below the bands, the shadow value uses the upsampled coarse Gaussian
+  compositeGaussian = upsample(coarseGaussian * (coarseScale / maximumGaussian), factor, image.shape).astype(dtype, copy=False)
+  timer.stop('normalization')
+
+  reflections = []
+  shadows = []
+  for (firstRow, lastRow, firstColumn, lastColumn), (top, left, gaussian) in zip(bands, gaussians):
+    rows = slice(firstRow - top, lastRow - top)
+    columns = slice(firstColumn - left, lastColumn - left)
+    bandGaussian = gaussian[rows, columns]
+    # The LoG is zero on the border of the slice and where it is negative, as in Foroughi2007.positiveLaplacianOfGaussian
+    laplacianOfGaussian = Foroughi2007.laplacian(gaussian)[rows, columns]
+    border = numpy.zeros(bandGaussian.shape, dtype=bool)
+    if firstRow == 0:
+      border[0, :] = True
+    if lastRow == ny:
+      border[-1, :] = True
+    if firstColumn == 0:
+      border[:, 0] = True
+    if lastColumn == nx:
+      border[:, -1] = True
+    laplacianOfGaussian = numpy.where(border | (laplacianOfGaussian <= 0), 0.0, laplacianOfGaussian / 0.005)
+    timer.stop('laplacianOfGaussian')
+    rowIndex = numpy.arange(firstRow, lastRow)[:, numpy.newaxis]
+    columnIndex = numpy.arange(firstColumn, lastColumn)[numpy.newaxis, :]
+    mask = (bandGaussian >= boneThreshold) & (rowIndex * nx + columnIndex > int(transducerMargin) * nx)
+    reflections.append(Foroughi2007.reflectionNumber(bandGaussian, laplacianOfGaussian, mask, blurredVSBLoG, False))
+    timer.stop('reflectionNumber')
+    # The shadow value of a row only depends on the rows below it, except within five rows of the top of the column
+    compositeGaussian[firstRow:lastRow, firstColumn:lastColumn] = bandGaussian
+    shadowTop = max(firstRow - 5, 0)
+    if shadowTop < firstRow:
+      compositeGaussian[shadowTop:firstRow, firstColumn:lastColumn] = gaussian[shadowTop - top:firstRow - top, columns]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+      shadow = Foroughi2007.shadowValue(compositeGaussian[shadowTop:, firstColumn:lastColumn], shadowSigma)[firstRow - shadowTop:lastRow - shadowTop]
+      shadows.append(Foroughi2007.maskedShadowValue(shadow, mask, False))
+    timer.stop('shadowValue')
+
+  maximumReflection = max(reflection.max() for reflection in reflections)
+  maximumShadow = max(max(shadow.max() for shadow in shadows), coarseMaximumShadow)
+  for (firstRow, lastRow, firstColumn, lastColumn), reflection, shadow in zip(bands, reflections, shadows):
+    if maximumReflection > 0:
+      reflection /= maximumReflection
+    if maximumShadow > 0:
+      shadow = 1 - shadow / maximumShadow
+    else:
+      shadow[...] = 0.0
+    timer.stop('normalization')
+    bsp[firstRow:lastRow, firstColumn:lastColumn] = Foroughi2007.boneSurfaceProbability(shadow, reflection, shadowVSIntensity, False)
+    timer.stop('boneSurfaceProbability')
+  Foroughi2007.normalize(bsp, False, 255)
+  timer.stop('normalization')
+  return bsp
+
+#-----------------------------------------------------------------------------
+def foroughi2007CoarseToFine(inputVolume, smoothingSigma=5.0, transducerMargin=60, shadowSigma=6.0, boneThreshold=0.4, blurredVSBLoG=3.0, shadowVSIntensity=5.0,
+                             downsamplingFactor=2, candidateThreshold=0.05, bandWidth=10, firstSliceIndex=-1, lastSliceIndex=-1, outputVolume=None,
+                             numberOfThreads=1, stageTimes=None, sliceTimes=None, sliceIndices=None):
+  """Extracts the coarse-to-fine BSP from an US volume of shape (nz, ny, nx), or an image of shape (ny, nx), with the
+  slice selection, threading and timing options of Foroughi2007.foroughi2007."""
+  def sliceFunction(image, sliceStageTimes):
+    return coarseToFineSlice(image, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity,
+                             downsamplingFactor, candidateThreshold, bandWidth, sliceStageTimes)
+  return Foroughi2007.processVolume(sliceFunction, inputVolume, firstSliceIndex, lastSliceIndex, outputVolume, numberOfThreads, stageTimes, sliceTimes, sliceIndices)
+
+#-----------------------------------------------------------------------------
+class FramePipeline:
+  """Extracts the coarse-to-fine BSP of consecutive frames of the same shape, with the interface of Foroughi2007.FramePipeline."""
+
+  def __init__(self, shape, dtype=numpy.float64, smoothingSigma=5.0, transducerMargin=60, shadowSigma=6.0, boneThreshold=0.4, blurredVSBLoG=3.0, shadowVSIntensity=5.0,
+               downsamplingFactor=2, candidateThreshold=0.05, bandWidth=10):
+    self.shape = tuple(shape)
+    self.dtype = Foroughi2007.realType(dtype)
+    self.setParameters(smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, downsamplingFactor, candidateThreshold, bandWidth)
+
+  def setParameters(self, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, downsamplingFactor=2, candidateThreshold=0.05, bandWidth=10):
+    self.params = {'smoothingSigma' : smoothingSigma, 'transducerMargin' : transducerMargin, 'shadowSigma' : shadowSigma, 'boneThreshold' : boneThreshold,
+                   'blurredVSBLoG' : blurredVSBLoG, 'shadowVSIntensity' : shadowVSIntensity, 'downsamplingFactor' : downsamplingFactor,
+                   'candidateThreshold' : candidateThreshold, 'bandWidth' : bandWidth}
+
+  def process(self, image):
+    """Returns the BSP of a frame, or None if it has no positive pixel."""
+    if not image.max() > 0:
+      return None
+    return coarseToFineSlice(image, **self.params)
+
+#-----------------------------------------------------------------------------
+def compare(volume, params=None, downsamplingFactor=2, candidateThreshold=0.05, bandWidth=10, repetitions=3):
+  """Compares the coarse-to-fine BSP of a (nz, ny, nx) volume with the full resolution one. params are named as
+  declared by Algorithms.FOROUGHI2007, the defaults where missing. Returns a dictionary of the best runtimes of both,
+  the speedup, the mean and maximum absolute BSP difference, and how many bone surface columns
+  (SurfaceExtraction.boneSurface) are found by both and agree within SURFACE_TOLERANCE rows."""
+  # Imported here, as Algorithms imports this module
+  from BoneEnhancerPyLib import Algorithms
+  keywordParameters = Foroughi2007.keywordParameters(Algorithms.FOROUGHI2007.parameters(params))
+  def bestTime(function):
+    times = []
+    for repetition in range(max(repetitions, 1)):
+      startTime = timeit.default_timer()
+      result = function()
+      times.append(timeit.default_timer() - startTime)
+    return min(times), result
+  fullResolutionTime, fullResolution = bestTime(lambda: Foroughi2007.foroughi2007(volume, **keywordParameters))
+  coarseToFineTime, coarseToFine = bestTime(lambda: foroughi2007CoarseToFine(volume, downsamplingFactor=downsamplingFactor, candidateThreshold=candidateThreshold,
+                                                                             bandWidth=bandWidth, **keywordParameters))
+  difference = numpy.abs(coarseToFine - fullResolution)
+  surface = SurfaceExtraction.boneSurface(coarseToFine)
+  fullResolutionSurface = SurfaceExtraction.boneSurface(fullResolution)
+  found = (surface >= 0) & (fullResolutionSurface >= 0)
+  return {'fullResolutionTime' : fullResolutionTime,
+          'coarseToFineTime' : coarseToFineTime,
+          'speedup' : fullResolutionTime / coarseToFineTime if coarseToFineTime > 0 else 0.0,
+          'meanAbsoluteDifference' : float(difference.mean()),
+          'maximumAbsoluteDifference' : float(difference.max()),
+          'numberOfSurfaceColumns' : int((fullResolutionSurface >= 0).sum()),
+          'numberOfFoundSurfaceColumns' : int(found.sum()),
+          'numberOfAgreeingSurfaceColumns' : int((found & (numpy.abs(surface - fullResolutionSurface) <= SURFACE_TOLERANCE)).sum())}
+
+#-----------------------------------------------------------------------------
+def main(argv=None):
+  from BoneEnhancerPyLib import Benchmark
+  parser = argparse.ArgumentParser(description='Compares the coarse-to-fine BSP (Foroughi2007, NumPy engine) with the full resolution BSP.')
+  parser.add_argument('input', nargs='?', default=Benchmark.SAMPLE_DATA_PATH, help='MetaImage or NRRD file (default: the sample data)')
+  parser.add_argument('--downsampling-factor', type=int, default=2, help='downsampling factor of the coarse BSP (default %(default)s)')
+  parser.add_argument('--candidate-threshold', type=float, default=0.05, help='fraction of the maximum coarse BSP of the candidates (default %(default)s)')
+  parser.add_argument('--band-width', type=int, default=10, help='rows refined above and below the candidates (default %(default)s)')
+  parser.add_argument('--repetitions', type=int, default=5, help='runs of which the best time is taken (default %(default)s)')
+  args = parser.parse_args(argv)
+
+  volume = ImageIO.readImage(args.input)[0]
+  result = compare(volume, downsamplingFactor=args.downsampling_factor, candidateThreshold=args.candidate_threshold, bandWidth=args.band_width, repetitions=args.repetitions)
+  log = lambda message: sys.stdout.write(message + '\n')
+  log('full resolution %.2f ms, coarse-to-fine %.2f ms, speedup %.2fx' % (1000 * result['fullResolutionTime'], 1000 * result['coarseToFineTime'], result['speedup']))
+  log('BSP difference: mean %.3f, maximum %.1f (0-255)' % (result['meanAbsoluteDifference'], result['maximumAbsoluteDifference']))
+  log('bone surface: %d of %d columns found, %d within %d rows' % (result['numberOfFoundSurfaceColumns'], result['numberOfSurfaceColumns'],
+                                                                    result['numberOfAgreeingSurfaceColumns'], SURFACE_TOLERANCE))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
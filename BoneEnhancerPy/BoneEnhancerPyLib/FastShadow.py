@@ -0,0 +1,111 @@
+"""
+Fast shadow-based bone enhancement, a cheaper alternative to Foroughi2007 for real-time use.
+
+Bone reflects most of the ultrasound and casts an acoustic shadow, so a bright pixel
+above dark pixels is likely on the bone surface. As in Foroughi2007, the image is
+blurred and normalized, and the bone candidates are the blurred pixels above
+BoneThreshold below the TransducerMargin. Everything is computed with cumulative sums,
+in time independent of the parameters:
+- the Gaussian is approximated by two passes of a box filter,
+- the shadow value of a pixel is the plain mean of the blurred pixels more than
+  ShadowOffset rows below it (one tail sum per column), instead of the shadow model
+  weighted mean,
+- the BSP combines it with the blurred intensity to the power IntensityPower, instead of
+  the reflection number, so the Laplacian of Gaussian is not computed.
+It takes less than half the time of Foroughi2007 per slice, and finds the bone surface
+within a few rows of it, but the BSP is less sharp.
+"""
+
+import numpy
+
+from BoneEnhancerPyLib import Foroughi2007
+
+# Number of box filter passes which approximate the Gaussian
+NUMBER_OF_BOX_PASSES = 2
+
+#-----------------------------------------------------------------------------
+def boxRadius(smoothingSigma, numberOfPasses=NUMBER_OF_BOX_PASSES):
+  """Returns the radius of the box filter which, applied numberOfPasses times, has the variance of the Gaussian."""
+  return max(int(round((numpy.sqrt(12.0 * smoothingSigma * smoothingSigma / numberOfPasses + 1) - 1) / 2)), 1)
+
+#-----------------------------------------------------------------------------
+def boxFilter(image, radius, axis):
+  """Returns the sum of the 2 * radius + 1 pixels around each pixel along an axis of a 2D image,
+  pixels outside the image are zero."""
+  n = image.shape[axis]
+  paddedShape = list(image.shape)
+  paddedShape[axis] = n + 2 * radius + 1
+  padded = numpy.zeros(paddedShape, dtype=image.dtype)
+  padded.swapaxes(0, axis)[radius + 1:radius + 1 + n] = image.swapaxes(0, axis)
+  cumulativeSum = numpy.cumsum(padded, axis=axis).swapaxes(0, axis)
+  return (cumulativeSum[2 * radius + 1:] - cumulativeSum[:n]).swapaxes(0, axis)
+
+#-----------------------------------------------------------------------------
+def blurredImage(image, smoothingSigma):
+  """Approximates the Gaussian blur of Foroughi2007.blurredImage by box filters, normalized between zero and one."""
+  radius = boxRadius(smoothingSigma)
+  blurred = numpy.asarray(image, dtype=Foroughi2007.realType(image.dtype))
+  for boxPass in range(NUMBER_OF_BOX_PASSES):
+    blurred = boxFilter(boxFilter(blurred, radius, 0), radius, 1)
+  return Foroughi2007.normalize(blurred, False)
+
+#-----------------------------------------------------------------------------
+def shadowMean(gaussian, shadowOffset):
+  """Returns, for every pixel, the mean of the pixels more than shadowOffset rows below it in its column
+  (zero where there are none). The sums are accumulated in double precision, the result has the type of gaussian."""
+  ny = gaussian.shape[0]
+  shadowOffset = min(max(int(shadowOffset), 1), ny)
+  tailSum = numpy.cumsum(gaussian[::-1], axis=0, dtype=numpy.float64)[::-1]
+  shadow = numpy.zeros(gaussian.shape, dtype=gaussian.dtype)
+  shadow[:ny - shadowOffset] = tailSum[shadowOffset:] / numpy.arange(ny - shadowOffset, 0, -1, dtype=numpy.float64)[:, numpy.newaxis]
+  return shadow
+
+#-----------------------------------------------------------------------------
+def fastShadowSlice(image, smoothingSigma, transducerMargin, shadowOffset, boneThreshold, intensityPower, shadowVSIntensity, stageTimes=None):
+  """Extracts the BSP (0-255) from a single 2D slice of shape (ny, nx). If stageTimes is a dictionary,
+  the wall time of each stage is added to it (see Foroughi2007.STAGE_NAMES)."""
+  timer = Foroughi2007.StageTimer(stageTimes)
+  gaussian = blurredImage(image, smoothingSigma)
+  timer.stop('gaussian')
+  mask = Foroughi2007.boneCandidateMask(gaussian, transducerMargin, boneThreshold)
+  shadow = shadowMean(gaussian, shadowOffset)
+  shadow[~mask] = 0.0
+  timer.stop('shadowValue')
+  Foroughi2007.normalize(shadow, True)
+  timer.stop('normalization')
+  # Only the bone candidates, usually a small fraction of the pixels, are combined
+  bsp = numpy.zeros(gaussian.shape, dtype=gaussian.dtype)
+  with numpy.errstate(invalid='ignore'):
+    bsp[mask] = numpy.power(shadow[mask], shadowVSIntensity) * numpy.power(gaussian[mask], intensityPower)
+  timer.stop('boneSurfaceProbability')
+  Foroughi2007.normalize(bsp, False, 255)
+  timer.stop('normalization')
+  return bsp
+
+#-----------------------------------------------------------------------------
+def fastShadow(inputVolume, smoothingSigma=5.0, transducerMargin=60, shadowOffset=12, boneThreshold=0.4, intensityPower=3.0, shadowVSIntensity=5.0,
+               firstSliceIndex=-1, lastSliceIndex=-1, outputVolume=None, numberOfThreads=1, stageTimes=None, sliceTimes=None, sliceIndices=None):
+  """Extracts the BSP from an US volume of shape (nz, ny, nx), or an image of shape (ny, nx), with the
+  slice selection, threading and timing options of Foroughi2007.foroughi2007."""
+  def sliceFunction(image, sliceStageTimes):
+    return fastShadowSlice(image, smoothingSigma, transducerMargin, shadowOffset, boneThreshold, intensityPower, shadowVSIntensity, sliceStageTimes)
+  return Foroughi2007.processVolume(sliceFunction, inputVolume, firstSliceIndex, lastSliceIndex, outputVolume, numberOfThreads, stageTimes, sliceTimes, sliceIndices)
+
+#-----------------------------------------------------------------------------
+class FramePipeline:
+  """Extracts the BSP of consecutive frames of the same shape, with the interface of Foroughi2007.FramePipeline."""
+
+  def __init__(self, shape, dtype=numpy.float64, smoothingSigma=5.0, transducerMargin=60, shadowOffset=12, boneThreshold=0.4, intensityPower=3.0, shadowVSIntensity=5.0):
+    self.shape = tuple(shape)
+    self.dtype = Foroughi2007.realType(dtype)
+    self.setParameters(smoothingSigma, transducerMargin, shadowOffset, boneThreshold, intensityPower, shadowVSIntensity)
+
+  def setParameters(self, smoothingSigma, transducerMargin, shadowOffset, boneThreshold, intensityPower, shadowVSIntensity):
+    self.params = {'smoothingSigma' : smoothingSigma, 'transducerMargin' : transducerMargin, 'shadowOffset' : shadowOffset,
+                   'boneThreshold' : boneThreshold, 'intensityPower' : intensityPower, 'shadowVSIntensity' : shadowVSIntensity}
+
+  def process(self, image):
+    """Returns the BSP of a frame, or None if it has no positive pixel."""
+    if not image.max() > 0:
+      return None
+    return fastShadowSlice(image, **self.params)
@@ -0,0 +1,516 @@
+"""
+Vectorized NumPy implementation of Foroughi2007 (with minor modifications).
+
+This is a port of vtkSlicerBoneEnhancerCppLogic::Foroughi2007 which does not
+depend on Slicer or Intel MKL, so that the bone surface probability (BSP) can be
+computed on plain arrays. Volumes are indexed as [slice, row, column], i.e.
+(nz, ny, nx), which is the memory layout of vtkImageData scalars.
+
+The output matches the Intel MKL implementation within TOLERANCE (absolute
+difference in BSP units, 0-255). The only exception are pixels whose blurred
+intensity is within rounding error of the bone threshold, since they may end
+up on different sides of the threshold in the two implementations.
+
+Like the C++ implementation, float64 input is processed in double precision and
+any other input type (e.g. uint8, uint16 or float32) in single precision, which
+halves the memory traffic. The output can be of any numeric type, integer types
+are rounded and clipped to their range.
+"""
+
+import hashlib
+import threading
+import timeit
+import numpy
+from multiprocessing.pool import ThreadPool
+
+# Maximum absolute difference to the C++ (Intel MKL) output, in BSP units (0-255)
+TOLERANCE = 1e-6
+
+# Stages of the algorithm, which are timed separately (see StageTimer), in the order of the C++ engine's stages
+STAGE_NAMES = ('conversion', 'gaussian', 'laplacianOfGaussian', 'reflectionNumber', 'shadowValue', 'normalization', 'boneSurfaceProbability')
+
+#-----------------------------------------------------------------------------
+class StageTimer:
+  """Adds the wall time since the previous call (or since construction) to a stage of a
+  dictionary of stage name -> seconds. Does nothing, and costs next to nothing, if the
+  dictionary is None."""
+
+  def __init__(self, stageTimes):
+    self.stageTimes = stageTimes
+    self.lastTime = timeit.default_timer() if stageTimes is not None else None
+
+  def stop(self, stageName):
+    if self.stageTimes is None:
+      return
+    now = timeit.default_timer()
+    self.stageTimes[stageName] = self.stageTimes.get(stageName, 0.0) + now - self.lastTime
+    self.lastTime = now
+
+#-----------------------------------------------------------------------------
+def keywordParameters(params):
+  """Returns a dictionary of parameters, named as declared by Algorithms.FOROUGHI2007, as keyword arguments of foroughi2007."""
+  return {'smoothingSigma' : params['SmoothingSigma'],
+          'transducerMargin' : int(params['TransducerMargin']),
+          'shadowSigma' : params['ShadowSigma'],
+          'boneThreshold' : params['BoneThreshold'],
+          'blurredVSBLoG' : params['BlurredVsBLoG'],
+          'shadowVSIntensity' : params['ShadowVsIntensity']}
+
+#-----------------------------------------------------------------------------
+def realType(dtype):
+  """Returns the floating point type the algorithm uses for input of the given type (of any byte order)."""
+  return numpy.float64 if numpy.dtype(dtype).type == numpy.float64 else numpy.float32
+
+#-----------------------------------------------------------------------------
+def castToType(image, dtype):
+  """Converts a BSP image to the given type, integer types are rounded and clipped to their range and NaN becomes zero,
+  as in vtkSlicerBoneEnhancerCppLogic."""
+  dtype = numpy.dtype(dtype)
+  if not numpy.issubdtype(dtype, numpy.integer):
+    return image.astype(dtype, copy=False)
+  typeInfo = numpy.iinfo(dtype)
+  return numpy.clip(numpy.rint(numpy.nan_to_num(image)), typeInfo.min, typeInfo.max).astype(dtype)
+
+#-----------------------------------------------------------------------------
+def gaussianKernel(smoothingSigma, dtype=numpy.float64):
+  """Returns the 1D Gaussian kernel of which the 2D Gaussian kernel is the outer product."""
+  intervall = int(numpy.floor(smoothingSigma * 3))
+  x = numpy.arange(-intervall, intervall + 1, dtype=numpy.float64)
+  return numpy.exp(-(x * x) / (2 * smoothingSigma * smoothingSigma)).astype(dtype)
+
+#-----------------------------------------------------------------------------
+def shadowModel(ny, shadowSigma):
+  """Returns the weights modelling the transition from bone surface to shadow."""
+  i = numpy.arange(ny, dtype=numpy.float64)
+  model = 1 - numpy.exp(-(i * i - 1) / (2 * shadowSigma * shadowSigma))
+  model[max(ny - 5, 0):] = 0.0
+  return model
+
+#-----------------------------------------------------------------------------
+def shadowKernel(ny, shadowSigma):
+  """Returns the weights k for which shadowModel = 1 - k (above the last five rows),
+  truncated where they become smaller than the machine epsilon."""
+  size = int(numpy.ceil(numpy.sqrt(1 - 2 * shadowSigma * shadowSigma * numpy.log(numpy.finfo(numpy.float64).eps))))
+  i = numpy.arange(min(size, ny), dtype=numpy.float64)
+  return numpy.exp(-(i * i - 1) / (2 * shadowSigma * shadowSigma))
+
+#-----------------------------------------------------------------------------
+def convolveSeparable(image, kernel):
+  """Convolves a 2D image with the outer product of a symmetric 1D kernel.
+  The result has the same size as the image, pixels outside the image are zero."""
+  ny, nx = image.shape
+  radius = len(kernel) // 2
+  padded = numpy.zeros((ny + 2 * radius, nx + 2 * radius), dtype=image.dtype)
+  padded[radius:radius + ny, radius:radius + nx] = image
+  # Convolve the columns, then the rows. The loops are over the kernel taps only.
+  rows = numpy.zeros((ny, nx + 2 * radius), dtype=image.dtype)
+  for k in range(len(kernel)):
+    rows += kernel[k] * padded[k:k + ny, :]
+  result = numpy.zeros((ny, nx), dtype=image.dtype)
+  for k in range(len(kernel)):
+    result += kernel[k] * rows[:, k:k + nx]
+  return result
+
+#-----------------------------------------------------------------------------
+def laplacian(image):
+  """Convolves a 2D image with the 3x3 Laplacian kernel, pixels outside the image are zero."""
+  padded = numpy.zeros((image.shape[0] + 2, image.shape[1] + 2), dtype=image.dtype)
+  padded[1:-1, 1:-1] = image
+  return 4 * image - padded[:-2, 1:-1] - padded[2:, 1:-1] - padded[1:-1, :-2] - padded[1:-1, 2:]
+
+#-----------------------------------------------------------------------------
+def maxPixelValue(image):
+  """Returns the maximum of an image, ignoring NaN, or zero if it has no positive pixel.
+  Same as vtkSlicerBoneEnhancerCppLogic::GetMaxPixelValue."""
+  maximum = numpy.fmax.reduce(image, axis=None)
+  return maximum if maximum > 0 else 0.0
+
+#-----------------------------------------------------------------------------
+def normalize(image, doInverse, maxValue=1.0):
+  """Scales an image so that its maximum (ignoring NaN) becomes maxValue (or 1 - image/max if doInverse).
+  Behaves as vtkSlicerBoneEnhancerCppLogic::Normalize for images without positive pixels."""
+  maximum = maxPixelValue(image)
+  if maximum == 0:
+    image[...] = 0.0 if doInverse else maxValue
+    return image
+  scaleFactor = maxValue / maximum
+  if doInverse:
+    image[...] = 1 - image * scaleFactor
+  else:
+    image *= scaleFactor
+  return image
+
+#-----------------------------------------------------------------------------
+def shadowValue(gaussian, shadowSigma):
+  """Returns, for every pixel, the shadow model weighted mean of the pixels below it:
+  sum_i(model[i-y] * gaussian[i]) / sum_i(model[i-y]) for i = y..ny-1.
+
+  Runs in O(ny) per column: the weighted tail sum is the plain tail sum of the column
+  minus its correlation with the shadow kernel, which only spans a few shadowSigma.
+  The tail sums are accumulated in double precision, the result has the type of gaussian."""
+  ny, nx = gaussian.shape
+  model = shadowModel(ny, shadowSigma)
+  sumG = numpy.cumsum(model)[::-1]
+  kernel = shadowKernel(ny, shadowSigma).astype(gaussian.dtype)
+  # Tail sums of each column
+  tailSum = numpy.cumsum(gaussian[::-1], axis=0, dtype=numpy.float64)[::-1]
+  # Correlation with the shadow kernel through a strided (ny, len(kernel), nx) view, zero below the image
+  padded = numpy.zeros((ny + len(kernel), nx), dtype=gaussian.dtype)
+  padded[:ny] = gaussian
+  windows = numpy.lib.stride_tricks.as_strided(padded, shape=(ny, len(kernel), nx),
+                                               strides=(padded.strides[0], padded.strides[0], padded.strides[1]))
+  sumGI = tailSum - numpy.einsum('k,ykx->yx', kernel, windows)
+  # The shadow model is zero for the last five rows, which only affects the first five rows
+  for y in range(min(5, ny)):
+    sumGI[y] = numpy.dot(model[:ny - y], gaussian[y:])
+  return (sumGI / sumG[:, numpy.newaxis]).astype(gaussian.dtype, copy=False)
+
+#-----------------------------------------------------------------------------
+def shadowValueDirect(gaussian, shadowSigma):
+  """Reference implementation of shadowValue, which is O(ny^2) per column."""
+  ny = gaussian.shape[0]
+  model = shadowModel(ny, shadowSigma)
+  offset = numpy.arange(ny)[numpy.newaxis, :] - numpy.arange(ny)[:, numpy.newaxis]
+  weights = numpy.where(offset >= 0, model[numpy.clip(offset, 0, ny - 1)], 0.0)
+  sumG = numpy.cumsum(model)[::-1]
+  sumGI = numpy.dot(weights, gaussian)
+  return sumGI / sumG[:, numpy.newaxis]
+
+#-----------------------------------------------------------------------------
+def blurredImage(image, smoothingSigma):
+  """Convolves with the Gaussian kernel and normalizes the result between zero and one."""
+  dtype = realType(image.dtype)
+  return normalize(convolveSeparable(numpy.asarray(image, dtype=dtype), gaussianKernel(smoothingSigma, dtype)), False)
+
+#-----------------------------------------------------------------------------
+def positiveLaplacianOfGaussian(gaussian):
+  """Convolves the blurred image with the Laplacian kernel, sets the outermost border pixels
+  and negative pixels to zero and scales the rest up."""
+  laplacianOfGaussian = laplacian(gaussian)
+  border = numpy.zeros(gaussian.shape, dtype=bool)
+  border[[0, -1], :] = True
+  border[:, [0, -1]] = True
+  # Divide by small number to increase image intensity
+  return numpy.where(border | (laplacianOfGaussian <= 0), 0.0, laplacianOfGaussian / 0.005)
+
+#-----------------------------------------------------------------------------
+def boneCandidateMask(gaussian, transducerMargin, boneThreshold):
+  """Returns the pixels with blurred intensity above the threshold, below the transducer margin."""
+  ny, nx = gaussian.shape
+  pixelIndex = numpy.arange(nx * ny).reshape(ny, nx)
+  return (gaussian >= boneThreshold) & (pixelIndex > int(transducerMargin) * nx)
+
+#-----------------------------------------------------------------------------
+def reflectionNumber(gaussian, laplacianOfGaussian, mask, blurredVSBLoG, doNormalize=True):
+  """Returns the normalized reflection number of the bone candidate pixels."""
+  with numpy.errstate(invalid='ignore'):
+    reflection = numpy.where(mask, numpy.power(gaussian, blurredVSBLoG) + laplacianOfGaussian, 0.0)
+  return normalize(reflection, False) if doNormalize else reflection
+
+#-----------------------------------------------------------------------------
+def maskedShadowValue(shadow, mask, doNormalize=True):
+  """Returns the inverted, normalized shadow value of the bone candidate pixels."""
+  with numpy.errstate(invalid='ignore'):
+    masked = numpy.where(mask, shadow, 0.0)
+  return normalize(masked, True) if doNormalize else masked
+
+#-----------------------------------------------------------------------------
+def boneSurfaceProbability(shadow, reflection, shadowVSIntensity, doNormalize=True):
+  """Combines the masked shadow value and reflection number into the BSP (0-255)."""
+  with numpy.errstate(invalid='ignore'):
+    bsp = numpy.power(shadow, shadowVSIntensity) * reflection
+  return normalize(bsp, False, 255) if doNormalize else bsp
+
+#-----------------------------------------------------------------------------
+def foroughi2007Slice(image, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, stageTimes=None):
+  """Extracts the BSP (0-255) from a single 2D slice of shape (ny, nx).
+  If stageTimes is a dictionary, the wall time of each of STAGE_NAMES is added to it."""
+  timer = StageTimer(stageTimes)
+  dtype = realType(image.dtype)
+  image = numpy.asarray(image, dtype=dtype)
+  timer.stop('conversion')
+  gaussian = convolveSeparable(image, gaussianKernel(smoothingSigma, dtype))
+  timer.stop('gaussian')
+  normalize(gaussian, False)
+  timer.stop('normalization')
+  laplacianOfGaussian = positiveLaplacianOfGaussian(gaussian)
+  timer.stop('laplacianOfGaussian')
+  mask = boneCandidateMask(gaussian, transducerMargin, boneThreshold)
+  reflection = reflectionNumber(gaussian, laplacianOfGaussian, mask, blurredVSBLoG, False)
+  timer.stop('reflectionNumber')
+  normalize(reflection, False)
+  timer.stop('normalization')
+  with numpy.errstate(invalid='ignore', divide='ignore'):
+    shadow = maskedShadowValue(shadowValue(gaussian, shadowSigma), mask, False)
+    timer.stop('shadowValue')
+    normalize(shadow, True)
+  timer.stop('normalization')
+  bsp = boneSurfaceProbability(shadow, reflection, shadowVSIntensity, False)
+  timer.stop('boneSurfaceProbability')
+  normalize(bsp, False, 255)
+  timer.stop('normalization')
+  return bsp
+
+#-----------------------------------------------------------------------------
+class _Cancelled(Exception):
+  pass
+
+class SliceCache:
+  """Computes foroughi2007Slice for a few recently used slices, keeping the intermediate
+  results. A stage is only recomputed when a parameter it depends on changes, e.g. changing
+  ShadowVsIntensity only recomputes the final combination. The stages of a slice are also keyed by a
+  hash of its voxels, so they are recomputed when the input slice changes (e.g. a streamed, appended
+  or edited frame).
+  """
+
+  # Parameters each cached stage depends on
+  STAGE_PARAMETERS = {'gaussian' : ('smoothingSigma',),
+                      'laplacianOfGaussian' : ('smoothingSigma',),
+                      'shadowValue' : ('smoothingSigma', 'shadowSigma'),
+                      'mask' : ('smoothingSigma', 'transducerMargin', 'boneThreshold'),
+                      'reflectionNumber' : ('smoothingSigma', 'transducerMargin', 'boneThreshold', 'blurredVSBLoG'),
+                      'maskedShadowValue' : ('smoothingSigma', 'transducerMargin', 'boneThreshold', 'shadowSigma')}
+
+  def __init__(self, maximumNumberOfSlices=8):
+    self.maximumNumberOfSlices = maximumNumberOfSlices
+    self.slices = {}
+    self.sliceOrder = []
+
+  def clear(self):
+    self.slices = {}
+    self.sliceOrder = []
+
+  def compute(self, sliceIndex, image, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, isCancelled=None):
+    """Returns the BSP of the slice, or None if the slice has no positive pixel or if
+    isCancelled() returns True between two stages."""
+    if maxPixelValue(image) <= 0:
+      return None
+    params = {'smoothingSigma' : smoothingSigma, 'transducerMargin' : int(transducerMargin), 'shadowSigma' : shadowSigma,
+              'boneThreshold' : boneThreshold, 'blurredVSBLoG' : blurredVSBLoG}
+
+    # Least recently used slices are evicted
+    if sliceIndex in self.sliceOrder:
+      self.sliceOrder.remove(sliceIndex)
+    self.sliceOrder.append(sliceIndex)
+    while len(self.sliceOrder) > self.maximumNumberOfSlices:
+      del self.slices[self.sliceOrder.pop(0)]
+    stages = self.slices.setdefault(sliceIndex, {})
+    inputKey = (image.shape, image.dtype.str, hashlib.sha1(numpy.ascontiguousarray(image).view(numpy.uint8)).digest())
+    if stages.get('input') != inputKey:
+      stages.clear()
+      stages['input'] = inputKey
+
+    def stage(name, function):
+      key = tuple(params[param] for param in self.STAGE_PARAMETERS[name])
+      if name not in stages or stages[name][0] != key:
+        if isCancelled and isCancelled():
+          raise _Cancelled()
+        stages[name] = (key, function())
+      return stages[name][1]
+
+    try:
+      gaussian = stage('gaussian', lambda: blurredImage(image, smoothingSigma))
+      laplacianOfGaussian = stage('laplacianOfGaussian', lambda: positiveLaplacianOfGaussian(gaussian))
+      mask = stage('mask', lambda: boneCandidateMask(gaussian, transducerMargin, boneThreshold))
+      reflection = stage('reflectionNumber', lambda: reflectionNumber(gaussian, laplacianOfGaussian, mask, blurredVSBLoG))
+      with numpy.errstate(invalid='ignore', divide='ignore'):
+        shadow = stage('shadowValue', lambda: shadowValue(gaussian, shadowSigma))
+      masked = stage('maskedShadowValue', lambda: maskedShadowValue(shadow, mask))
+    except _Cancelled:
+      return None
+    return boneSurfaceProbability(masked, reflection, shadowVSIntensity)
+
+#-----------------------------------------------------------------------------
+class FramePipeline:
+  """Computes foroughi2007Slice for a stream of frames of a fixed shape. The kernels, masks and
+  all intermediate buffers are allocated once and reused for every frame, so that processing a
+  frame allocates (almost) no memory. Parameters can be changed between frames with setParameters.
+  """
+
+  def __init__(self, shape, dtype=numpy.float64, smoothingSigma=5.0, transducerMargin=60, shadowSigma=6.0, boneThreshold=0.4, blurredVSBLoG=3.0, shadowVSIntensity=5.0):
+    self.shape = tuple(shape)
+    self.dtype = realType(dtype)
+    ny, nx = self.shape
+    self.gaussian = numpy.zeros(self.shape, dtype=self.dtype)
+    self.laplacianOfGaussian = numpy.zeros(self.shape, dtype=self.dtype)
+    self.laplacianPadded = numpy.zeros((ny + 2, nx + 2), dtype=self.dtype)
+    self.reflection = numpy.zeros(self.shape, dtype=self.dtype)
+    self.shadow = numpy.zeros(self.shape, dtype=self.dtype)
+    self.tailSum = numpy.zeros(self.shape, dtype=numpy.float64)
+    self.mask = numpy.zeros(self.shape, dtype=bool)
+    self.border = numpy.zeros(self.shape, dtype=bool)
+    self.border[[0, -1], :] = True
+    self.border[:, [0, -1]] = True
+    self.pixelIndex = numpy.arange(nx * ny).reshape(ny, nx)
+    self.params = {}
+    self.setParameters(smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity)
+
+  def setParameters(self, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity):
+    """Updates the parameters, recomputing only the kernels and buffers which depend on a changed one."""
+    ny, nx = self.shape
+    if self.params.get('smoothingSigma') != smoothingSigma:
+      self.kernel = gaussianKernel(smoothingSigma, self.dtype)
+      radius = len(self.kernel) // 2
+      self.padded = numpy.zeros((ny + 2 * radius, nx + 2 * radius), dtype=self.dtype)
+      self.rows = numpy.zeros((ny, nx + 2 * radius), dtype=self.dtype)
+      self.rowsTerm = numpy.zeros((ny, nx + 2 * radius), dtype=self.dtype)
+      self.term = numpy.zeros(self.shape, dtype=self.dtype)
+    if self.params.get('shadowSigma') != shadowSigma:
+      self.model = shadowModel(ny, shadowSigma)
+      self.sumG = numpy.cumsum(self.model)[::-1][:, numpy.newaxis]
+      self.shadowKernel = shadowKernel(ny, shadowSigma).astype(self.dtype)
+      self.shadowPadded = numpy.zeros((ny + len(self.shadowKernel), nx), dtype=self.dtype)
+      self.windows = numpy.lib.stride_tricks.as_strided(self.shadowPadded, shape=(ny, len(self.shadowKernel), nx),
+                                                        strides=(self.shadowPadded.strides[0], self.shadowPadded.strides[0], self.shadowPadded.strides[1]))
+      self.correlation = numpy.zeros(self.shape, dtype=self.dtype)
+    if self.params.get('transducerMargin') != int(transducerMargin):
+      self.marginMask = self.pixelIndex > int(transducerMargin) * nx
+    self.params = {'smoothingSigma' : smoothingSigma, 'transducerMargin' : int(transducerMargin), 'shadowSigma' : shadowSigma,
+                   'boneThreshold' : boneThreshold, 'blurredVSBLoG' : blurredVSBLoG, 'shadowVSIntensity' : shadowVSIntensity}
+
+  def process(self, image):
+    """Returns the BSP (0-255) of a frame, or None if the frame has no positive pixel. The returned
+    array is a buffer of the pipeline, which is overwritten by the next frame."""
+    if image.shape != self.shape:
+      raise ValueError('Expected a frame of shape %s, got %s' % (self.shape, image.shape))
+    if maxPixelValue(image) <= 0:
+      return None
+    ny, nx = self.shape
+    kernel = self.kernel
+    radius = len(kernel) // 2
+
+    # Gaussian blur, as convolveSeparable
+    self.padded[radius:radius + ny, radius:radius + nx] = image
+    self.rows.fill(0)
+    for k in range(len(kernel)):
+      numpy.multiply(kernel[k], self.padded[k:k + ny, :], out=self.rowsTerm)
+      self.rows += self.rowsTerm
+    gaussian = self.gaussian
+    gaussian.fill(0)
+    for k in range(len(kernel)):
+      numpy.multiply(kernel[k], self.rows[:, k:k + nx], out=self.term)
+      gaussian += self.term
+    normalize(gaussian, False)
+
+    # Laplacian of Gaussian, as positiveLaplacianOfGaussian
+    padded = self.laplacianPadded
+    padded[1:-1, 1:-1] = gaussian
+    laplacianOfGaussian = self.laplacianOfGaussian
+    numpy.multiply(4, gaussian, out=laplacianOfGaussian)
+    laplacianOfGaussian -= padded[:-2, 1:-1]
+    laplacianOfGaussian -= padded[2:, 1:-1]
+    laplacianOfGaussian -= padded[1:-1, :-2]
+    laplacianOfGaussian -= padded[1:-1, 2:]
+    numpy.logical_or(self.border, laplacianOfGaussian <= 0, out=self.mask)
+    laplacianOfGaussian /= 0.005
+    laplacianOfGaussian[self.mask] = 0.0
+
+    # Bone candidates and reflection number
+    mask = self.mask
+    numpy.greater_equal(gaussian, self.params['boneThreshold'], out=mask)
+    mask &= self.marginMask
+    reflection = self.reflection
+    with numpy.errstate(invalid='ignore'):
+      numpy.power(gaussian, self.params['blurredVSBLoG'], out=reflection)
+    reflection += laplacianOfGaussian
+    reflection[~mask] = 0.0
+    normalize(reflection, False)
+
+    # Shadow value, as shadowValue
+    shadow = self.shadow
+    numpy.cumsum(gaussian[::-1], axis=0, dtype=numpy.float64, out=self.tailSum)
+    self.shadowPadded[:ny] = gaussian
+    numpy.einsum('k,ykx->yx', self.shadowKernel, self.windows, out=self.correlation)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+      sumGI = self.tailSum[::-1] - self.correlation
+      for y in range(min(5, ny)):
+        sumGI[y] = numpy.dot(self.model[:ny - y], gaussian[y:])
+      numpy.divide(sumGI, self.sumG, out=shadow, casting='unsafe')
+      shadow[~mask] = 0.0
+      normalize(shadow, True)
+
+      # BSP
+      numpy.power(shadow, self.params['shadowVSIntensity'], out=shadow)
+      shadow *= reflection
+    return normalize(shadow, False, 255)
+
+#-----------------------------------------------------------------------------
+def processVolume(sliceFunction, inputVolume, firstSliceIndex=-1, lastSliceIndex=-1, outputVolume=None, numberOfThreads=1, stageTimes=None, sliceTimes=None, sliceIndices=None):
+  """Applies sliceFunction(image, stageTimes), which returns the BSP of a 2D slice, to the slices of a volume
+  as described in foroughi2007, which is its application to foroughi2007Slice. Other enhancers (see
+  Algorithms.py) share the slice selection, threading, timing and output conversion this way."""
+  inputVolume = numpy.asarray(inputVolume)
+  is2D = (inputVolume.ndim == 2)
+  if is2D:
+    inputVolume = inputVolume[numpy.newaxis]
+  if inputVolume.ndim != 3:
+    raise ValueError('Expected a 2D or 3D array, got shape %s' % (inputVolume.shape,))
+  nz = inputVolume.shape[0]
+
+  if outputVolume is None:
+    outputVolume = numpy.zeros(inputVolume.shape, dtype=numpy.float64)
+  elif outputVolume.shape != inputVolume.shape and not (is2D and outputVolume.shape == inputVolume.shape[1:]):
+    raise ValueError('Output shape %s does not match input shape %s' % (outputVolume.shape, inputVolume.shape))
+  output = outputVolume[numpy.newaxis] if outputVolume.ndim == 2 else outputVolume
+
+  if firstSliceIndex < 0 or lastSliceIndex < 0 or firstSliceIndex > lastSliceIndex:
+    firstSliceIndex = 0
+    lastSliceIndex = nz - 1
+
+  stageTimesLock = threading.Lock()
+  def processSlice(sliceIndex):
+    startTime = timeit.default_timer() if sliceTimes is not None else None
+    image = inputVolume[sliceIndex]
+    # If slice has not all zero pixels...
+    skipped = maxPixelValue(image) <= 0
+    if not skipped:
+      sliceStageTimes = {} if stageTimes is not None else None
+      bsp = sliceFunction(image, sliceStageTimes)
+      timer = StageTimer(sliceStageTimes)
+      output[sliceIndex] = castToType(bsp, output.dtype)
+      timer.stop('conversion')
+      if sliceStageTimes:
+        with stageTimesLock:
+          for stageName, seconds in sliceStageTimes.items():
+            stageTimes[stageName] = stageTimes.get(stageName, 0.0) + seconds
+    if sliceTimes is not None:
+      # list.append is atomic, so the threads need no lock
+      sliceTimes.append((sliceIndex, startTime, timeit.default_timer() - startTime, threading.current_thread().ident, skipped))
+
+  if sliceIndices is None:
+    sliceIndices = range(firstSliceIndex, min(lastSliceIndex, nz - 1) + 1)
+  else:
+    sliceIndices = [sliceIndex for sliceIndex in sliceIndices if 0 <= sliceIndex < nz]
+  numberOfThreads = min(numberOfThreads, len(sliceIndices))
+  if numberOfThreads > 1:
+    pool = ThreadPool(numberOfThreads)
+    try:
+      pool.map(processSlice, sliceIndices)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for sliceIndex in sliceIndices:
+      processSlice(sliceIndex)
+
+  return outputVolume
+
+#-----------------------------------------------------------------------------
+def foroughi2007(inputVolume, smoothingSigma=5.0, transducerMargin=60, shadowSigma=6.0, boneThreshold=0.4, blurredVSBLoG=3.0, shadowVSIntensity=5.0, firstSliceIndex=-1, lastSliceIndex=-1, outputVolume=None, numberOfThreads=1, stageTimes=None, sliceTimes=None, sliceIndices=None):
+  """Extracts the BSP from an US volume of shape (nz, ny, nx), or an image of shape (ny, nx).
+
+  Slices outside [firstSliceIndex, lastSliceIndex] and slices without any positive pixel
+  are not processed (left zero, or untouched if outputVolume is given). A negative or
+  inverted range processes all slices, like the C++ ImageProcessingConnector.
+  sliceIndices, if given, is the list of slices to process instead of the range; it
+  need not be contiguous.
+  Slices are distributed across numberOfThreads threads (NumPy releases the GIL in
+  the array operations). The input is never modified. Returns the output volume
+  (float64 unless outputVolume is given, which can be of any numeric type).
+  If stageTimes is a dictionary, the wall time of each stage, summed over slices, is added to it.
+  If sliceTimes is a list, a (slice index, start time, duration, thread identifier, skipped) tuple is
+  appended to it for every slice, with times in seconds of timeit.default_timer.
+  """
+  def sliceFunction(image, sliceStageTimes):
+    return foroughi2007Slice(image, smoothingSigma, transducerMargin, shadowSigma, boneThreshold, blurredVSBLoG, shadowVSIntensity, sliceStageTimes)
+  return processVolume(sliceFunction, inputVolume, firstSliceIndex, lastSliceIndex, outputVolume, numberOfThreads, stageTimes, sliceTimes, sliceIndices)
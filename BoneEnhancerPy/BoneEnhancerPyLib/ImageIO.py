@@ -0,0 +1,293 @@
+"""
+Minimal readers and writers of the image files used by the BoneEnhancer, without Slicer.
+
+Volumes are returned as (nz, ny, nx) NumPy arrays, i.e. in the memory layout of
+vtkImageData scalars, together with a dictionary of the header fields. MetaImage
+(.mha, .mhd) and NRRD (.nrrd, .nhdr) files with a single component are supported.
+Files are written uncompressed, slice by slice (ImageWriter), so that a volume
+can be written while it is computed. Uncompressed files, and .raw files of a known
+shape and type, can also be accessed a slab of slices at a time through memory maps
+(MemoryMappedImage), for volumes which do not fit in memory.
+"""
+
+import os
+import zlib
+import numpy
+
+# MetaImage element types
+METAIMAGE_TYPES = {'MET_UCHAR' : numpy.uint8,
+                   'MET_CHAR' : numpy.int8,
+                   'MET_USHORT' : numpy.uint16,
+                   'MET_SHORT' : numpy.int16,
+                   'MET_UINT' : numpy.uint32,
+                   'MET_INT' : numpy.int32,
+                   'MET_FLOAT' : numpy.float32,
+                   'MET_DOUBLE' : numpy.float64}
+
+# NRRD types, with all their aliases, and the name written for each NumPy type (the first alias)
+NRRD_TYPES = {}
+NRRD_TYPE_NAMES = {}
+for _names, _dtype in [(('signed char', 'int8', 'int8_t'), numpy.int8),
+                       (('uchar', 'unsigned char', 'uint8', 'uint8_t'), numpy.uint8),
+                       (('short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'), numpy.int16),
+                       (('ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'), numpy.uint16),
+                       (('int', 'signed int', 'int32', 'int32_t'), numpy.int32),
+                       (('uint', 'unsigned int', 'uint32', 'uint32_t'), numpy.uint32),
+                       (('float',), numpy.float32),
+                       (('double',), numpy.float64)]:
+  for _name in _names:
+    NRRD_TYPES[_name] = _dtype
+  NRRD_TYPE_NAMES[numpy.dtype(_dtype)] = _names[0]
+
+# Header fields which define the geometry of a volume, copied from the input to the output
+METAIMAGE_GEOMETRY_FIELDS = ('TransformMatrix', 'Offset', 'CenterOfRotation', 'AnatomicalOrientation', 'ElementSpacing')
+NRRD_GEOMETRY_FIELDS = ('space', 'space dimension', 'space units', 'space origin', 'space directions', 'measurement frame', 'spacings', 'kinds')
+
+#-----------------------------------------------------------------------------
+def readMetaImageHeader(filePath):
+  """Returns the header fields of a MetaImage (.mha or .mhd) file, and the offset of the
+  data in the file if it is stored locally (ElementDataFile = LOCAL), otherwise None."""
+  header = {}
+  with open(filePath, 'rb') as f:
+    while True:
+      line = f.readline()
+      if not line:
+        raise ValueError('No ElementDataFile in MetaImage header of ' + filePath)
+      key, _, value = line.decode('latin-1').partition('=')
+      header[key.strip()] = value.strip()
+      if key.strip() == 'ElementDataFile':
+        return header, (f.tell() if header['ElementDataFile'] == 'LOCAL' else None)
+
+#-----------------------------------------------------------------------------
+def metaImageShape(header):
+  """Returns the (nz, ny, nx) shape and the NumPy type of the voxels of a MetaImage header."""
+  dimensions = [int(value) for value in header['DimSize'].split()]
+  dimensions += [1] * (3 - len(dimensions))
+  if header.get('ElementNumberOfChannels', '1') != '1':
+    raise ValueError('Only single channel MetaImages are supported')
+  if header['ElementType'] not in METAIMAGE_TYPES:
+    raise ValueError('Unsupported MetaImage element type ' + header['ElementType'])
+  dtype = numpy.dtype(METAIMAGE_TYPES[header['ElementType']])
+  if header.get('BinaryDataByteOrderMSB', header.get('ElementByteOrderMSB', 'False')) == 'True':
+    dtype = dtype.newbyteorder('>')
+  return (dimensions[2], dimensions[1], dimensions[0]), dtype
+
+#-----------------------------------------------------------------------------
+def readMetaImage(filePath):
+  """Reads a MetaImage (.mha, or .mhd with its data file), compressed or not.
+  Returns the (nz, ny, nx) voxel array and the header fields."""
+  header, dataOffset = readMetaImageHeader(filePath)
+  shape, dtype = metaImageShape(header)
+  if dataOffset is not None:
+    with open(filePath, 'rb') as f:
+      f.seek(dataOffset)
+      data = f.read()
+  else:
+    with open(os.path.join(os.path.dirname(filePath), header['ElementDataFile']), 'rb') as f:
+      data = f.read()
+  if header.get('CompressedData', 'False') == 'True':
+    data = zlib.decompress(data)
+  size = int(numpy.prod(shape))
+  return numpy.frombuffer(data, dtype=dtype, count=size).reshape(shape).astype(dtype.newbyteorder('='), copy=True), header
+
+#-----------------------------------------------------------------------------
+def readNrrdHeader(filePath):
+  """Returns the fields of a NRRD (.nrrd or .nhdr) header, and the offset of the data in the file
+  if it is stored in the same file, otherwise None (detached data file)."""
+  header = {}
+  with open(filePath, 'rb') as f:
+    if not f.readline().startswith(b'NRRD'):
+      raise ValueError('Not a NRRD file: ' + filePath)
+    while True:
+      line = f.readline()
+      text = line.decode('latin-1').rstrip('\r\n')
+      # The header ends with an empty line, or the end of a detached header
+      if not line or not text:
+        return header, (f.tell() if 'data file' not in header and 'datafile' not in header else None)
+      if text.startswith('#') or ':' not in text:
+        continue
+      key, _, value = text.partition(':')
+      header[key.strip()] = value.lstrip('=').strip()
+
+#-----------------------------------------------------------------------------
+def nrrdShape(header):
+  """Returns the (nz, ny, nx) shape and the NumPy type of the voxels of a NRRD header."""
+  dimensions = [int(value) for value in header['sizes'].split()]
+  if len(dimensions) > 3 or int(header['dimension']) != len(dimensions):
+    raise ValueError('Only single component 2D and 3D NRRD files are supported')
+  dimensions += [1] * (3 - len(dimensions))
+  if header['type'] not in NRRD_TYPES:
+    raise ValueError('Unsupported NRRD type ' + header['type'])
+  dtype = numpy.dtype(NRRD_TYPES[header['type']])
+  if header.get('endian', 'little') == 'big':
+    dtype = dtype.newbyteorder('>')
+  return (dimensions[2], dimensions[1], dimensions[0]), dtype
+
+#-----------------------------------------------------------------------------
+def readNrrd(filePath):
+  """Reads a NRRD file (.nrrd, or .nhdr with its data file), raw or gzip encoded.
+  Returns the (nz, ny, nx) voxel array and the header fields."""
+  header, dataOffset = readNrrdHeader(filePath)
+  shape, dtype = nrrdShape(header)
+  dataFilePath = filePath
+  if dataOffset is None:
+    dataFilePath = os.path.join(os.path.dirname(filePath), header.get('data file', header.get('datafile')))
+    dataOffset = 0
+  with open(dataFilePath, 'rb') as f:
+    f.seek(dataOffset)
+    data = f.read()
+  encoding = header.get('encoding', 'raw')
+  if encoding in ('gzip', 'gz'):
+    data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+  elif encoding != 'raw':
+    raise ValueError('Unsupported NRRD encoding ' + encoding)
+  size = int(numpy.prod(shape))
+  return numpy.frombuffer(data, dtype=dtype, count=size).reshape(shape).astype(dtype.newbyteorder('='), copy=True), header
+
+#-----------------------------------------------------------------------------
+def isNrrd(filePath):
+  return os.path.splitext(filePath)[1].lower() in ('.nrrd', '.nhdr')
+
+#-----------------------------------------------------------------------------
+def isRaw(filePath):
+  return os.path.splitext(filePath)[1].lower() == '.raw'
+
+#-----------------------------------------------------------------------------
+def readImage(filePath):
+  """Reads a MetaImage or NRRD file, depending on its extension. Returns the (nz, ny, nx) voxel array and the header fields."""
+  return readNrrd(filePath) if isNrrd(filePath) else readMetaImage(filePath)
+
+#-----------------------------------------------------------------------------
+def imageLayout(filePath):
+  """Returns the header fields, (nz, ny, nx) shape and voxel type of a MetaImage or NRRD file, the file and offset
+  of its data, and whether the data is compressed."""
+  if isNrrd(filePath):
+    header, dataOffset = readNrrdHeader(filePath)
+    shape, dtype = nrrdShape(header)
+    compressed = header.get('encoding', 'raw') != 'raw'
+    dataFileName = header.get('data file', header.get('datafile'))
+  else:
+    header, dataOffset = readMetaImageHeader(filePath)
+    shape, dtype = metaImageShape(header)
+    compressed = header.get('CompressedData', 'False') == 'True'
+    dataFileName = header['ElementDataFile']
+  if dataOffset is None:
+    return header, shape, dtype, os.path.join(os.path.dirname(filePath), dataFileName), 0, compressed
+  return header, shape, dtype, filePath, dataOffset, compressed
+
+#-----------------------------------------------------------------------------
+def isUncompressed(filePath):
+  """Returns True if the voxels of a file can be memory mapped: a .raw file, or a MetaImage or NRRD file with uncompressed data."""
+  return isRaw(filePath) or not imageLayout(filePath)[5]
+
+#-----------------------------------------------------------------------------
+def imageHeader(filePath, shape, dtype, referenceHeader=None):
+  """Returns the header of an uncompressed MetaImage or NRRD file (depending on the extension) with its data in the
+  same file, or no header for a .raw file. The geometry is copied from referenceHeader, the header of a 3D file of the
+  same format, e.g. the input of the processing."""
+  if isRaw(filePath):
+    return b''
+  referenceHeader = referenceHeader or {}
+  dtype = numpy.dtype(numpy.dtype(dtype).type)
+  nz, ny, nx = shape
+  if isNrrd(filePath):
+    lines = ['NRRD0004',
+             'type: ' + NRRD_TYPE_NAMES[dtype],
+             'dimension: 3',
+             'sizes: %d %d %d' % (nx, ny, nz),
+             'endian: little',
+             'encoding: raw']
+    if referenceHeader.get('dimension') == '3':
+      lines += ['%s: %s' % (field, referenceHeader[field]) for field in NRRD_GEOMETRY_FIELDS if field in referenceHeader]
+    return ('\n'.join(lines) + '\n\n').encode('latin-1')
+  elementType = dict((numpy.dtype(metaImageType), name) for name, metaImageType in METAIMAGE_TYPES.items())[dtype]
+  lines = ['ObjectType = Image',
+           'NDims = 3',
+           'BinaryData = True',
+           'BinaryDataByteOrderMSB = False',
+           'CompressedData = False']
+  if referenceHeader.get('NDims') == '3':
+    lines += ['%s = %s' % (field, referenceHeader[field]) for field in METAIMAGE_GEOMETRY_FIELDS if field in referenceHeader]
+  lines += ['DimSize = %d %d %d' % (nx, ny, nz),
+            'ElementType = ' + elementType,
+            'ElementDataFile = LOCAL']
+  return ('\n'.join(lines) + '\n').encode('latin-1')
+
+#-----------------------------------------------------------------------------
+class ImageWriter:
+  """Writes a volume of the given (nz, ny, nx) shape and type to an uncompressed MetaImage, NRRD or .raw file
+  (depending on the extension), slice by slice in order. The geometry is copied from referenceHeader (see imageHeader)."""
+
+  def __init__(self, filePath, shape, dtype, referenceHeader=None):
+    self.filePath = filePath
+    self.shape = tuple(shape)
+    self.dtype = numpy.dtype(dtype).newbyteorder('<')
+    self.numberOfWrittenSlices = 0
+    self.file = open(filePath, 'wb')
+    self.file.write(imageHeader(filePath, self.shape, self.dtype, referenceHeader))
+    self.dataOffset = self.file.tell()
+
+  def writeSlice(self, image):
+    """Writes the next slice, converted to the type of the file."""
+    if self.numberOfWrittenSlices >= self.shape[0]:
+      raise ValueError('All %d slices have already been written' % self.shape[0])
+    self.file.write(numpy.ascontiguousarray(image, dtype=self.dtype).reshape(self.shape[1:]).tobytes())
+    self.numberOfWrittenSlices += 1
+
+  def close(self):
+    self.file.close()
+    if self.numberOfWrittenSlices != self.shape[0]:
+      raise ValueError('Only %d of %d slices were written to %s' % (self.numberOfWrittenSlices, self.shape[0], self.filePath))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    if excType is None:
+      self.close()
+    else:
+      # Do not leave a truncated file behind
+      self.file.close()
+      os.remove(self.filePath)
+
+#-----------------------------------------------------------------------------
+class MemoryMappedImage:
+  """The voxels of an uncompressed MetaImage or NRRD file, or of a .raw file of the given (nz, ny, nx) shape and type,
+  accessed a slab of slices at a time through memory maps. Only the slabs in use are mapped, so the memory used does
+  not depend on the number of slices. create() makes a new file to write to."""
+
+  def __init__(self, filePath, shape=None, dtype=None, writable=False):
+    self.filePath = filePath
+    self.writable = writable
+    if isRaw(filePath):
+      if shape is None or dtype is None:
+        raise ValueError('The shape and type of a .raw file must be given')
+      self.header = {}
+      self.shape = tuple(shape)
+      self.dtype = numpy.dtype(dtype)
+      self.dataFilePath = filePath
+      self.dataOffset = 0
+    else:
+      self.header, self.shape, self.dtype, self.dataFilePath, self.dataOffset, compressed = imageLayout(filePath)
+      if compressed:
+        raise ValueError('Compressed files cannot be memory mapped: ' + filePath)
+    self.sliceSize = self.shape[1] * self.shape[2] * self.dtype.itemsize
+
+  @staticmethod
+  def create(filePath, shape, dtype, referenceHeader=None):
+    """Creates a file of the given (nz, ny, nx) shape and type, with a header (see imageHeader) and all voxels zero,
+    and returns it as a writable MemoryMappedImage."""
+    dtype = numpy.dtype(dtype).newbyteorder('<')
+    with open(filePath, 'wb') as f:
+      f.write(imageHeader(filePath, shape, dtype, referenceHeader))
+      # Sizes the file without writing the voxels, which read as zero
+      f.truncate(f.tell() + int(numpy.prod(shape)) * dtype.itemsize)
+    return MemoryMappedImage(filePath, shape, dtype, writable=True)
+
+  def slab(self, firstSlice, lastSlice):
+    """Returns slices firstSlice to lastSlice (included) as a (lastSlice - firstSlice + 1, ny, nx) memory map. It is
+    unmapped when it is no longer referenced; changes to the slab of a writable image are then in the file."""
+    if firstSlice < 0 or lastSlice >= self.shape[0] or firstSlice > lastSlice:
+      raise IndexError('Slices %d to %d out of range for %d slices' % (firstSlice, lastSlice, self.shape[0]))
+    return numpy.memmap(self.dataFilePath, dtype=self.dtype, mode='r+' if self.writable else 'r',
+                        offset=self.dataOffset + firstSlice * self.sliceSize, shape=(lastSlice - firstSlice + 1,) + self.shape[1:])
@@ -0,0 +1,90 @@
+"""
+Incremental BSP extraction, which only recomputes the slices that are out of date.
+
+A SliceTracker remembers, for every slice of an output volume, a hash of the input
+slice and the parameters its BSP was computed with. A slice is stale if it was never
+computed, if its input or the parameters changed since, or if it was invalidated,
+e.g. because the output was edited. The module's logic
+(BoneEnhancerPyLogic.calculateBoneEnhancedImageIncremental) processes only the stale
+slices, so an edited region is recomputed in time proportional to its size, and a
+sweep that grows by appended frames in time proportional to the new frames.
+
+Sets of slices are given as lists of (first, last) ranges, last included, which need
+not be contiguous or sorted (sliceIndices and sliceRanges convert).
+"""
+
+import hashlib
+import numpy
+
+#-----------------------------------------------------------------------------
+def sliceHash(image):
+  """Returns a hash of the voxels of a slice."""
+  return hashlib.sha1(numpy.ascontiguousarray(image).view(numpy.uint8)).digest()
+
+#-----------------------------------------------------------------------------
+def sliceIndices(ranges, numberOfSlices):
+  """Returns the sorted slice indices in a list of (first, last) ranges, within [0, numberOfSlices).
+  None is all slices."""
+  if ranges is None:
+    return list(range(numberOfSlices))
+  indices = set()
+  for firstSlice, lastSlice in ranges:
+    indices.update(range(max(firstSlice, 0), min(lastSlice, numberOfSlices - 1) + 1))
+  return sorted(indices)
+
+#-----------------------------------------------------------------------------
+def sliceRanges(indices):
+  """Returns slice indices as a sorted list of (first, last) ranges of consecutive slices."""
+  ranges = []
+  for sliceIndex in sorted(set(indices)):
+    if ranges and ranges[-1][1] == sliceIndex - 1:
+      ranges[-1] = (ranges[-1][0], sliceIndex)
+    else:
+      ranges.append((sliceIndex, sliceIndex))
+  return ranges
+
+#-----------------------------------------------------------------------------
+class SliceTracker:
+  """Tracks which input and parameters produced each slice of an output volume.
+
+  The key of a slice is its input hash (sliceHash) and the parameters (a dictionary, e.g. of
+  Foroughi2007.keywordParameters). A change of the slice size or of the input or output type
+  makes every slice stale; a change of the number of slices keeps the slices that still exist.
+  """
+
+  def __init__(self):
+    self.layout = None
+    self.sliceKeys = {}
+
+  def invalidate(self, ranges=None):
+    """Makes the slices in ranges, or all slices if ranges is None, stale."""
+    if ranges is None:
+      self.sliceKeys = {}
+      return
+    for firstSlice, lastSlice in ranges:
+      for sliceIndex in range(firstSlice, lastSlice + 1):
+        self.sliceKeys.pop(sliceIndex, None)
+
+  def staleSlices(self, inputVolume, params, outputType, ranges=None):
+    """Returns the stale slices among the slices in ranges (all if None), and a dictionary of their
+    keys to pass to markComputed once they are computed."""
+    layout = (inputVolume.shape[1:], numpy.dtype(inputVolume.dtype), numpy.dtype(outputType))
+    if layout != self.layout:
+      self.layout = layout
+      self.sliceKeys = {}
+    numberOfSlices = inputVolume.shape[0]
+    for sliceIndex in [sliceIndex for sliceIndex in self.sliceKeys if sliceIndex >= numberOfSlices]:
+      del self.sliceKeys[sliceIndex]
+    parameterKey = tuple(sorted(params.items()))
+    staleKeys = {}
+    for sliceIndex in sliceIndices(ranges, numberOfSlices):
+      key = (sliceHash(inputVolume[sliceIndex]), parameterKey)
+      if self.sliceKeys.get(sliceIndex) != key:
+        staleKeys[sliceIndex] = key
+    return sorted(staleKeys.keys()), staleKeys
+
+  def markComputed(self, staleKeys, indices=None):
+    """Records that the slices of staleKeys (returned by staleSlices), or only the given indices of them,
+    were computed."""
+    for sliceIndex in (staleKeys.keys() if indices is None else indices):
+      self.sliceKeys[sliceIndex] = staleKeys[sliceIndex]
@@ -0,0 +1,130 @@
+"""
+Instrumentation of the BSP extraction, for either engine.
+
+An Instrumentation records one extraction: its wall time, the time of each stage
+(Foroughi2007.STAGE_NAMES) summed over the slices, the start time, duration and worker
+thread of each slice, the number of slices skipped because all their pixels are zero,
+the bytes of scratch memory allocated and the number of threads used. A record can be
+logged as one line (summary), appended to a JSON lines file (appendToLog), and records
+can be written as a trace file in the Chrome trace event format (writeTrace), which
+chrome://tracing and https://ui.perfetto.dev display as a timeline of the slices.
+
+Instrumentation is only created when it is enabled, so it costs nothing when it is off.
+"""
+
+import collections
+import json
+import time
+import timeit
+
+from BoneEnhancerPyLib import Foroughi2007
+
+try:
+  import tracemalloc
+except ImportError:
+  # Python 2, the NumPy engine reports no allocated bytes
+  tracemalloc = None
+
+# Time of a slice, startTime is in seconds since the start of the extraction, thread is the index of the worker thread
+SliceTime = collections.namedtuple('SliceTime', ['sliceIndex', 'startTime', 'duration', 'thread', 'skipped'])
+
+#-----------------------------------------------------------------------------
+class Instrumentation:
+  """Instrumentation of one BSP extraction. Call start() before and stop() after the extraction, and add the
+  stage and slice times reported by the engine in between."""
+
+  def __init__(self, engine, name=''):
+    self.engine = engine
+    self.name = name
+    self.timestamp = time.time()
+    self.startTime = timeit.default_timer()
+    self.runtime = 0.0
+    self.stageTimes = dict((stageName, 0.0) for stageName in Foroughi2007.STAGE_NAMES)
+    self.sliceTimes = []
+    self.numberOfSkippedSlices = 0
+    self.numberOfAllocatedBytes = 0
+    self.numberOfThreads = 0
+    self.threadIndices = {}
+    self.tracingMemory = False
+
+  def start(self, traceMemory=False):
+    """Starts timing the extraction. If traceMemory is True, the peak of the memory allocated by Python and NumPy
+    until stop() is reported as allocated bytes (tracemalloc, unless it is already tracing for something else)."""
+    self.timestamp = time.time()
+    self.startTime = timeit.default_timer()
+    self.tracingMemory = traceMemory and tracemalloc is not None and not tracemalloc.is_tracing()
+    if self.tracingMemory:
+      tracemalloc.start()
+
+  def stop(self):
+    self.runtime = timeit.default_timer() - self.startTime
+    self.numberOfThreads = max(self.numberOfThreads, len(self.threadIndices))
+    if self.tracingMemory:
+      self.numberOfAllocatedBytes += tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      self.tracingMemory = False
+
+  def addStageTimes(self, stageTimes):
+    """Adds a dictionary of stage name -> seconds."""
+    for stageName, seconds in stageTimes.items():
+      self.stageTimes[stageName] = self.stageTimes.get(stageName, 0.0) + seconds
+
+  def addSliceTime(self, sliceIndex, startTime, duration, thread, skipped):
+    """Adds the time of a slice. startTime is a time of timeit.default_timer, thread identifies the worker thread
+    and is numbered in the order of appearance."""
+    if thread not in self.threadIndices:
+      self.threadIndices[thread] = len(self.threadIndices)
+    self.sliceTimes.append(SliceTime(int(sliceIndex), startTime - self.startTime, duration, self.threadIndices[thread], bool(skipped)))
+    if skipped:
+      self.numberOfSkippedSlices += 1
+
+  def addForoughi2007Times(self, stageTimes, sliceTimes):
+    """Adds the stageTimes and sliceTimes filled by Foroughi2007.foroughi2007."""
+    self.addStageTimes(stageTimes)
+    for sliceIndex, startTime, duration, thread, skipped in sliceTimes:
+      self.addSliceTime(sliceIndex, startTime, duration, thread, skipped)
+
+  def toDict(self):
+    return {'engine' : self.engine,
+            'name' : self.name,
+            'timestamp' : self.timestamp,
+            'runtime' : self.runtime,
+            'stageTimes' : self.stageTimes,
+            'sliceTimes' : [sliceTime._asdict() for sliceTime in self.sliceTimes],
+            'numberOfSlices' : len(self.sliceTimes),
+            'numberOfSkippedSlices' : self.numberOfSkippedSlices,
+            'numberOfAllocatedBytes' : self.numberOfAllocatedBytes,
+            'numberOfThreads' : self.numberOfThreads}
+
+  def summary(self):
+    """Returns a one line summary, with the stages in the order of Foroughi2007.STAGE_NAMES."""
+    stages = ', '.join('%s %.1f ms' % (stageName, 1000 * self.stageTimes.get(stageName, 0.0)) for stageName in Foroughi2007.STAGE_NAMES)
+    return ('%s: %.3f s, %d slices (%d skipped), %d threads, %.1f MB allocated; %s' %
+            (self.engine, self.runtime, len(self.sliceTimes), self.numberOfSkippedSlices, self.numberOfThreads,
+             self.numberOfAllocatedBytes / 1e6, stages))
+
+  def appendToLog(self, filePath):
+    """Appends the record as one JSON line to a log file."""
+    with open(filePath, 'a') as f:
+      f.write(json.dumps(self.toDict(), sort_keys=True) + '\n')
+
+#-----------------------------------------------------------------------------
+def traceEvents(instrumentation, processId=0):
+  """Returns the Chrome trace events of a record: the extraction on row 0, and each slice on the row of its worker thread plus one."""
+  startTime = 1e6 * instrumentation.timestamp
+  args = dict((key, value) for key, value in instrumentation.toDict().items() if key != 'sliceTimes')
+  events = [{'name' : instrumentation.name or 'BSP', 'cat' : instrumentation.engine, 'ph' : 'X', 'pid' : processId, 'tid' : 0,
+             'ts' : startTime, 'dur' : 1e6 * instrumentation.runtime, 'args' : args}]
+  for sliceTime in instrumentation.sliceTimes:
+    events.append({'name' : 'slice %d' % sliceTime.sliceIndex + (' (skipped)' if sliceTime.skipped else ''), 'cat' : instrumentation.engine,
+                   'ph' : 'X', 'pid' : processId, 'tid' : sliceTime.thread + 1, 'ts' : startTime + 1e6 * sliceTime.startTime, 'dur' : 1e6 * sliceTime.duration})
+  return events
+
+#-----------------------------------------------------------------------------
+def writeTrace(instrumentations, filePath):
+  """Writes records to a trace file in the Chrome trace event format."""
+  events = []
+  for instrumentation in instrumentations:
+    events += traceEvents(instrumentation)
+  with open(filePath, 'w') as f:
+    json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
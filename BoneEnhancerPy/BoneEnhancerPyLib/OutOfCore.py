@@ -0,0 +1,85 @@
+"""
+Out-of-core BSP extraction of volumes which do not fit in memory, without Slicer.
+
+The input, an uncompressed MetaImage (.mha, .mhd) or NRRD (.nrrd, .nhdr) file or a
+.raw file of a given shape and type, is memory mapped and processed a slab of slices
+at a time with the per-slice algorithm (Foroughi2007.foroughi2007). The BSP of each
+slab is written straight into a memory map of the output file, which is unmapped
+before the next slab, so the memory used is bounded by the size of a slab and not
+by the number of slices:
+
+  python -m BoneEnhancerPyLib.OutOfCore sweep.mha sweep_BSP.mha --slab-size 32
+  python -m BoneEnhancerPyLib.OutOfCore sweep.raw sweep_BSP.raw --shape 2000x280x440 --type uint8
+"""
+
+import argparse
+import sys
+import timeit
+import numpy
+
+from BoneEnhancerPyLib import Algorithms
+from BoneEnhancerPyLib import Foroughi2007
+from BoneEnhancerPyLib import ImageIO
+
+# Number of slices mapped at a time
+DEFAULT_SLAB_SIZE = 16
+
+#-----------------------------------------------------------------------------
+def slabRanges(numberOfSlices, slabSize=DEFAULT_SLAB_SIZE):
+  """Returns the (first, last) slice indices, included, of the slabs of a volume."""
+  slabSize = max(1, slabSize)
+  return [(firstSlice, min(firstSlice + slabSize, numberOfSlices) - 1) for firstSlice in range(0, numberOfSlices, slabSize)]
+
+#-----------------------------------------------------------------------------
+def foroughi2007OutOfCore(inputFilePath, outputFilePath, params=None, outputType=numpy.float64, slabSize=DEFAULT_SLAB_SIZE,
+                          numberOfThreads=1, inputShape=None, inputType=None, progressCallback=None):
+  """Writes the BSP of an uncompressed volume file to outputFilePath (MetaImage, NRRD or .raw, depending on the
+  extension, with the geometry of the input), slabSize slices at a time. inputShape, as (nz, ny, nx), and inputType
+  are only needed for a .raw input. params are named as declared by Algorithms.FOROUGHI2007, the defaults where missing.
+  progressCallback, if given, is called with the number of slices done after each slab. Returns a dictionary describing
+  the result."""
+  params = Algorithms.FOROUGHI2007.parameters(params)
+  startTime = timeit.default_timer()
+  inputImage = ImageIO.MemoryMappedImage(inputFilePath, inputShape, inputType)
+  outputImage = ImageIO.MemoryMappedImage.create(outputFilePath, inputImage.shape, outputType, inputImage.header)
+  keywordParameters = Foroughi2007.keywordParameters(params)
+  numberOfSkippedSlices = 0
+  for firstSlice, lastSlice in slabRanges(inputImage.shape[0], slabSize):
+    inputSlab = inputImage.slab(firstSlice, lastSlice)
+    outputSlab = outputImage.slab(firstSlice, lastSlice)
+    sliceTimes = []
+    Foroughi2007.foroughi2007(inputSlab, outputVolume=outputSlab, numberOfThreads=numberOfThreads, sliceTimes=sliceTimes, **keywordParameters)
+    outputSlab.flush()
+    numberOfSkippedSlices += len([sliceTime for sliceTime in sliceTimes if sliceTime[4]])
+    # Unmap the slab, so that its pages can be reclaimed
+    del inputSlab, outputSlab
+    if progressCallback:
+      progressCallback(lastSlice + 1)
+  return {'input' : inputFilePath, 'output' : outputFilePath, 'shape' : list(inputImage.shape), 'slabSize' : slabSize,
+          'numberOfSkippedSlices' : numberOfSkippedSlices, 'runtime' : timeit.default_timer() - startTime}
+
+#-----------------------------------------------------------------------------
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Extracts the bone surface probability of an uncompressed volume file a slab of slices at a time (Foroughi2007, NumPy engine).')
+  parser.add_argument('input', help='input file (.mha, .mhd, .nrrd, .nhdr, uncompressed, or .raw with --shape and --type)')
+  parser.add_argument('output', help='output file (.mha, .nrrd or .raw)')
+  parser.add_argument('--slab-size', type=int, default=DEFAULT_SLAB_SIZE, help='number of slices mapped at a time (default %(default)s)')
+  parser.add_argument('--threads', type=int, default=1, help='number of threads processing the slices of a slab (default %(default)s)')
+  parser.add_argument('--output-type', default='float64', help='NumPy type of the output (default %(default)s)')
+  parser.add_argument('--shape', help='shape of a .raw input, as FRAMESxDEPTHxWIDTH')
+  parser.add_argument('--type', help='NumPy type of a .raw input, e.g. uint8')
+  args = parser.parse_args(argv)
+
+  inputShape = tuple(int(value) for value in args.shape.lower().split('x')) if args.shape else None
+  if ImageIO.isRaw(args.input) and (inputShape is None or len(inputShape) != 3 or not args.type):
+    parser.error('a .raw input needs --shape FRAMESxDEPTHxWIDTH and --type')
+  if not ImageIO.isUncompressed(args.input):
+    parser.error('the input is compressed and cannot be memory mapped')
+  log = lambda message: sys.stdout.write(message + '\n')
+  result = foroughi2007OutOfCore(args.input, args.output, outputType=numpy.dtype(args.output_type), slabSize=args.slab_size,
+                                 numberOfThreads=args.threads, inputShape=inputShape, inputType=args.type)
+  log('%s -> %s: %d slices (%d skipped) in %.3f s' % (result['input'], result['output'], result['shape'][0], result['numberOfSkippedSlices'], result['runtime']))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+BSP extraction restricted to a region of interest of a volume.
+
+A region is an index box ((firstSlice, lastSlice), (firstRow, lastRow), (firstColumn,
+lastColumn)) of a (nz, ny, nx) volume, last included, in which a None range is the
+whole axis and a None first or last the start or end of the axis. Only the voxels of
+the box are processed, and the output is zero outside it:
+
+  box = ((0, 99), (60, None), (40, 399))
+  bsp, box = RegionOfInterest.processRegion(Algorithms.getAlgorithm('Foroughi2007'), volume, params, box)
+
+Each slice of the box is processed as an image of its own, so the BSP is normalized
+within the box, and the TransducerMargin, which counts rows from the top of the
+slice, is counted from the top of the volume (regionParameters).
+"""
+
+import numpy
+
+#-----------------------------------------------------------------------------
+def clipBox(box, shape):
+  """Returns a box, or None for the whole volume, clipped to a volume shape, with None replaced by the whole axis or its ends.
+  Raises ValueError if the clipped box is empty."""
+  if box is None:
+    box = (None, None, None)
+  if len(box) != len(shape):
+    raise ValueError('Expected a box of %d (first, last) ranges, got %s' % (len(shape), box))
+  clipped = []
+  for axisRange, size in zip(box, shape):
+    first, last = (None, None) if axisRange is None else axisRange
+    first = 0 if first is None else max(int(first), 0)
+    last = size - 1 if last is None else min(int(last), size - 1)
+    if first > last:
+      raise ValueError('The box %s is outside the volume of shape %s' % (box, shape))
+    clipped.append((first, last))
+  return tuple(clipped)
+
+#-----------------------------------------------------------------------------
+def boxSlices(box):
+  """Returns the index of the voxels of a (clipped) box, e.g. volume[boxSlices(box)]."""
+  return tuple(slice(first, last + 1) for first, last in box)
+
+#-----------------------------------------------------------------------------
+def regionParameters(params, box):
+  """Returns the parameters (named as the parameters of Algorithms) with which the region of a (clipped) box is
+  processed: the TransducerMargin, if there is one, is reduced by the rows above the box."""
+  params = dict(params)
+  if 'TransducerMargin' in params:
+    params['TransducerMargin'] = type(params['TransducerMargin'])(max(params['TransducerMargin'] - box[1][0], 0))
+  return params
+
+#-----------------------------------------------------------------------------
+def processRegion(algorithm, inputVolume, params, box, outputVolume=None, numberOfThreads=1, stageTimes=None, sliceTimes=None):
+  """Extracts the BSP of the voxels of a box of a (nz, ny, nx) volume with an algorithm (see Algorithms.Algorithm).
+  The output is zero outside the box. Returns the output volume (float64 unless outputVolume is given) and the
+  clipped box. The slice indices of sliceTimes are relative to the box."""
+  box = clipBox(box, inputVolume.shape)
+  if outputVolume is None:
+    outputVolume = numpy.zeros(inputVolume.shape, dtype=numpy.float64)
+  elif outputVolume.shape != inputVolume.shape:
+    raise ValueError('Output shape %s does not match input shape %s' % (outputVolume.shape, inputVolume.shape))
+  else:
+    outputVolume[...] = 0
+  region = boxSlices(box)
+  algorithm.process(inputVolume[region], regionParameters(params, box), outputVolume=outputVolume[region], numberOfThreads=numberOfThreads,
+                    stageTimes=stageTimes, sliceTimes=sliceTimes)
+  return outputVolume, box
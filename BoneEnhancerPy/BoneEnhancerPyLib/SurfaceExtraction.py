@@ -0,0 +1,111 @@
+"""
+Bone surface extraction by dynamic programming (Foroughi et al. 2007).
+
+The bone surface of a slice is the path through its bone surface probability (BSP)
+image, from the first to the last column, with one row per column, which minimizes
+the sum of the internal cost 1 - BSP/255 of its pixels plus smoothness times the
+vertical jump between neighbouring columns. Jumps are at most maximumJump rows.
+Columns where the BSP on the path is below minimumBSP are not bone.
+
+The minimum cost of every slice and row is updated column by column, each update
+being a few array operations on (nz, ny) arrays, so all slices of a sweep are
+extracted together. Volumes are indexed as [slice, row, column], like Foroughi2007.
+"""
+
+import numpy
+
+# Default parameters
+DEFAULT_MAXIMUM_JUMP = 3
+DEFAULT_SMOOTHNESS = 0.02
+DEFAULT_MINIMUM_BSP = 20.0
+
+#-----------------------------------------------------------------------------
+def internalCost(bspVolume):
+  """Returns the cost of a pixel to be on the surface, 0 for BSP = 255 and 1 for BSP = 0."""
+  return 1 - numpy.asarray(bspVolume, dtype=numpy.float64) / 255.0
+
+#-----------------------------------------------------------------------------
+def optimalPaths(cost, maximumJump=DEFAULT_MAXIMUM_JUMP, smoothness=DEFAULT_SMOOTHNESS):
+  """Returns the row of the minimum cost path of every slice and column, as a (nz, nx) int array,
+  for a cost volume of shape (nz, ny, nx)."""
+  nz, ny, nx = cost.shape
+  jumps = numpy.arange(-maximumJump, maximumJump + 1)
+  jumpCost = smoothness * numpy.abs(jumps)
+  # Minimum cost of the paths ending in each row of the current column, padded with infinity above and below
+  pathCost = numpy.full((nz, ny + 2 * maximumJump), numpy.inf)
+  pathCost[:, maximumJump:maximumJump + ny] = cost[:, :, 0]
+  # Jump into each pixel from the previous column of its minimum cost path
+  bestJump = numpy.zeros((nx, nz, ny), dtype=numpy.int8 if maximumJump < 128 else numpy.int32)
+  candidates = numpy.empty((len(jumps), nz, ny))
+  for x in range(1, nx):
+    # Candidate k comes from row y + jumps[k] of the previous column
+    for k in range(len(jumps)):
+      numpy.add(pathCost[:, maximumJump + jumps[k]:maximumJump + jumps[k] + ny], jumpCost[k], out=candidates[k])
+    best = numpy.argmin(candidates, axis=0)
+    bestJump[x] = jumps[best]
+    pathCost[:, maximumJump:maximumJump + ny] = numpy.take_along_axis(candidates, best[numpy.newaxis], axis=0)[0] + cost[:, :, x]
+
+  # Backtrack from the minimum cost row of the last column
+  paths = numpy.zeros((nz, nx), dtype=int)
+  sliceIndices = numpy.arange(nz)
+  paths[:, nx - 1] = numpy.argmin(pathCost[:, maximumJump:maximumJump + ny], axis=1)
+  for x in range(nx - 1, 0, -1):
+    paths[:, x - 1] = paths[:, x] + bestJump[x, sliceIndices, paths[:, x]]
+  return paths
+
+#-----------------------------------------------------------------------------
+def optimalPathsDirect(cost, maximumJump=DEFAULT_MAXIMUM_JUMP, smoothness=DEFAULT_SMOOTHNESS):
+  """Reference implementation of optimalPaths, looping over slices, columns, rows and jumps."""
+  nz, ny, nx = cost.shape
+  paths = numpy.zeros((nz, nx), dtype=int)
+  for z in range(nz):
+    pathCost = [cost[z, y, 0] for y in range(ny)]
+    bestJump = numpy.zeros((nx, ny), dtype=int)
+    for x in range(1, nx):
+      newPathCost = []
+      for y in range(ny):
+        minimumCost = numpy.inf
+        for jump in range(-maximumJump, maximumJump + 1):
+          if 0 <= y + jump < ny:
+            candidate = pathCost[y + jump] + smoothness * abs(jump)
+            if candidate < minimumCost:
+              minimumCost = candidate
+              bestJump[x, y] = jump
+        newPathCost.append(minimumCost + cost[z, y, x])
+      pathCost = newPathCost
+    paths[z, nx - 1] = int(numpy.argmin(pathCost))
+    for x in range(nx - 1, 0, -1):
+      paths[z, x - 1] = paths[z, x] + bestJump[x, paths[z, x]]
+  return paths
+
+#-----------------------------------------------------------------------------
+def boneSurface(bspVolume, maximumJump=DEFAULT_MAXIMUM_JUMP, smoothness=DEFAULT_SMOOTHNESS, minimumBSP=DEFAULT_MINIMUM_BSP):
+  """Extracts the bone surface from a BSP volume of shape (nz, ny, nx), or an image of shape (ny, nx).
+  Returns the surface row of every slice and column, as a (nz, nx) (or (nx,)) int array, which is -1
+  in columns without bone."""
+  bspVolume = numpy.asarray(bspVolume)
+  is2D = (bspVolume.ndim == 2)
+  if is2D:
+    bspVolume = bspVolume[numpy.newaxis]
+  if bspVolume.ndim != 3:
+    raise ValueError('Expected a 2D or 3D array, got shape %s' % (bspVolume.shape,))
+  surface = optimalPaths(internalCost(bspVolume), maximumJump, smoothness)
+  nz, ny, nx = bspVolume.shape
+  bspOnSurface = bspVolume[numpy.arange(nz)[:, numpy.newaxis], surface, numpy.arange(nx)[numpy.newaxis, :]]
+  surface[~(bspOnSurface >= minimumBSP)] = -1
+  return surface[0] if is2D else surface
+
+#-----------------------------------------------------------------------------
+def surfaceLabelVolume(surface, shape, label=1, outputVolume=None):
+  """Returns a label volume of the given (nz, ny, nx) shape, which is label on the surface and zero
+  elsewhere, from a surface returned by boneSurface."""
+  surface = numpy.asarray(surface)
+  if surface.ndim == 1:
+    surface = surface[numpy.newaxis]
+  if outputVolume is None:
+    outputVolume = numpy.zeros(shape, dtype=numpy.uint8)
+  else:
+    outputVolume[...] = 0
+  sliceIndices, columnIndices = numpy.nonzero(surface >= 0)
+  outputVolume.reshape(shape)[sliceIndices, surface[sliceIndices, columnIndices], columnIndices] = label
+  return outputVolume
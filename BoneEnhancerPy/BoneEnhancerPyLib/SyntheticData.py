@@ -0,0 +1,37 @@
+"""
+Synthetic US sweeps for testing and benchmarking without recorded data.
+
+A sweep is a (nz, ny, nx) volume of B-mode like frames: Rayleigh distributed speckle
+which gets darker with depth, a bright bone surface which moves slowly from frame to
+frame, and an acoustic shadow below the surface. The surface row of every column is
+known (syntheticSurface), so the frames can also be used to check bone surface extraction.
+"""
+
+import numpy
+
+#-----------------------------------------------------------------------------
+def syntheticSurface(numberOfFrames, ny, nx):
+  """Returns the bone surface row of every frame and column, as a (numberOfFrames, nx) int array."""
+  x = numpy.arange(nx, dtype=numpy.float64) / max(nx - 1, 1)
+  frame = numpy.arange(numberOfFrames, dtype=numpy.float64)[:, numpy.newaxis]
+  # A shallow arc in the middle of the image, which slowly shifts and tilts through the sweep
+  depth = 0.55 + 0.1 * numpy.sin(2 * numpy.pi * (x - 0.5)) * numpy.cos(2 * numpy.pi * frame / max(numberOfFrames, 1))
+  depth = depth - 0.15 * numpy.exp(-((x - 0.5 - 0.2 * numpy.sin(frame / 10.0)) ** 2) / 0.02)
+  return numpy.clip(numpy.round(depth * ny), 0, ny - 1).astype(int)
+
+#-----------------------------------------------------------------------------
+def syntheticSweep(numberOfFrames=50, ny=280, nx=440, dtype=numpy.uint8, seed=0):
+  """Returns a synthetic sweep of shape (numberOfFrames, ny, nx), with values between 0 and 255."""
+  random = numpy.random.RandomState(seed)
+  surface = syntheticSurface(numberOfFrames, ny, nx)
+  row = numpy.arange(ny)[:, numpy.newaxis]
+  attenuation = numpy.exp(-2.0 * row / ny)
+  sweep = numpy.zeros((numberOfFrames, ny, nx), dtype=dtype)
+  for frameIndex in range(numberOfFrames):
+    frame = 40 * attenuation * random.rayleigh(1.0, (ny, nx))
+    distance = row - surface[frameIndex][numpy.newaxis, :]
+    # Bright reflection at the surface, and a shadow which gets darker below it
+    frame += 200 * numpy.exp(-(distance * distance) / 4.0)
+    frame = numpy.where(distance > 3, frame * numpy.exp(-numpy.clip(distance - 3, 0, None) / 10.0), frame)
+    sweep[frameIndex] = numpy.clip(frame, 0, 255)
+  return sweep
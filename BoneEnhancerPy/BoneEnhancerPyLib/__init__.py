@@ -0,0 +1 @@
+"""NumPy implementations of the BoneEnhancer algorithms, usable without Slicer."""
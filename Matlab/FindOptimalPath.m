@@ -3,16 +3,39 @@ filename = 'H:/src/S4Mods/BoneEnhancer/Data/BP_Lumbar_SingleSlice_Double.mha';
 BoneProbability = imrotate(BoneProbability, -90);
 %imshow(BP)
 
-E_int = 1 - BoneProbability;
+% Parameters, see BoneEnhancerPyLib/SurfaceExtraction.py
+maxJump = 3;       % maximum vertical jump between neighbouring columns (rows)
+smoothness = 0.02; % cost per row of vertical jump
+minBSP = 20;       % columns with a lower BSP on the path are not bone
 
+% Internal cost, BoneProbability is the BSP (0-255)
+E_int = 1 - BoneProbability / 255;
+[ny, nx] = size(E_int);
+jumps = -maxJump:maxJump;
+
+% minC(i,j) is the minimum cost of a path ending in pixel (i,j), minI(i,j) the row
+% of the previous column on that path. Each column is updated at once.
 minC = zeros(size(BoneProbability));
 minI = zeros(size(BoneProbability));
+minC(:,1) = E_int(:,1);
+for j=2:nx
+    padded = [inf(maxJump,1); minC(:,j-1); inf(maxJump,1)];
+    candidates = zeros(ny, numel(jumps));
+    for k=1:numel(jumps)
+        candidates(:,k) = padded((1:ny) + maxJump + jumps(k)) + smoothness * abs(jumps(k));
+    end
+    [cost, best] = min(candidates, [], 2);
+    minC(:,j) = E_int(:,j) + cost;
+    minI(:,j) = (1:ny)' + jumps(best)';
+end
+
+% Backtrack from the minimum cost row of the last column
+surface = zeros(1, nx);
+[~, surface(nx)] = min(minC(:,nx));
+for j=nx:-1:2
+    surface(j-1) = minI(surface(j), j);
+end
+surface(BoneProbability(sub2ind(size(BoneProbability), surface, 1:nx)) < minBSP) = NaN;
 
-for i=1:size(BoneProbability,1)
-    for j=1:size(BoneProbability,2)
-        for k=1:size(BoneProbability,2)
-               
-        end                    
-        minC(i,j) = E_int(i,j) + 111;
-    end    
-end
\ No newline at end of file
+imshow(BoneProbability, []); hold on;
+plot(1:nx, surface, 'r');